@@ -0,0 +1,127 @@
+# app/audit.py
+"""
+Entity columns for AuditLog.
+
+Every AuditLog row is tagged with the entity it is about (entity_type, entity_id),
+derived from its meta, so per-entity history is an indexed lookup instead of a
+scan over recent rows. Two meta formats exist:
+
+    JSON    {"po_id": 12, "action": "ship", ...}
+    legacy  "po:12,vendor:3,total:120.0"
+
+ORM inserts are tagged by a before_insert listener when the caller didn't set
+the columns; bulk Core inserts must pass them explicitly. Rows written before
+the columns existed are backfilled once:
+
+    python -m app.audit
+"""
+import json
+import logging
+from typing import Any, Dict, Optional, Tuple
+
+from sqlalchemy import bindparam, event, update
+from sqlmodel import Session, select
+
+from .models import AuditLog
+
+logger = logging.getLogger(__name__)
+
+PURCHASE_ORDER = "purchase_order"
+NEW_ORDER = "new_order"
+VENDOR_LIMIT = "vendor_limit"
+
+# meta key -> entity type, in priority order (a row about a PO may also name its vendor)
+ENTITY_KEYS = (
+    ("po_id", PURCHASE_ORDER),
+    ("po", PURCHASE_ORDER),
+    ("order_id", NEW_ORDER),
+    ("limit_id", VENDOR_LIMIT),
+)
+
+
+def _parse_meta(meta: Optional[str]) -> Dict[str, Any]:
+    if not meta:
+        return {}
+    try:
+        data = json.loads(meta)
+        return data if isinstance(data, dict) else {}
+    except ValueError:
+        pass
+    pairs = {}
+    for part in meta.split(","):
+        key, sep, value = part.partition(":")
+        if sep:
+            pairs[key.strip()] = value.strip()
+    return pairs
+
+
+def parse_entity(meta: Optional[str]) -> Tuple[Optional[str], Optional[int]]:
+    data = _parse_meta(meta)
+    for key, entity_type in ENTITY_KEYS:
+        if key in data:
+            try:
+                return entity_type, int(data[key])
+            except (TypeError, ValueError):
+                return None, None
+    return None, None
+
+
+@event.listens_for(AuditLog, "before_insert")
+def _tag_entity(mapper, connection, target: AuditLog):
+    if target.entity_type is None:
+        target.entity_type, target.entity_id = parse_entity(target.meta)
+
+
+def entity_history(session: Session, entity_type: str, entity_id: int, limit: int = 10):
+    """Newest-first audit rows for one entity (range scan on ix_auditlog_entity)."""
+    stmt = (
+        select(AuditLog)
+        .where(AuditLog.entity_type == entity_type, AuditLog.entity_id == entity_id)
+        .order_by(AuditLog.id.desc())
+        .limit(limit)
+    )
+    return session.exec(stmt).all()
+
+
+# ---------------- one-off backfill ----------------
+
+def backfill_entities(session: Session, batch_size: int = 1000) -> int:
+    """Tag untagged rows from their meta, in id order, committing per batch. Returns rows tagged."""
+    t = AuditLog.__table__
+    stmt = (
+        update(t)
+        .where(t.c.id == bindparam("b_id"))
+        .values(entity_type=bindparam("b_type"), entity_id=bindparam("b_entity_id"))
+    )
+    tagged = 0
+    last_id = 0
+    while True:
+        rows = session.exec(
+            select(AuditLog.id, AuditLog.meta)
+            .where(AuditLog.entity_type.is_(None), AuditLog.id > last_id)
+            .order_by(AuditLog.id)
+            .limit(batch_size)
+        ).all()
+        if not rows:
+            break
+        last_id = rows[-1][0]
+        params = []
+        for row_id, meta in rows:
+            entity_type, entity_id = parse_entity(meta)
+            if entity_type:
+                params.append({"b_id": row_id, "b_type": entity_type, "b_entity_id": entity_id})
+        if params:
+            session.execute(stmt, params)
+            session.commit()
+            tagged += len(params)
+    return tagged
+
+
+if __name__ == "__main__":
+    from .database import engine, init_db
+
+    logging.basicConfig(level=logging.INFO)
+    init_db()
+    with Session(engine) as s:
+        n = backfill_entities(s)
+    print(f"tagged {n} audit row(s)")
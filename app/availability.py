@@ -0,0 +1,368 @@
+# app/availability.py
+"""
+Write-through availability cache in Redis.
+
+    stock:avail:{product_id} = StockLevel.quantity - reserved
+
+where "reserved" is the qty held by active StockReservation rows (see
+reservations.py; placed / processing orders hold stock until dispatch).
+Order paths call adjust() with the qty deltas after their commit. Orders take
+stock with holding(): one script checks every line and DECRBYs them all only if
+none would go below zero, so two concurrent orders cannot both pass the check;
+the hold is given back if the order is not committed. Stock write paths that know
+their deltas adjust() too; others call refresh() after commit, and reconcile()
+rewrites all keys from MySQL periodically to correct drift.
+
+refresh() / reconcile() write absolute values computed from the DB, so they must
+not land on top of a change the DB read did not see. Every take, adjust and hold
+release bumps stock:gen:{id}, and a take in flight (taken, not yet committed)
+counts in stock:held:{id}: a recomputed value is only written if the product's
+generation is unchanged since before the DB read and nothing is held; otherwise
+the key is left alone (the change itself was applied as a delta).
+
+Redis is only a cache: any redis error falls back to computing from the DB.
+"""
+import logging
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Dict, Iterable, List, Optional
+
+import redis
+from fastapi import HTTPException
+from sqlalchemy import func
+from sqlmodel import Session, select
+
+from .models import Product, ReservationStatus, StockLevel, StockReservation
+from .redis_client import redis_client
+
+logger = logging.getLogger(__name__)
+
+KEY_PREFIX = "stock:avail:"
+GEN_PREFIX = "stock:gen:"
+HELD_PREFIX = "stock:held:"
+HELD_TTL_SECONDS = 300  # a hold whose request died is forgotten after this long
+OPEN_ORDER_STATUSES = ("placed", "processing")
+
+# KEYS: n avail keys then their n gen keys. INCRBY only keys that already exist; a
+# missing key is loaded lazily from the DB instead of being created from 0 with a partial value.
+_ADJUST_LUA = """
+local n = #ARGV
+for i = 1, n do
+    if redis.call('EXISTS', KEYS[i]) == 1 then
+        redis.call('INCRBY', KEYS[i], ARGV[i])
+    end
+    redis.call('INCR', KEYS[n + i])
+end
+return n
+"""
+_adjust_script = redis_client.register_script(_ADJUST_LUA)
+
+# All-or-nothing take. KEYS: n avail, n gen, n held keys; ARGV: n qtys, then the held TTL.
+# Returns {"ok"}, {"missing"} when a key is not loaded yet, or {"short", avail_1, ..., avail_n}
+# without touching anything.
+_TAKE_LUA = """
+local n = #ARGV - 1
+local avail = {}
+for i = 1, n do
+    local v = redis.call('GET', KEYS[i])
+    if not v then
+        return {'missing'}
+    end
+    avail[i] = tonumber(v)
+end
+for i = 1, n do
+    if avail[i] < tonumber(ARGV[i]) then
+        local out = {'short'}
+        for j = 1, n do
+            out[j + 1] = avail[j]
+        end
+        return out
+    end
+end
+for i = 1, n do
+    redis.call('DECRBY', KEYS[i], ARGV[i])
+    redis.call('INCR', KEYS[n + i])
+    redis.call('INCR', KEYS[2 * n + i])
+    redis.call('EXPIRE', KEYS[2 * n + i], ARGV[n + 1])
+end
+return {'ok'}
+"""
+_take_script = redis_client.register_script(_TAKE_LUA)
+
+# End of a take (committed or given back). KEYS: n gen keys then n held keys.
+# The generation moves first, so a recompute that started while the take was held never writes.
+_RELEASE_LUA = """
+local n = #KEYS / 2
+for i = 1, n do
+    redis.call('INCR', KEYS[i])
+    if redis.call('DECR', KEYS[n + i]) <= 0 then
+        redis.call('DEL', KEYS[n + i])
+    end
+end
+return n
+"""
+_release_script = redis_client.register_script(_RELEASE_LUA)
+
+# Write recomputed values. KEYS: n avail, n gen, n held keys; ARGV: n values, the n
+# generations read before the DB query ('' = none), then '1' to only fill missing keys.
+# Returns how many keys were written.
+_SET_IF_UNCHANGED_LUA = """
+local n = #KEYS / 3
+local only_missing = ARGV[2 * n + 1] == '1'
+local written = 0
+for i = 1, n do
+    local gen = redis.call('GET', KEYS[n + i]) or ''
+    local held = tonumber(redis.call('GET', KEYS[2 * n + i]) or '0')
+    if gen == ARGV[n + i] and held <= 0 and not (only_missing and redis.call('EXISTS', KEYS[i]) == 1) then
+        redis.call('SET', KEYS[i], ARGV[i])
+        written = written + 1
+    end
+end
+return written
+"""
+_set_if_unchanged_script = redis_client.register_script(_SET_IF_UNCHANGED_LUA)
+
+RECOMPUTE_CHUNK = 500
+
+
+def _key(product_id: int) -> str:
+    return f"{KEY_PREFIX}{product_id}"
+
+
+def _gen_key(product_id: int) -> str:
+    return f"{GEN_PREFIX}{product_id}"
+
+
+def _held_key(product_id: int) -> str:
+    return f"{HELD_PREFIX}{product_id}"
+
+
+def order_reservation(items: Iterable, status: Optional[str]) -> Dict[int, int]:
+    """qty held per product by an order's items (empty when the order is not open)."""
+    held: Dict[int, int] = defaultdict(int)
+    if status not in OPEN_ORDER_STATUSES:
+        return {}
+    for it in items:
+        held[int(it.product_id)] += int(it.qty or 0)
+    return dict(held)
+
+
+def compute_available(session: Session, product_ids: Optional[List[int]] = None) -> Dict[int, int]:
+    """Available qty straight from MySQL (two grouped queries)."""
+    lvl_stmt = select(StockLevel.product_id, func.sum(StockLevel.quantity)).group_by(StockLevel.product_id)
+    res_stmt = (
+        select(StockReservation.product_id, func.sum(StockReservation.qty))
+        .where(StockReservation.status == ReservationStatus.ACTIVE)
+        .group_by(StockReservation.product_id)
+    )
+    if product_ids is not None:
+        if not product_ids:
+            return {}
+        lvl_stmt = lvl_stmt.where(StockLevel.product_id.in_(product_ids))
+        res_stmt = res_stmt.where(StockReservation.product_id.in_(product_ids))
+        ids = list(product_ids)
+    else:
+        ids = list(session.exec(select(Product.id)).all())
+
+    levels = {int(pid): int(q or 0) for pid, q in session.exec(lvl_stmt).all()}
+    reserved = {int(pid): int(q or 0) for pid, q in session.exec(res_stmt).all()}
+    return {int(pid): levels.get(int(pid), 0) - reserved.get(int(pid), 0) for pid in ids}
+
+
+def get_available(session: Session, product_ids: Iterable[int]) -> Dict[int, int]:
+    """Available qty per product: one MGET, DB fallback (and backfill) for misses."""
+    ids = list(dict.fromkeys(int(p) for p in product_ids))
+    if not ids:
+        return {}
+    try:
+        cached = redis_client.mget([_key(p) for p in ids])
+    except redis.RedisError:
+        logger.warning("availability cache unavailable, reading from DB")
+        return compute_available(session, ids)
+
+    result: Dict[int, int] = {}
+    missing: List[int] = []
+    for pid, val in zip(ids, cached):
+        if val is None:
+            missing.append(pid)
+        else:
+            result[pid] = int(val)
+
+    if missing:
+        try:
+            loaded = _recompute(session, missing, only_missing=True)[0]
+        except redis.RedisError:
+            loaded = compute_available(session, missing)
+        result.update(loaded)
+    return result
+
+
+def _raise_shortages(requested: Dict[int, int], available: Dict[int, int]):
+    """Raise 409 listing every line whose requested qty exceeds availability."""
+    shortages = [
+        {"product_id": pid, "requested": qty, "available": max(0, available.get(pid, 0))}
+        for pid, qty in requested.items()
+        if qty > available.get(pid, 0)
+    ]
+    if shortages:
+        raise HTTPException(status_code=409, detail={"message": "Insufficient stock", "items": shortages})
+
+
+def _own_session() -> Session:
+    """Session for reads inside a hold: the caller's may have staged, uncommitted reservations."""
+    from .database import engine
+
+    return Session(engine)
+
+
+def _take(requested: Dict[int, int]) -> bool:
+    """Atomically decrement every line or raise 409. False when redis could not be used."""
+    ids = list(requested)
+    keys = [_key(p) for p in ids] + [_gen_key(p) for p in ids] + [_held_key(p) for p in ids]
+    args = [int(requested[p]) for p in ids] + [HELD_TTL_SECONDS]
+    try:
+        for attempt in range(3):
+            res = _take_script(keys=keys, args=args)
+            if res[0] == "ok":
+                return True
+            if res[0] == "short":
+                _raise_shortages(requested, {pid: int(v) for pid, v in zip(ids, res[1:])})
+            # load the missing keys without overwriting ones a concurrent request just took from
+            with _own_session() as session:
+                _recompute(session, ids, only_missing=True)
+    except redis.RedisError:
+        logger.warning("availability cache unavailable, checking stock in DB")
+    return False
+
+
+def _release(product_ids: List[int]):
+    if not product_ids:
+        return
+    try:
+        _release_script(keys=[_gen_key(p) for p in product_ids] + [_held_key(p) for p in product_ids])
+    except redis.RedisError:
+        logger.warning("availability hold release failed for %d products", len(product_ids))
+
+
+class Hold:
+    """Stock taken by one request; see holding()."""
+
+    def __init__(self):
+        self.taken: Dict[int, int] = defaultdict(int)
+
+    def take(self, requested: Dict[int, int]):
+        """Take qty per product (positive = more stock held), raising 409 on a shortage."""
+        requested = {int(p): int(q) for p, q in requested.items() if q and int(q) > 0}
+        if not requested:
+            return
+        if not _take(requested):
+            # without redis this degrades to a (non-atomic) check against the DB
+            with _own_session() as session:
+                _raise_shortages(requested, compute_available(session, list(requested)))
+            return
+        for pid, qty in requested.items():
+            self.taken[pid] += qty
+
+
+@contextmanager
+def holding(requested: Optional[Dict[int, int]] = None):
+    """
+    Take stock for an order being placed or grown, raising 409 on a shortage:
+
+        with availability.holding(requested) as hold:   # and/or hold.take(...) inside
+            ... stage the order / reservations ...
+            session.commit()
+
+    Commit inside the block; if the block raises, everything taken is given back.
+    """
+    hold = Hold()
+    try:
+        hold.take(requested or {})
+        yield hold
+    except BaseException:
+        adjust(hold.taken)
+        raise
+    finally:
+        _release(list(hold.taken))
+
+
+def _recompute(session: Session, product_ids: List[int], cached_too: bool = False, only_missing: bool = False):
+    """
+    Write DB-computed values for product_ids unless a take / adjust raced the DB read
+    (see the module docstring). Returns (truth, cached values before the write, written count).
+    """
+    truth: Dict[int, int] = {}
+    cached: Dict[int, Optional[str]] = {}
+    written = 0
+    for start in range(0, len(product_ids), RECOMPUTE_CHUNK):
+        ids = product_ids[start:start + RECOMPUTE_CHUNK]
+        gens = redis_client.mget([_gen_key(p) for p in ids])
+        values = compute_available(session, ids)
+        if cached_too:
+            cached.update(zip(ids, redis_client.mget([_key(p) for p in ids])))
+        written += _set_if_unchanged_script(
+            keys=[_key(p) for p in ids] + [_gen_key(p) for p in ids] + [_held_key(p) for p in ids],
+            args=[values[p] for p in ids] + [g or "" for g in gens] + ["1" if only_missing else "0"],
+        )
+        truth.update(values)
+    return truth, cached, written
+
+
+def refresh(session: Session, product_ids: Iterable[int]):
+    """Recompute and write through the given products (call after the DB commit)."""
+    ids = list(dict.fromkeys(int(p) for p in product_ids))
+    if not ids:
+        return
+    try:
+        _recompute(session, ids)
+    except redis.RedisError:
+        logger.warning("availability refresh failed for %d products", len(ids))
+
+
+def adjust(deltas: Dict[int, int]):
+    """Apply available-qty deltas (negative = reserve) to already-cached products."""
+    deltas = {int(p): int(d) for p, d in deltas.items() if d}
+    if not deltas:
+        return
+    try:
+        _adjust_script(keys=[_key(p) for p in deltas] + [_gen_key(p) for p in deltas], args=list(deltas.values()))
+    except redis.RedisError:
+        # drop the keys so the next read reloads from MySQL instead of serving stale values
+        try:
+            redis_client.delete(*[_key(p) for p in deltas])
+        except redis.RedisError:
+            logger.warning("availability cache adjust failed for %d products", len(deltas))
+
+
+def forget(product_ids: Iterable[int]):
+    keys = [_key(p) for p in product_ids]
+    if not keys:
+        return
+    try:
+        redis_client.delete(*keys)
+    except redis.RedisError:
+        pass
+
+
+def reconcile(session: Session) -> Dict[str, int]:
+    """
+    Rewrite every product's key from MySQL and report how many had drifted.
+    Products with a take / adjust racing the read are skipped until the next run.
+    """
+    ids = [int(p) for p in session.exec(select(Product.id)).all()]
+    try:
+        truth, cached, written = _recompute(session, ids, cached_too=True)
+    except redis.RedisError:
+        logger.warning("availability reconcile skipped: redis unavailable")
+        return {"products": len(ids), "drifted": 0, "skipped": 0}
+    drifted = sum(1 for pid, val in cached.items() if val is not None and int(val) != truth[pid])
+    if drifted:
+        logger.info("availability reconcile corrected %d of %d products", drifted, len(ids))
+    return {"products": len(ids), "drifted": drifted, "skipped": len(ids) - written}
+
+
+def reconcile_job():
+    from .database import engine
+
+    with Session(engine) as session:
+        reconcile(session)
@@ -0,0 +1,58 @@
+# app/background.py
+"""
+Tiny periodic-job runner for maintenance work (cache reconcile, sweepers, ...).
+
+Every worker process starts the same daemon threads, but each run first takes a
+short Redis lock (SET NX EX) so only one gunicorn worker executes a job per
+interval. Jobs open their own DB session.
+"""
+import logging
+import threading
+import time
+import uuid
+from typing import Callable, Dict
+
+import redis
+
+from .config import settings
+from .redis_client import redis_client
+
+logger = logging.getLogger(__name__)
+
+_started: Dict[str, threading.Thread] = {}
+
+
+def _run_locked(name: str, interval_seconds: int, fn: Callable[[], object]):
+    token = uuid.uuid4().hex
+    try:
+        acquired = redis_client.set(f"bg:lock:{name}", token, nx=True, ex=max(1, int(interval_seconds)))
+    except redis.RedisError:
+        # without redis we cannot elect a single runner; skip this tick
+        logger.warning("background job %s skipped: redis unavailable", name)
+        return
+    if not acquired:
+        return
+    try:
+        fn()
+    except Exception:
+        logger.exception("background job %s failed", name)
+
+
+def start_periodic(name: str, interval_seconds: int, fn: Callable[[], object]):
+    """
+    Run fn() every interval_seconds in a daemon thread (at most one worker per tick).
+    Calling twice with the same name is a no-op.
+    """
+    if not settings.BACKGROUND_JOBS_ENABLED or interval_seconds <= 0:
+        return
+    if name in _started:
+        return
+
+    def loop():
+        while True:
+            time.sleep(interval_seconds)
+            _run_locked(name, interval_seconds, fn)
+
+    t = threading.Thread(target=loop, name=f"bg-{name}", daemon=True)
+    t.start()
+    _started[name] = t
@@ -0,0 +1,70 @@
+# app/concurrency.py
+"""
+Optimistic concurrency helpers for versioned rows (NewOrder, PurchaseOrder).
+
+The models carry a `version` column used as SQLAlchemy's version_id_col, so every
+flush is a compare-and-swap (UPDATE ... WHERE id=:id AND version=:v). Endpoints:
+
+    check_if_match(order, if_match, current)
+    with versioned_write(session, order, current):
+        ... mutate ...
+    set_etag(response, order)
+
+where current is a callable returning the serialized row. Both helpers answer
+409 with the row's current state so the client can re-apply its edit on top of it.
+"""
+from contextlib import contextmanager
+from typing import Any, Callable, Optional
+
+from fastapi import HTTPException, Response
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy.orm.exc import StaleDataError
+from sqlmodel import Session
+
+
+def parse_if_match(value: Optional[str]) -> Optional[int]:
+    """Expected version from an If-Match header ('3', '"3"', 'W/"3"'); None for absent or '*'."""
+    if value is None:
+        return None
+    value = value.strip()
+    if value in ("", "*"):
+        return None
+    if value.startswith("W/"):
+        value = value[2:]
+    try:
+        return int(value.strip('"'))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="If-Match must be the resource version, e.g. \"3\"")
+
+
+def _conflict(current: Any):
+    raise HTTPException(
+        status_code=409,
+        detail={"message": "Resource was modified by someone else; reload and retry", "current": jsonable_encoder(current)},
+    )
+
+
+def check_if_match(obj, if_match: Optional[str], current_state: Callable[[], Any]):
+    """Reject early when the client's If-Match version is already stale."""
+    expected = parse_if_match(if_match)
+    if expected is not None and expected != obj.version:
+        _conflict(current_state())
+
+
+@contextmanager
+def versioned_write(session: Session, obj, current_state: Callable[[], Any]):
+    """
+    Run the mutations in the block and commit. If another writer bumped the version
+    meanwhile (detected at any flush inside the block or at commit), roll back and answer 409.
+    """
+    try:
+        yield
+        session.commit()
+    except StaleDataError:
+        session.rollback()
+        session.refresh(obj)
+        _conflict(current_state())
+
+
+def set_etag(response: Response, obj):
+    response.headers["ETag"] = f'"{obj.version}"'
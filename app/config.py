@@ -10,6 +10,33 @@ class Settings(BaseSettings):
     ATTENDANCE_FIXED_LNG: float | None = None
     ATTENDANCE_RADIUS_METERS: int = 100         # allowed radius in meters (default 100)
     TIMEZONE: str = "Asia/Kolkata"
+    BACKGROUND_JOBS_ENABLED: bool = True
+    AVAILABILITY_RECONCILE_SECONDS: int = 300   # redis availability cache vs MySQL drift check
+    RESERVATION_TTL_HOURS: int = 48             # placed orders hold stock this long unless dispatched
+    RESERVATION_SWEEP_SECONDS: int = 60
+    IDEMPOTENCY_TTL_SECONDS: int = 60*60*24     # how long a replayable response is kept
+    IDEMPOTENCY_LOCK_SECONDS: int = 60          # max time one request may hold its key
+    IDEMPOTENCY_WAIT_SECONDS: int = 15          # duplicates wait this long for the first to finish
+    PHONEPE_TIMEOUT_SECONDS: float = 10.0       # per gateway HTTP call
+    PHONEPE_MAX_RETRIES: int = 2                # extra attempts on timeouts / 5xx / 429
+    PHONEPE_POOL_SIZE: int = 20                 # keep-alive connections per worker
+    PHONEPE_BREAKER_FAILURES: int = 5           # consecutive failed calls that open the circuit
+    PHONEPE_BREAKER_RESET_SECONDS: int = 30     # open circuit fails fast this long, then lets one call probe
+    PHONEPE_TOKEN_REFRESH_MARGIN_SECONDS: int = 300  # refresh the shared OAuth token this long before expiry
+    PHONEPE_TOKEN_LOCK_SECONDS: int = 10        # max time one worker may hold the token refresh lock
+    PHONEPE_TOKEN_WAIT_SECONDS: float = 5.0     # others wait this long for a refresh once the token expired
+    PAYMENT_RECONCILE_SECONDS: int = 60         # background poll of pending PhonePe payments (0 = off)
+    PAYMENT_RECONCILE_BATCH: int = 200          # attempts loaded and applied per batch
+    PAYMENT_RECONCILE_MAX_PER_RUN: int = 2000
+    PAYMENT_RECONCILE_CONCURRENCY: int = 10     # status calls in flight at once
+    PAYMENT_RECONCILE_RATE_PER_SECOND: float = 20.0
+    PAYMENT_RECONCILE_MIN_AGE_SECONDS: int = 60  # leave attempts alone this long after creation / last check
+    PHONEPE_WEBHOOK_USERNAME: str | None = None  # callback credentials configured on the PhonePe dashboard
+    PHONEPE_WEBHOOK_PASSWORD: str | None = None
+    PAYMENT_WEBHOOK_DRAIN_SECONDS: int = 2      # how often queued callbacks are applied
+    PAYMENT_WEBHOOK_BATCH: int = 500
+    PAYMENT_WEBHOOK_MAX_ATTEMPTS: int = 5       # failed applies before a batch is moved to the dead-letter list
+    PENDING_COUNTS_CACHE_SECONDS: int = 5       # dashboard badge counts are shared across workers this long
 
     class Config:
         env_file = ".env"
@@ -1,11 +1,54 @@
 from sqlmodel import SQLModel, create_engine, Session
+from sqlalchemy import inspect, text
 from .config import settings
 
 engine = create_engine(settings.DATABASE_URL, echo=False, pool_pre_ping=True)
 
+# Columns added to tables that already exist in deployed databases.
+# create_all() only creates missing tables, so these are added with ALTER TABLE.
+ADDED_COLUMNS = {
+    "new_order": {
+        "version": "INTEGER NOT NULL DEFAULT 1",
+        "delivery_lat": "FLOAT NULL",
+        "delivery_lng": "FLOAT NULL",
+    },
+    "purchaseorder": {"version": "INTEGER NOT NULL DEFAULT 1"},
+    "purchaseitem": {"received_qty": "INTEGER NOT NULL DEFAULT 0"},
+    "auditlog": {
+        "entity_type": "VARCHAR(255) NULL",
+        "entity_id": "INTEGER NULL",
+    },
+}
+
+def _add_missing_columns():
+    insp = inspect(engine)
+    with engine.begin() as conn:
+        for table, columns in ADDED_COLUMNS.items():
+            if not insp.has_table(table):
+                continue
+            existing = {c["name"] for c in insp.get_columns(table)}
+            for name, ddl in columns.items():
+                if name not in existing:
+                    conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {name} {ddl}"))
+
+def _add_missing_indexes():
+    """Indexes declared on models for tables that predate them (create_all skips existing tables)."""
+    insp = inspect(engine)
+    with engine.begin() as conn:
+        for name, table in SQLModel.metadata.tables.items():
+            if not table.indexes or not insp.has_table(name):
+                continue
+            existing = {i["name"] for i in insp.get_indexes(name)}
+            for index in table.indexes:
+                if index.name not in existing:
+                    index.create(conn)
+
 def init_db():
     from . import models  # ensure models are imported
+    from . import audit  # registers the AuditLog entity listener
     SQLModel.metadata.create_all(engine)
+    _add_missing_columns()
+    _add_missing_indexes()
 
 def get_session():
     with Session(engine) as session:
@@ -0,0 +1,143 @@
+# app/driver_assignments.py
+"""
+Driver assignments for PurchaseOrders (po_driver_assignment).
+
+assign-driver records a row in the same transaction as the PO status change,
+ship moves it to 'shipped', and re-assigning a PO marks the previous row
+'reassigned' so a PO has at most one live assignment. Drivers list their work
+with one query on the (driver_id, status) index.
+
+Older assignments only exist as assign_driver AuditLog rows; backfill them once:
+
+    python -m app.driver_assignments
+
+Functions here only stage changes on the session; the caller commits.
+"""
+import json
+import logging
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from sqlalchemy import insert, update
+from sqlmodel import Session, select
+
+from .models import AssignmentStatus, AuditLog, PODriverAssignment, PurchaseOrder
+
+logger = logging.getLogger(__name__)
+
+ACTIVE_STATUSES = (AssignmentStatus.ASSIGNED, AssignmentStatus.SHIPPED)
+
+
+def record_assignment(session: Session, po_id: int, driver_id: int, assigned_by: Optional[int] = None,
+                      eta_days: Optional[int] = None, notes: Optional[str] = None) -> PODriverAssignment:
+    now = datetime.utcnow()
+    t = PODriverAssignment.__table__
+    session.execute(
+        update(t)
+        .where(t.c.purchase_order_id == po_id, t.c.status.in_(ACTIVE_STATUSES))
+        .values(status=AssignmentStatus.REASSIGNED, updated_at=now)
+    )
+    row = PODriverAssignment(purchase_order_id=po_id, driver_id=driver_id, assigned_by=assigned_by,
+                             eta_days=eta_days, notes=notes, assigned_at=now)
+    session.add(row)
+    return row
+
+
+def mark_shipped(session: Session, po_id: int) -> int:
+    t = PODriverAssignment.__table__
+    res = session.execute(
+        update(t)
+        .where(t.c.purchase_order_id == po_id, t.c.status == AssignmentStatus.ASSIGNED)
+        .values(status=AssignmentStatus.SHIPPED, updated_at=datetime.utcnow())
+    )
+    return res.rowcount
+
+
+def current_driver(session: Session, po_id: int) -> Optional[int]:
+    """Driver of the PO's live assignment (None if unassigned); status events carry it for driver feeds."""
+    return session.exec(
+        select(PODriverAssignment.driver_id)
+        .where(PODriverAssignment.purchase_order_id == po_id, PODriverAssignment.status.in_(ACTIVE_STATUSES))
+        .order_by(PODriverAssignment.id.desc())
+        .limit(1)
+    ).first()
+
+
+def driver_pos_stmt(driver_id: int, limit: int):
+    """Newest-first POs currently assigned to (or shipped by) a driver."""
+    return (
+        select(PurchaseOrder)
+        .join(PODriverAssignment, PODriverAssignment.purchase_order_id == PurchaseOrder.id)
+        .where(PODriverAssignment.driver_id == driver_id, PODriverAssignment.status.in_(ACTIVE_STATUSES))
+        .order_by(PODriverAssignment.assigned_at.desc(), PODriverAssignment.id.desc())
+        .limit(limit)
+    )
+
+
+# ---------------- one-off backfill ----------------
+
+def backfill_from_audit(session: Session, batch_size: int = 1000) -> int:
+    """
+    Build assignment rows from assign_driver audit entries for POs that have none yet.
+    The latest entry per PO is live ('shipped' if the PO has shipped); earlier ones
+    are 'reassigned'. Returns the number of rows inserted.
+    """
+    done = set(session.exec(select(PODriverAssignment.purchase_order_id).distinct()).all())
+    by_po: Dict[int, List[dict]] = {}
+    last_id = 0
+    while True:
+        rows = session.exec(
+            select(AuditLog)
+            .where(AuditLog.action == "assign_driver", AuditLog.id > last_id)
+            .order_by(AuditLog.id)
+            .limit(batch_size)
+        ).all()
+        if not rows:
+            break
+        last_id = rows[-1].id
+        for r in rows:
+            try:
+                meta = json.loads(r.meta) if r.meta else {}
+                po_id, driver_id = int(meta["po_id"]), int(meta["driver_id"])
+            except (ValueError, KeyError, TypeError):
+                logger.warning("skipping unparsable assign_driver audit row %s", r.id)
+                continue
+            if po_id in done:
+                continue
+            by_po.setdefault(po_id, []).append({
+                "purchase_order_id": po_id,
+                "driver_id": driver_id,
+                "assigned_by": meta.get("by", r.user_id),
+                "status": AssignmentStatus.REASSIGNED,
+                "eta_days": meta.get("eta_days"),
+                "notes": meta.get("notes"),
+                "assigned_at": r.timestamp,
+                "updated_at": None,
+            })
+    if not by_po:
+        return 0
+
+    po_status = dict(session.exec(
+        select(PurchaseOrder.id, PurchaseOrder.status).where(PurchaseOrder.id.in_(list(by_po)))
+    ).all())
+    values: List[dict] = []
+    for po_id, entries in by_po.items():
+        if po_id not in po_status:
+            continue  # PO deleted since
+        live = entries[-1]
+        live["status"] = AssignmentStatus.SHIPPED if po_status[po_id] == "shipped" else AssignmentStatus.ASSIGNED
+        values.extend(entries)
+    if values:
+        session.execute(insert(PODriverAssignment.__table__), values)
+    return len(values)
+
+
+if __name__ == "__main__":
+    from .database import engine, init_db
+
+    logging.basicConfig(level=logging.INFO)
+    init_db()
+    with Session(engine) as s:
+        n = backfill_from_audit(s)
+        s.commit()
+    print(f"backfilled {n} driver assignment row(s)")
@@ -0,0 +1,141 @@
+# app/events.py
+"""
+Status-change events for NewOrders and PurchaseOrders over Redis pub/sub.
+
+Write paths call publish(...) after their commit with one or more events:
+
+    publish(status_event("purchase_order", po.id, "packed", from_status="payment_verified",
+                         vendor_id=po.vendor_id, actor_id=user.id))
+
+and the SSE endpoint (routers/events.py) fans them out to connected dashboards,
+filtered per role with EVENT_RULES. Events only say *what* changed; clients
+refetch the affected row. Publishing is best effort: a Redis error is logged
+and never fails the request.
+
+Each worker process holds one asyncio pub/sub subscription (hub) that copies
+every event into a bounded asyncio.Queue per connected client, so open
+dashboards cost neither a Redis connection nor a threadpool thread each.
+"""
+import asyncio
+import json
+import logging
+from datetime import datetime
+from typing import Any, Dict, Optional, Set
+
+import redis
+
+from .models import Role
+from .redis_client import async_redis_client, redis_client
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = "events:status"
+
+KINDS = ("new_order", "purchase_order")
+
+# --- Role-based visibility: which kinds a role receives, and whether only its own rows ---
+EVENT_RULES = {
+    Role.MASTER:     {"kinds": KINDS, "own": None},
+    Role.ADMIN:      {"kinds": KINDS, "own": None},
+    Role.STAFF:      {"kinds": KINDS, "own": None},
+    Role.ACCOUNTANT: {"kinds": KINDS, "own": None},
+    Role.VENDOR:     {"kinds": KINDS, "own": "vendor_id"},
+    Role.DRIVER:     {"kinds": ("purchase_order",), "own": "driver_id"},
+}
+
+
+def status_event(kind: str, entity_id: int, to_status: str, from_status: Optional[str] = None,
+                 vendor_id: Optional[int] = None, actor_id: Optional[int] = None, **extra: Any) -> Dict[str, Any]:
+    evt = {
+        "kind": kind,
+        "id": entity_id,
+        "from": from_status,
+        "to": to_status,
+        "vendor_id": vendor_id,
+        "by": actor_id,
+        "at": datetime.utcnow().isoformat(),
+    }
+    evt.update(extra)
+    return evt
+
+
+def publish(*events: Dict[str, Any]):
+    """Publish events (call after the DB commit); one pipeline round trip for many."""
+    events = [e for e in events if e]
+    if not events:
+        return
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        for evt in events:
+            pipe.publish(CHANNEL, json.dumps(evt, default=str))
+        pipe.execute()
+    except redis.RedisError:
+        logger.warning("failed to publish %d status event(s)", len(events))
+
+
+def visible_to(evt: Dict[str, Any], user_id: int, role: str) -> bool:
+    rule = EVENT_RULES.get(role)
+    if not rule or evt.get("kind") not in rule["kinds"]:
+        return False
+    own = rule["own"]
+    return own is None or evt.get(own) == user_id
+
+
+# ---------------- per-process subscriber ----------------
+
+CLIENT_QUEUE_SIZE = 256
+
+
+class _Hub:
+    """One CHANNEL subscription per process, fanned out to per-client queues. None in a queue ends that client."""
+
+    def __init__(self):
+        self._queues: Set[asyncio.Queue] = set()
+        self._task: Optional[asyncio.Task] = None
+        self._lock = asyncio.Lock()
+
+    async def join(self) -> asyncio.Queue:
+        """Queue of (event, raw json) for a new client; raises redis.RedisError if the feed cannot start."""
+        async with self._lock:
+            if self._task is None or self._task.done():
+                pubsub = async_redis_client.pubsub(ignore_subscribe_messages=True)
+                try:
+                    await pubsub.subscribe(CHANNEL)
+                except redis.RedisError:
+                    await pubsub.aclose()
+                    raise
+                self._task = asyncio.create_task(self._listen(pubsub))
+            queue: asyncio.Queue = asyncio.Queue(maxsize=CLIENT_QUEUE_SIZE)
+            self._queues.add(queue)
+            return queue
+
+    def leave(self, queue: asyncio.Queue):
+        self._queues.discard(queue)
+
+    def _end(self, queue: asyncio.Queue):
+        self._queues.discard(queue)
+        while not queue.empty():
+            queue.get_nowait()
+        queue.put_nowait(None)
+
+    async def _listen(self, pubsub):
+        try:
+            async for msg in pubsub.listen():
+                if msg.get("type") != "message":
+                    continue
+                item = (json.loads(msg["data"]), msg["data"])
+                for queue in list(self._queues):
+                    try:
+                        queue.put_nowait(item)
+                    except asyncio.QueueFull:
+                        self._end(queue)  # a client that stopped reading reconnects instead of growing memory
+        except redis.RedisError:
+            logger.warning("status event subscription lost; disconnecting %d client(s)", len(self._queues))
+        finally:
+            # clients reconnect (SSE retry) and the next join() subscribes again
+            for queue in list(self._queues):
+                self._end(queue)
+            await pubsub.aclose()
+
+
+hub = _Hub()
@@ -0,0 +1,151 @@
+# app/idempotency.py
+"""
+Idempotency-Key support for create endpoints (orders, POs with payment).
+
+    with IdempotentRequest(idempotency_key, scope=f"new-order:{user.id}", payload=payload) as idem:
+        if idem.replay is not None:
+            return idem.replay
+        ... create ...
+        idem.save(result, status_code=201)
+        return result
+
+The first request with a key takes a short Redis lock, runs, and stores its
+response for IDEMPOTENCY_TTL_SECONDS. Retries get the stored response back
+(header Idempotent-Replayed: true) without running the handler again.
+A duplicate arriving while the first is still running waits for it (up to
+IDEMPOTENCY_WAIT_SECONDS) instead of executing in parallel. Reusing a key with a
+different payload is rejected with 422. Without the header, or when Redis is
+unreachable, the request simply runs normally.
+
+A handler with several commits (create the PO, then call the gateway) records
+what it already committed with idem.checkpoint({...}); if it then fails, a retry
+with the same key finds that in idem.progress and resumes instead of creating
+everything again.
+"""
+import hashlib
+import json
+import logging
+import time
+import uuid
+from typing import Any, Optional
+
+import redis
+from fastapi import HTTPException
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+from .config import settings
+from .redis_client import redis_client
+
+logger = logging.getLogger(__name__)
+
+HEADER = "Idempotency-Key"
+
+# delete the lock only if we still own it
+_RELEASE_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+_release_script = redis_client.register_script(_RELEASE_LUA)
+
+
+def _fingerprint(payload: Any) -> str:
+    raw = json.dumps(jsonable_encoder(payload), sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+class IdempotentRequest:
+    def __init__(self, key: Optional[str], scope: str, payload: Any = None):
+        self.key = (key or "").strip() or None
+        if self.key and len(self.key) > 255:
+            raise HTTPException(status_code=400, detail=f"{HEADER} must be at most 255 characters")
+        self.fingerprint = _fingerprint(payload)
+        base = f"idem:{scope}:{self.key}"
+        self._result_key = f"{base}:result"
+        self._lock_key = f"{base}:lock"
+        self._progress_key = f"{base}:progress"
+        self._token = uuid.uuid4().hex
+        self._locked = False
+        self.replay: Optional[JSONResponse] = None
+        self.progress: Optional[dict] = None
+
+    # ---- context manager -------------------------------------------------
+    def __enter__(self) -> "IdempotentRequest":
+        if not self.key:
+            return self
+        try:
+            self._acquire()
+        except redis.RedisError:
+            logger.warning("idempotency store unavailable, running request without it")
+            self.key = None
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self._locked:
+            try:
+                _release_script(keys=[self._lock_key], args=[self._token])
+            except redis.RedisError:
+                pass  # lock expires on its own
+        return False
+
+    # ---- internals -------------------------------------------------------
+    def _load(self) -> bool:
+        raw = redis_client.get(self._result_key)
+        if raw is None:
+            return False
+        stored = json.loads(raw)
+        if stored.get("fingerprint") != self.fingerprint:
+            raise HTTPException(status_code=422, detail=f"{HEADER} was already used with a different request body")
+        self.replay = JSONResponse(
+            status_code=stored["status_code"],
+            content=stored["body"],
+            headers={"Idempotent-Replayed": "true"},
+        )
+        return True
+
+    def _load_progress(self):
+        raw = redis_client.get(self._progress_key)
+        if raw is None:
+            return
+        stored = json.loads(raw)
+        if stored.get("fingerprint") != self.fingerprint:
+            raise HTTPException(status_code=422, detail=f"{HEADER} was already used with a different request body")
+        self.progress = stored["data"]
+
+    def _acquire(self):
+        deadline = time.monotonic() + settings.IDEMPOTENCY_WAIT_SECONDS
+        while True:
+            if self._load():
+                return
+            if redis_client.set(self._lock_key, self._token, nx=True, ex=settings.IDEMPOTENCY_LOCK_SECONDS):
+                self._locked = True
+                # the previous holder may have finished between our GET and SET
+                if not self._load():
+                    self._load_progress()
+                return
+            if time.monotonic() >= deadline:
+                raise HTTPException(status_code=409, detail=f"A request with this {HEADER} is still being processed")
+            time.sleep(0.1)
+
+    # ---- public ----------------------------------------------------------
+    def save(self, body: Any, status_code: int = 200):
+        """Remember the successful response for replays (no-op without a key)."""
+        if not self.key:
+            return
+        record = {"fingerprint": self.fingerprint, "status_code": status_code, "body": jsonable_encoder(body)}
+        try:
+            redis_client.set(self._result_key, json.dumps(record), ex=settings.IDEMPOTENCY_TTL_SECONDS)
+        except redis.RedisError:
+            logger.warning("failed to store idempotent response for key %s", self.key)
+
+    def checkpoint(self, data: dict):
+        """Record what a multi-step request has committed so far (no-op without a key)."""
+        if not self.key:
+            return
+        record = {"fingerprint": self.fingerprint, "data": jsonable_encoder(data)}
+        try:
+            redis_client.set(self._progress_key, json.dumps(record), ex=settings.IDEMPOTENCY_TTL_SECONDS)
+        except redis.RedisError:
+            logger.warning("failed to store idempotency progress for key %s", self.key)
@@ -0,0 +1,135 @@
+# app/load_planner.py
+"""
+Capacity-aware load planning for NewOrders.
+
+Order weight = sum(item.qty * Product.weight), computed for all orders in one
+grouped query. Product.weight is taken to be in kg; vehicle capacities are
+normalised to kg from Vehicle.capacity_unit. Orders are packed onto vehicles
+with first-fit-decreasing: heaviest order first, into the first vehicle
+(largest free capacity first) that still has room.
+"""
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import func
+from sqlmodel import Session, select
+
+from .availability import OPEN_ORDER_STATUSES
+from .models import NewOrder, NewOrderItem, Product, Vehicle
+
+UNIT_TO_KG = {
+    "g": 0.001, "gm": 0.001, "gram": 0.001, "grams": 0.001,
+    "kg": 1.0, "kgs": 1.0, "kilogram": 1.0, "kilograms": 1.0,
+    "quintal": 100.0, "quintals": 100.0,
+    "t": 1000.0, "ton": 1000.0, "tons": 1000.0, "tonne": 1000.0, "tonnes": 1000.0, "mt": 1000.0,
+}
+
+
+def to_kg(value: Optional[float], unit: Optional[str]) -> Optional[float]:
+    """Convert a capacity to kg; None when the value is missing or the unit unknown."""
+    if value is None:
+        return None
+    factor = UNIT_TO_KG.get((unit or "kg").strip().lower())
+    if factor is None:
+        return None
+    return float(value) * factor
+
+
+def _weight_stmt(key):
+    return (
+        select(key, func.coalesce(func.sum(NewOrderItem.qty * func.coalesce(Product.weight, 0.0)), 0.0))
+        .select_from(NewOrder)
+        .join(NewOrderItem, NewOrderItem.new_order_id == NewOrder.id)
+        .join(Product, Product.id == NewOrderItem.product_id)
+        .group_by(key)
+    )
+
+
+def order_weights(session: Session, order_ids: Optional[Iterable[int]] = None,
+                  statuses: Iterable[str] = OPEN_ORDER_STATUSES, unassigned_only: bool = True) -> Dict[int, float]:
+    """kg per order for the pending orders (or the given ids) in one aggregate query."""
+    stmt = _weight_stmt(NewOrder.id)
+    if order_ids is not None:
+        stmt = stmt.where(NewOrder.id.in_(list(order_ids)))
+    else:
+        stmt = stmt.where(NewOrder.status.in_(list(statuses)))
+        if unassigned_only:
+            stmt = stmt.where(NewOrder.vehicle_id.is_(None))
+    return {int(oid): float(kg or 0.0) for oid, kg in session.exec(stmt).all()}
+
+
+def vehicle_loads(session: Session, vehicle_ids: Iterable[int], exclude_order_id: Optional[int] = None) -> Dict[int, float]:
+    """kg already on each vehicle from its open orders."""
+    ids = list(vehicle_ids)
+    if not ids:
+        return {}
+    stmt = _weight_stmt(NewOrder.vehicle_id).where(
+        NewOrder.vehicle_id.in_(ids),
+        NewOrder.status.in_(list(OPEN_ORDER_STATUSES)),
+    )
+    if exclude_order_id is not None:
+        stmt = stmt.where(NewOrder.id != exclude_order_id)
+    return {int(vid): float(kg or 0.0) for vid, kg in session.exec(stmt).all()}
+
+
+def first_fit_decreasing(orders: Dict[int, float], free: Dict[int, float]) -> Tuple[Dict[int, List[int]], List[int]]:
+    """
+    Pack orders (id -> kg) into vehicles (id -> free kg).
+    Returns ({vehicle_id: [order ids]}, [order ids that fit nowhere]).
+    """
+    remaining = dict(free)
+    bins = sorted(remaining, key=lambda vid: -remaining[vid])
+    plan: Dict[int, List[int]] = {vid: [] for vid in bins}
+    unplaced: List[int] = []
+    for oid, kg in sorted(orders.items(), key=lambda kv: (-kv[1], kv[0])):
+        for vid in bins:
+            if remaining[vid] >= kg:
+                remaining[vid] -= kg
+                plan[vid].append(oid)
+                break
+        else:
+            unplaced.append(oid)
+    return plan, unplaced
+
+
+def plan_loads(session: Session, vehicle_ids: Optional[List[int]] = None,
+               order_ids: Optional[List[int]] = None) -> dict:
+    """Propose vehicle assignments for pending orders; nothing is written."""
+    v_stmt = select(Vehicle).where(Vehicle.active == True)  # noqa: E712
+    if vehicle_ids:
+        v_stmt = v_stmt.where(Vehicle.id.in_(vehicle_ids))
+    vehicles = session.exec(v_stmt).all()
+
+    capacity: Dict[int, float] = {}
+    skipped = []
+    for v in vehicles:
+        kg = to_kg(v.capacity_weight, v.capacity_unit)
+        if kg is None:
+            reason = "no capacity set" if v.capacity_weight is None else f"unknown capacity unit '{v.capacity_unit}'"
+            skipped.append({"vehicle_id": v.id, "reason": reason})
+        else:
+            capacity[v.id] = kg
+
+    loaded = vehicle_loads(session, capacity.keys())
+    free = {vid: max(0.0, cap - loaded.get(vid, 0.0)) for vid, cap in capacity.items()}
+    weights = order_weights(session, order_ids)
+    plan, unplaced = first_fit_decreasing(weights, free)
+
+    by_id = {v.id: v for v in vehicles}
+    out = []
+    for vid, oids in plan.items():
+        planned = sum(weights[o] for o in oids)
+        out.append({
+            "vehicle_id": vid,
+            "vehicle_number": by_id[vid].vehicle_number,
+            "capacity_kg": round(capacity[vid], 3),
+            "current_load_kg": round(loaded.get(vid, 0.0), 3),
+            "planned_load_kg": round(planned, 3),
+            "utilization": round((loaded.get(vid, 0.0) + planned) / capacity[vid], 4) if capacity[vid] else None,
+            "order_ids": oids,
+        })
+    return {
+        "vehicles": out,
+        "unassigned": [{"order_id": o, "weight_kg": round(weights[o], 3)} for o in unplaced],
+        "skipped_vehicles": skipped,
+        "orders_considered": len(weights),
+    }
@@ -1,6 +1,8 @@
 from fastapi import FastAPI, Depends, HTTPException, status
 from .database import init_db
-from .routers import users, products, vendors, stock, purchases, reports, auth_extra, categories, tags, invoice, orders, chat, purchase_orders, profile, vehicles, vendor_limits, new_orders, products_with_stock, attendance
+from .background import start_periodic
+from . import availability, payment_reconciler, payment_webhooks, phonepe, reservations
+from .routers import users, products, vendors, stock, purchases, reports, auth_extra, categories, tags, invoice, orders, chat, purchase_orders, profile, vehicles, vendor_limits, new_orders, products_with_stock, attendance, events, payments
 from .config import settings
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
@@ -14,11 +16,24 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag", "X-Next-Cursor"],  # readable by browser clients
 )
 
 @app.on_event("startup")
 def on_startup():
     init_db()
+    start_periodic("availability_reconcile", settings.AVAILABILITY_RECONCILE_SECONDS, availability.reconcile_job)
+    start_periodic("reservation_sweep", settings.RESERVATION_SWEEP_SECONDS, reservations.sweep_job)
+    start_periodic("payment_reconcile", settings.PAYMENT_RECONCILE_SECONDS, payment_reconciler.reconcile_job)
+    start_periodic("payment_webhooks", settings.PAYMENT_WEBHOOK_DRAIN_SECONDS, payment_webhooks.drain_job)
+
+@app.on_event("startup")
+async def start_payment_gateway():
+    phonepe.bind_loop()
+
+@app.on_event("shutdown")
+async def stop_payment_gateway():
+    await phonepe.aclose()
 
 app.include_router(users.router)
 app.include_router(products.router)
@@ -42,6 +57,8 @@ app.include_router(vendor_limits.router)
 app.include_router(new_orders.router)
 app.include_router(products_with_stock.router)
 app.include_router(attendance.router)
+app.include_router(events.router)
+app.include_router(payments.router)
 
 
 UPLOAD_DIR = os.path.join(os.getcwd(), "uploads")
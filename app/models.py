@@ -21,7 +21,7 @@ class Message(SQLModel, table=True):
     created_at: datetime = Field(default_factory=datetime.utcnow)
     read: bool = False
 from sqlmodel import SQLModel, Field, Relationship
-from sqlalchemy import Column, Text
+from sqlalchemy import Column, Integer, Text, Index, UniqueConstraint
 
 class Role(str):
     MASTER = "master_admin"
@@ -69,7 +69,7 @@ class Vendor(VendorBase, table=True):
 
 class StockLevel(SQLModel, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
-    product_id: int = Field(foreign_key="product.id")
+    product_id: int = Field(foreign_key="product.id", index=True)
     quantity: int = 0
 
 class StockMovement(SQLModel, table=True):
@@ -84,15 +84,28 @@ class StockMovement(SQLModel, table=True):
 
 
 
+# optimistic-concurrency counters: every ORM UPDATE runs "... WHERE id=? AND version=?"
+# and bumps the value; a concurrent write makes the flush raise StaleDataError.
+_po_version_col = Column("version", Integer, nullable=False, server_default="1")
+_new_order_version_col = Column("version", Integer, nullable=False, server_default="1")
+
 class PurchaseOrder(SQLModel, table=True):
+    __mapper_args__ = {"version_id_col": _po_version_col}
+    # vendor listings page newest-first by (created_at, id) — see pagination.py;
+    # workflow queues filter / count by status
+    __table_args__ = (
+        Index("ix_po_vendor_created", "vendor_id", "created_at"),
+        Index("ix_po_status_created", "status", "created_at"),
+    )
     id: Optional[int] = Field(default=None, primary_key=True)
     # vendor_id now references user.id (vendors are users with role 'vendor')
     vendor_id: int = Field(foreign_key="user.id")
     created_by: int = Field(foreign_key="user.id")
-    status: str = Field(default="placed")  # placed -> accepted -> received -> dispatched -> cancelled
+    status: str = Field(default="placed")  # placed -> accepted -> [partially_received ->] received -> dispatched -> cancelled
     total: float = Field(default=0.0)
     expected_date: Optional[datetime] = None
     created_at: datetime = Field(default_factory=datetime.utcnow)
+    version: int = Field(default=1, sa_column=_po_version_col)
 
 class PurchaseItem(SQLModel, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
@@ -100,14 +113,21 @@ class PurchaseItem(SQLModel, table=True):
     product_id: int = Field(foreign_key="product.id")
     qty: int
     unit_price: float
+    received_qty: int = Field(default=0)  # goods received so far; < qty while the PO is partially received
 
 
 class AuditLog(SQLModel, table=True):
+    # per-entity history is an index range scan: WHERE entity_type=? AND entity_id=? ORDER BY id DESC
+    __table_args__ = (
+        Index("ix_auditlog_entity", "entity_type", "entity_id", "id"),
+    )
     id: Optional[int] = Field(default=None, primary_key=True)
     user_id: Optional[int] = Field(default=None, foreign_key="user.id")
     action: str
     meta: Optional[str] = Field(default=None, sa_column=Column("metadata", Text))
     timestamp: datetime = Field(default_factory=datetime.utcnow)
+    entity_type: Optional[str] = None   # "purchase_order", "new_order", ... (filled from meta, see app/audit.py)
+    entity_id: Optional[int] = None
 
 class Product(SQLModel, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
@@ -176,6 +196,20 @@ class VendorLimit(SQLModel, table=True):
     created_by: Optional[int] = Field(default=None, foreign_key="user.id")
     created_at: datetime = Field(default_factory=datetime.utcnow)
 
+class VendorMonthSpend(SQLModel, table=True):
+    """
+    Month-to-date order value and boxes per vendor (NewOrders + POs, cancelled excluded),
+    kept current by vendor_spend.py in the same transaction as the order write.
+    """
+    __tablename__ = "vendor_month_spend"
+    __table_args__ = (UniqueConstraint("vendor_id", "month", name="uq_vendor_month_spend"),)
+    id: Optional[int] = Field(default=None, primary_key=True)
+    vendor_id: int = Field(foreign_key="user.id")
+    month: str                                  # "YYYY-MM" of the order's created_at (UTC)
+    amount: float = Field(default=0.0)
+    boxes: int = Field(default=0)
+    updated_at: datetime = Field(default_factory=datetime.utcnow)
+
 class PurchaseItemHistory(SQLModel, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
     purchase_item_id: int = Field(foreign_key="purchaseitem.id", index=True)
@@ -255,6 +289,7 @@ class OrderItemHistory(SQLModel, table=True):
 # --- NewOrder tables (explicit table names) ---
 class NewOrder(SQLModel, table=True):
     __tablename__ = "new_order"
+    __mapper_args__ = {"version_id_col": _new_order_version_col}
     id: Optional[int] = Field(default=None, primary_key=True)
     vendor_id: int = Field(foreign_key="user.id", index=True)   # vendor (user with role 'vendor')
     created_at: datetime = Field(default_factory=datetime.utcnow)
@@ -263,6 +298,8 @@ class NewOrder(SQLModel, table=True):
     vehicle_id: Optional[int] = Field(default=None, foreign_key="vehicle.id", index=True)
     notes: Optional[str] = None
     shipping_address: Optional[str] = None
+    delivery_lat: Optional[float] = None   # drop-off coordinates, used for route sequencing
+    delivery_lng: Optional[float] = None
 
     # verification / workflow fields
     verified: bool = Field(default=False)
@@ -272,6 +309,7 @@ class NewOrder(SQLModel, table=True):
     # small convenience: who last modified (optional)
     last_modified_by: Optional[int] = Field(default=None, foreign_key="user.id")
     last_modified_at: Optional[datetime] = None
+    version: int = Field(default=1, sa_column=_new_order_version_col)
 
 class NewOrderItem(SQLModel, table=True):
     __tablename__ = "new_order_item"
@@ -284,6 +322,81 @@ class NewOrderItem(SQLModel, table=True):
     notes: Optional[str] = None
 
 
+class ReservationStatus:
+    ACTIVE = "active"
+    RELEASED = "released"     # order cancelled / line removed
+    EXPIRED = "expired"       # TTL passed, released by the sweeper
+    CONSUMED = "consumed"     # stock taken out at dispatch
+
+class StockReservation(SQLModel, table=True):
+    """
+    Stock held for a placed NewOrder, one row per (order, product).
+    Active rows count against available-to-promise until released, expired or consumed.
+    """
+    __tablename__ = "stock_reservation"
+    __table_args__ = (
+        UniqueConstraint("new_order_id", "product_id", name="uq_reservation_order_product"),
+        Index("ix_reservation_product_status", "product_id", "status"),
+        Index("ix_reservation_status_expires", "status", "expires_at"),
+    )
+    id: Optional[int] = Field(default=None, primary_key=True)
+    new_order_id: int = Field(foreign_key="new_order.id", index=True)
+    product_id: int = Field(foreign_key="product.id")
+    qty: int = Field(default=0)
+    status: str = Field(default=ReservationStatus.ACTIVE)
+    expires_at: Optional[datetime] = None
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+    updated_at: Optional[datetime] = None
+
+
+class AssignmentStatus:
+    ASSIGNED = "assigned"
+    SHIPPED = "shipped"
+    REASSIGNED = "reassigned"   # replaced by a newer assignment for the same PO
+
+class PODriverAssignment(SQLModel, table=True):
+    """Driver assigned to a PurchaseOrder (written by assign-driver, advanced by ship)."""
+    __tablename__ = "po_driver_assignment"
+    __table_args__ = (
+        Index("ix_po_assignment_driver_status", "driver_id", "status"),
+    )
+    id: Optional[int] = Field(default=None, primary_key=True)
+    purchase_order_id: int = Field(foreign_key="purchaseorder.id", index=True)
+    driver_id: int = Field(foreign_key="user.id")
+    assigned_by: Optional[int] = Field(default=None, foreign_key="user.id")
+    status: str = Field(default=AssignmentStatus.ASSIGNED)
+    eta_days: Optional[int] = None
+    notes: Optional[str] = None
+    assigned_at: datetime = Field(default_factory=datetime.utcnow)
+    updated_at: Optional[datetime] = None
+
+
+
+class PaymentState:
+    # PhonePe order states, stored as returned by the gateway
+    PENDING = "PENDING"
+    COMPLETED = "COMPLETED"
+    FAILED = "FAILED"
+    TERMINAL = (COMPLETED, FAILED)
+
+class PaymentAttempt(SQLModel, table=True):
+    """One PhonePe checkout created for a PurchaseOrder (create or regenerate)."""
+    __tablename__ = "payment_attempt"
+    __table_args__ = (
+        Index("ix_payment_attempt_state_created", "state", "created_at"),
+    )
+    id: Optional[int] = Field(default=None, primary_key=True)
+    purchase_order_id: int = Field(foreign_key="purchaseorder.id", index=True)
+    merchant_order_id: str = Field(index=True)
+    amount: int                                  # smallest currency unit (paise)
+    state: str = Field(default=PaymentState.PENDING)
+    gateway_order_id: Optional[str] = None       # PhonePe orderId
+    redirect_url: Optional[str] = None
+    created_by: Optional[int] = Field(default=None, foreign_key="user.id")
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+    updated_at: Optional[datetime] = None
+    last_checked_at: Optional[datetime] = None   # last status poll against the gateway
+
 
 # New Invoice models (explicit table names)
 class NewInvoice(SQLModel, table=True):
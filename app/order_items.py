@@ -0,0 +1,171 @@
+# app/order_items.py
+"""
+Diff-based item replacement for NewOrder and PurchaseOrder edits.
+
+PATCH payloads still carry the full item list, but instead of deleting every row
+and inserting the list again, each line is matched to an existing row by `id`
+(when sent) or else by `product_id`:
+
+    unchanged rows -> left alone (ids and history links survive)
+    changed rows   -> one executemany UPDATE
+    new lines      -> one multi-row INSERT
+    dropped rows   -> one DELETE ... WHERE id IN (...)
+
+The parent's total is then recomputed from the item rows by the database
+(see totals.py). Nothing here commits; the caller owns the transaction.
+"""
+from collections import defaultdict
+from typing import Dict, Iterable, List, Sequence, Tuple
+
+from fastapi import HTTPException
+from sqlalchemy import bindparam, delete, insert, update
+from sqlmodel import Session, select
+
+from . import totals
+from .models import NewOrder, NewOrderItem, Product, PurchaseItem, PurchaseOrder
+
+
+class ItemDiff:
+    def __init__(self, updated: List[dict], inserted: List[dict], deleted: List[int]):
+        self.updated = updated
+        self.inserted = inserted
+        self.deleted = deleted
+
+    @property
+    def changed(self) -> bool:
+        return bool(self.updated or self.inserted or self.deleted)
+
+    def summary(self) -> Dict[str, int]:
+        return {"updated": len(self.updated), "inserted": len(self.inserted), "deleted": len(self.deleted)}
+
+
+def product_prices(session: Session, product_ids: Iterable[int]) -> Dict[int, float]:
+    """Master price per product (one IN query); 400 if any product is unknown."""
+    ids = {int(p) for p in product_ids}
+    if not ids:
+        return {}
+    rows = session.exec(select(Product.id, Product.price).where(Product.id.in_(ids))).all()
+    prices = {pid: float(price or 0.0) for pid, price in rows}
+    missing = sorted(ids - prices.keys())
+    if missing:
+        raise HTTPException(status_code=400, detail=f"Product id {', '.join(str(m) for m in missing)} not found")
+    return prices
+
+
+def _match(existing: Sequence, incoming: Sequence) -> Tuple[List[tuple], List]:
+    """Pair each incoming line with an existing row (or None); return pairs and unmatched rows."""
+    bad_qty = [line.product_id for line in incoming if int(line.qty) <= 0]
+    if bad_qty:
+        raise HTTPException(status_code=400, detail=f"qty must be > 0 (product {', '.join(str(b) for b in bad_qty)})")
+
+    by_id = {row.id: row for row in existing}
+    taken = set()
+    # explicit ids first, so a product_id match cannot claim a row another line names
+    for line in incoming:
+        line_id = getattr(line, "id", None)
+        if line_id is None:
+            continue
+        if line_id not in by_id:
+            raise HTTPException(status_code=400, detail=f"Item {line_id} does not belong to this order")
+        if line_id in taken:
+            raise HTTPException(status_code=400, detail=f"Item {line_id} appears more than once")
+        taken.add(line_id)
+
+    free = defaultdict(list)
+    for row in existing:
+        if row.id not in taken:
+            free[row.product_id].append(row)
+
+    pairs = []
+    for line in incoming:
+        line_id = getattr(line, "id", None)
+        if line_id is not None:
+            row = by_id[line_id]
+        else:
+            candidates = free.get(line.product_id)
+            row = candidates.pop(0) if candidates else None
+            if row is not None:
+                taken.add(row.id)
+        pairs.append((line, row))
+    removed = [row for row in existing if row.id not in taken]
+    return pairs, removed
+
+
+def _write(session: Session, model, diff: ItemDiff):
+    table = model.__table__
+    if diff.deleted:
+        session.execute(delete(table).where(table.c.id.in_(diff.deleted)))
+    if diff.updated:
+        cols = [k for k in diff.updated[0] if k != "id"]
+        session.execute(
+            update(table)
+            .where(table.c.id == bindparam("b_id"))
+            .values({c: bindparam(f"b_{c}") for c in cols}),
+            [{f"b_{k}": v for k, v in row.items()} for row in diff.updated],
+        )
+    if diff.inserted:
+        session.execute(insert(table), diff.inserted)
+
+
+def _changed(row, values: dict) -> bool:
+    return any(getattr(row, k) != v for k, v in values.items())
+
+
+# ---------------- per-kind diffs ----------------
+
+def patch_new_order_items(session: Session, order: NewOrder, incoming: Sequence, prices: Dict[int, float]) -> ItemDiff:
+    """
+    Bring a NewOrder's items in line with `incoming` (NewOrderItemUpdate-like lines).
+    A line keeps its stored unit_price unless it sends one or switches product;
+    `prices` must cover every incoming product_id.
+    """
+    existing = session.exec(select(NewOrderItem).where(NewOrderItem.new_order_id == order.id)).all()
+    pairs, removed = _match(existing, incoming)
+    updated, inserted = [], []
+    for line, row in pairs:
+        qty = int(line.qty)
+        if line.unit_price is not None:
+            unit_price = float(line.unit_price)
+        elif row is not None and row.product_id == line.product_id:
+            unit_price = row.unit_price
+        else:
+            unit_price = prices[line.product_id]
+        values = {"product_id": line.product_id, "qty": qty, "unit_price": unit_price,
+                  "subtotal": unit_price * qty, "notes": line.notes}
+        if row is None:
+            inserted.append({"new_order_id": order.id, **values})
+        elif _changed(row, values):
+            updated.append({"id": row.id, **values})
+
+    diff = ItemDiff(updated, inserted, [row.id for row in removed])
+    _write(session, NewOrderItem, diff)
+    if diff.changed:
+        totals.assign_new_order_total(order)
+    return diff
+
+
+def patch_purchase_items(session: Session, po: PurchaseOrder, incoming: Sequence, prices: Dict[int, float]) -> ItemDiff:
+    """
+    Bring a PurchaseOrder's items in line with `incoming` (PurchaseItemUpdate-like lines).
+    Matched rows keep their unit_price; new lines (or a product switch) take the
+    master price from `prices`.
+    """
+    existing = session.exec(select(PurchaseItem).where(PurchaseItem.purchase_order_id == po.id)).all()
+    pairs, removed = _match(existing, incoming)
+    updated, inserted = [], []
+    for line, row in pairs:
+        if row is not None and row.product_id == line.product_id:
+            unit_price = row.unit_price
+        else:
+            unit_price = prices[line.product_id]
+        values = {"product_id": line.product_id, "qty": int(line.qty), "unit_price": unit_price}
+        if row is None:
+            inserted.append({"purchase_order_id": po.id, **values})
+        elif _changed(row, values):
+            updated.append({"id": row.id, **values})
+
+    diff = ItemDiff(updated, inserted, [row.id for row in removed])
+    _write(session, PurchaseItem, diff)
+    if diff.changed:
+        totals.assign_po_total(po)
+    return diff
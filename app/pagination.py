@@ -0,0 +1,75 @@
+# app/pagination.py
+"""
+Keyset ("seek") pagination for newest-first listings.
+
+    rows, next_cursor = keyset_page(session, stmt, PurchaseOrder, limit, cursor)
+    set_next_cursor(response, next_cursor)
+
+or, for the usual status / created_at filtered listing, both steps at once:
+
+    rows = filtered_page(session, response, stmt, PurchaseOrder, status, date_from, date_to, limit, cursor)
+
+Rows are ordered by (created_at DESC, id DESC) and the cursor is the last row's
+(created_at, id), so a page is WHERE (created_at, id) < cursor ... LIMIT n — an
+index range scan however deep the client pages, unlike OFFSET. The cursor is
+opaque to clients: they pass the X-Next-Cursor response header back as ?cursor=;
+no header means the last page. Response bodies stay plain lists.
+"""
+import base64
+from datetime import datetime
+from typing import List, Optional, Tuple
+
+from fastapi import HTTPException, Response
+from sqlalchemy import and_, or_
+from sqlmodel import Session
+
+HEADER = "X-Next-Cursor"
+
+
+def encode_cursor(created_at: datetime, row_id: int) -> str:
+    raw = f"{created_at.isoformat()}|{row_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        ts, row_id = raw.rsplit("|", 1)
+        return datetime.fromisoformat(ts), int(row_id)
+    except (ValueError, UnicodeDecodeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def keyset_page(session: Session, stmt, model, limit: int, cursor: Optional[str] = None) -> Tuple[List, Optional[str]]:
+    """One page of stmt (a select of model, filters already applied) and the cursor of the next one."""
+    if cursor:
+        ts, row_id = decode_cursor(cursor)
+        stmt = stmt.where(or_(model.created_at < ts, and_(model.created_at == ts, model.id < row_id)))
+    rows = session.exec(stmt.order_by(model.created_at.desc(), model.id.desc()).limit(limit + 1)).all()
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, encode_cursor(rows[-1].created_at, rows[-1].id)
+
+
+def set_next_cursor(response: Response, next_cursor: Optional[str]):
+    if next_cursor:
+        response.headers[HEADER] = next_cursor
+
+
+def filtered_page(session: Session, response: Response, stmt, model, status: Optional[str] = None,
+                  date_from: Optional[datetime] = None, date_to: Optional[datetime] = None,
+                  limit: int = 100, cursor: Optional[str] = None) -> List:
+    """
+    keyset_page with the shared listing filters: model.status in status (comma separated)
+    and model.created_at within [date_from, date_to]. Sets the X-Next-Cursor header.
+    """
+    if status:
+        stmt = stmt.where(model.status.in_([s.strip() for s in status.split(",") if s.strip()]))
+    if date_from is not None:
+        stmt = stmt.where(model.created_at >= date_from)
+    if date_to is not None:
+        stmt = stmt.where(model.created_at <= date_to)
+    rows, next_cursor = keyset_page(session, stmt, model, limit, cursor)
+    set_next_cursor(response, next_cursor)
+    return rows
@@ -0,0 +1,263 @@
+# app/payment_reconciler.py
+"""
+Background reconciliation of pending PhonePe payments.
+
+Every PAYMENT_RECONCILE_SECONDS one worker (see background.start_periodic) walks
+the non-terminal payment attempts in id batches, polls the gateway for each
+(PAYMENT_RECONCILE_CONCURRENCY calls in flight, at most
+PAYMENT_RECONCILE_RATE_PER_SECOND), and applies what changed per batch:
+
+  - attempt state / last_checked_at with one executemany UPDATE,
+  - PO status: the batch's POs are locked (SELECT ... FOR UPDATE, in id order),
+    moved with one executemany UPDATE, one audit insert, then status events.
+
+A COMPLETED attempt marks its PO paid; other outcomes only move the PO when
+they come from its latest attempt, so an expired old link does not fail a PO
+that has a newer one pending. Only POs still waiting for payment are touched.
+
+lag() reports how far behind the gateway we are (oldest unreconciled attempt).
+"""
+import asyncio
+import json
+import logging
+import time
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+import redis
+from sqlalchemy import bindparam, func, insert, or_, update
+from sqlmodel import Session, select
+
+from .config import settings
+from .models import AuditLog, PaymentAttempt, PaymentState, PurchaseOrder
+from .redis_client import redis_client
+from . import audit, events, payments, phonepe
+
+logger = logging.getLogger(__name__)
+
+LAST_RUN_KEY = "payments:reconcile:last"
+
+
+def awaiting_payment(po_status: str) -> bool:
+    return po_status == "pending_payment" or (po_status.startswith("payment_") and po_status != "payment_verified")
+
+
+class _RateLimiter:
+    """Spaces calls at least 1/rate seconds apart (shared by all tasks on one loop)."""
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self._next = 0.0
+        self._lock = asyncio.Lock()
+
+    async def wait(self):
+        if not self.interval:
+            return
+        async with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next)
+            self._next = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+
+def _due_batch(session: Session, after_id: int, now: datetime, limit: int):
+    cutoff = now - timedelta(seconds=settings.PAYMENT_RECONCILE_MIN_AGE_SECONDS)
+    return session.exec(
+        select(PaymentAttempt.id, PaymentAttempt.purchase_order_id, PaymentAttempt.merchant_order_id, PaymentAttempt.state)
+        .where(
+            PaymentAttempt.state.not_in(PaymentState.TERMINAL),
+            PaymentAttempt.id > after_id,
+            PaymentAttempt.created_at <= cutoff,
+            or_(PaymentAttempt.last_checked_at.is_(None), PaymentAttempt.last_checked_at <= cutoff),
+        )
+        .order_by(PaymentAttempt.id)
+        .limit(limit)
+    ).all()
+
+
+async def _poll(rows, sem: asyncio.Semaphore, limiter: _RateLimiter) -> List[Tuple[tuple, Optional[dict]]]:
+    async def one(row):
+        async with sem:
+            await limiter.wait()
+            try:
+                return row, await phonepe.check_status(row[2])
+            except phonepe.GatewayError as e:
+                logger.info("reconcile: status for %s failed: %s", row[2], e)
+                return row, None
+    return await asyncio.gather(*(one(r) for r in rows))
+
+
+def apply_results(session: Session, polled: List[Tuple[tuple, Optional[dict]]], now: datetime,
+                  action: str = "payment_reconcile", user_id: Optional[int] = None) -> Dict[str, int]:
+    """
+    Write one batch of gateway answers and commit. polled holds
+    ((attempt_id, po_id, merchant_order_id, stored_state), response-or-None) pairs;
+    replaying the same answers changes nothing, and an answer never moves an attempt
+    out of a terminal state (a late PENDING callback after COMPLETED). Returns counters.
+    """
+    checked = [(row, resp) for row, resp in polled if resp is not None]
+    stats = {"checked": len(checked), "errors": len(polled) - len(checked), "stale": 0, "state_changes": 0, "po_updates": 0}
+    if not checked:
+        return stats
+
+    # current states, locked: the stored_state in rows may predate a concurrent webhook / poll
+    stored = dict(session.exec(
+        select(PaymentAttempt.id, PaymentAttempt.state)
+        .where(PaymentAttempt.id.in_([row[0] for row, _ in checked]))
+        .order_by(PaymentAttempt.id)
+        .with_for_update()
+    ).all())
+    checked = [
+        ((row[0], row[1], row[2], stored[row[0]]), resp) for row, resp in checked
+        if row[0] in stored and not (stored[row[0]] in PaymentState.TERMINAL and resp.get("state") != stored[row[0]])
+    ]
+    stats["stale"] = stats["checked"] - len(checked)
+    if not checked:
+        session.commit()
+        return stats
+
+    t = PaymentAttempt.__table__
+    session.execute(
+        update(t)
+        .where(t.c.id == bindparam("b_id"))
+        .values(
+            state=bindparam("b_state"),
+            gateway_order_id=func.coalesce(t.c.gateway_order_id, bindparam("b_order_id")),
+            updated_at=func.coalesce(bindparam("b_updated_at"), t.c.updated_at),
+            last_checked_at=now,
+        ),
+        [
+            {"b_id": row[0], "b_state": resp.get("state") or row[3], "b_order_id": resp.get("orderId"),
+             "b_updated_at": now if resp.get("state") and resp["state"] != row[3] else None}
+            for row, resp in checked
+        ],
+    )
+    stats["state_changes"] = sum(1 for row, resp in checked if resp.get("state") and resp["state"] != row[3])
+
+    # --- PO transitions ---
+    # locked until the commit, so a webhook drain / sync endpoint moving the same PO
+    # waits and then sees the new status instead of applying (and auditing) it twice
+    po_ids = {row[1] for row, _ in checked}
+    pos = {pid: (st, vid) for pid, st, vid in session.exec(
+        select(PurchaseOrder.id, PurchaseOrder.status, PurchaseOrder.vendor_id)
+        .where(PurchaseOrder.id.in_(po_ids))
+        .order_by(PurchaseOrder.id)
+        .with_for_update()
+    ).all()}
+    latest = dict(session.exec(
+        select(PaymentAttempt.purchase_order_id, func.max(PaymentAttempt.id))
+        .where(PaymentAttempt.purchase_order_id.in_(po_ids))
+        .group_by(PaymentAttempt.purchase_order_id)
+    ).all())
+
+    moves: Dict[int, Tuple[str, str, str]] = {}  # po_id -> (from, to, merchantOrderId)
+    for row, resp in checked:
+        attempt_id, po_id, moid, _ = row
+        state = resp.get("state")
+        if po_id not in pos or not state:
+            continue
+        current = pos[po_id][0]
+        if not awaiting_payment(current):
+            continue
+        if state != PaymentState.COMPLETED and latest.get(po_id) != attempt_id:
+            continue
+        if po_id in moves and moves[po_id][1] == "paid":
+            continue  # a completed attempt wins over anything else in the batch
+        target = payments.po_status_for(state, current)
+        if target != current:
+            moves[po_id] = (current, target, moid)
+
+    if moves:
+        po_t = PurchaseOrder.__table__
+        session.execute(
+            update(po_t)
+            .where(po_t.c.id == bindparam("b_id"), po_t.c.status == bindparam("b_from"))
+            .values(status=bindparam("b_to"), version=po_t.c.version + 1),
+            [{"b_id": pid, "b_from": frm, "b_to": to} for pid, (frm, to, _) in moves.items()],
+        )
+        session.execute(insert(AuditLog.__table__), [
+            {"user_id": user_id, "action": action, "timestamp": now,
+             "metadata": json.dumps({"po_id": pid, "merchantOrderId": moid, "from": frm, "to": to}),
+             "entity_type": audit.PURCHASE_ORDER, "entity_id": pid}
+            for pid, (frm, to, moid) in moves.items()
+        ])
+    session.commit()
+    events.publish(*[
+        events.status_event("purchase_order", pid, to, from_status=frm, vendor_id=pos[pid][1])
+        for pid, (frm, to, _) in moves.items()
+    ])
+    stats["po_updates"] = len(moves)
+    return stats
+
+
+async def reconcile(session: Session, time_budget: Optional[float] = None) -> Dict[str, object]:
+    """One pass over due attempts, batch by batch, within max-per-run and the time budget."""
+    started = time.monotonic()
+    now = datetime.utcnow()
+    sem = asyncio.Semaphore(max(1, settings.PAYMENT_RECONCILE_CONCURRENCY))
+    limiter = _RateLimiter(settings.PAYMENT_RECONCILE_RATE_PER_SECOND)
+    totals = {"checked": 0, "errors": 0, "stale": 0, "state_changes": 0, "po_updates": 0, "batches": 0}
+    last_id = 0
+    while totals["checked"] + totals["errors"] < settings.PAYMENT_RECONCILE_MAX_PER_RUN:
+        if time_budget is not None and time.monotonic() - started >= time_budget:
+            break
+        if phonepe.BREAKER.snapshot()["state"] == "open":
+            logger.warning("reconcile: gateway circuit open, stopping this run")
+            break
+        rows = _due_batch(session, last_id, now, settings.PAYMENT_RECONCILE_BATCH)
+        if not rows:
+            break
+        last_id = rows[-1][0]
+        polled = await _poll(rows, sem, limiter)
+        for k, v in apply_results(session, polled, datetime.utcnow()).items():
+            totals[k] += v
+        totals["batches"] += 1
+    totals["duration_ms"] = round((time.monotonic() - started) * 1000, 1)
+    totals["finished_at"] = datetime.utcnow().isoformat()
+    return totals
+
+
+def reconcile_job():
+    """start_periodic entry point: own event loop, own DB session, stats to Redis."""
+    from .database import engine
+
+    async def run():
+        try:
+            with Session(engine) as session:
+                # stay inside the interval so the next tick's lock doesn't overlap us
+                return await reconcile(session, time_budget=settings.PAYMENT_RECONCILE_SECONDS * 0.8)
+        finally:
+            await phonepe.aclose()
+
+    stats = asyncio.run(run())
+    try:
+        redis_client.set(LAST_RUN_KEY, json.dumps(stats), ex=max(3600, settings.PAYMENT_RECONCILE_SECONDS * 10))
+    except redis.RedisError:
+        pass
+    if stats["checked"] or stats["errors"]:
+        logger.info("payment reconcile: %s", stats)
+
+
+def lag(session: Session) -> Dict[str, object]:
+    """Backlog of non-terminal attempts and how stale the oldest one is."""
+    now = datetime.utcnow()
+    count, oldest_created, oldest_checked = session.exec(
+        select(
+            func.count(PaymentAttempt.id),
+            func.min(PaymentAttempt.created_at),
+            func.min(func.coalesce(PaymentAttempt.last_checked_at, PaymentAttempt.created_at)),
+        ).where(PaymentAttempt.state.not_in(PaymentState.TERMINAL))
+    ).one()
+    try:
+        raw = redis_client.get(LAST_RUN_KEY)
+        last_run = json.loads(raw) if raw else None
+    except redis.RedisError:
+        last_run = None
+    age = lambda ts: round((now - ts).total_seconds(), 1) if ts else None
+    return {
+        "pending_attempts": count,
+        "oldest_pending_age_seconds": age(oldest_created),
+        "oldest_unreconciled_age_seconds": age(oldest_checked),
+        "last_run": last_run,
+    }
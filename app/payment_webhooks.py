@@ -0,0 +1,157 @@
+# app/payment_webhooks.py
+"""
+PhonePe payment callbacks: verify, queue, apply in batches.
+
+The webhook endpoint only checks the Authorization header (PhonePe sends
+sha256("<username>:<password>") of the callback credentials configured on its
+dashboard), pushes the body onto a Redis list and answers 200. drain_job runs
+every PAYMENT_WEBHOOK_DRAIN_SECONDS on one worker, pops up to
+PAYMENT_WEBHOOK_BATCH callbacks and applies them through
+payment_reconciler.apply_results, the same idempotent bulk path the poller
+uses, so redelivered or duplicate callbacks are harmless.
+
+Malformed callbacks are dropped when parsed. A batch that fails to apply goes
+back to the head of the queue; after PAYMENT_WEBHOOK_MAX_ATTEMPTS failures its
+callbacks move to DEAD_KEY for inspection instead of blocking the queue.
+"""
+import hashlib
+import hmac
+import json
+import logging
+import time
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from sqlmodel import Session, select
+
+from .config import settings
+from .models import PaymentAttempt, PaymentState
+from .redis_client import redis_client
+from . import payment_reconciler
+
+logger = logging.getLogger(__name__)
+
+QUEUE_KEY = "payments:webhooks"
+DEAD_KEY = "payments:webhooks:dead"
+
+# take up to ARGV[1] items off the head of the list in one step
+_POP_LUA = """
+local items = redis.call('LRANGE', KEYS[1], 0, tonumber(ARGV[1]) - 1)
+if #items > 0 then
+    redis.call('LTRIM', KEYS[1], #items, -1)
+end
+return items
+"""
+_pop_script = redis_client.register_script(_POP_LUA)
+
+
+def verify_authorization(header: Optional[str]) -> bool:
+    username, password = settings.PHONEPE_WEBHOOK_USERNAME, settings.PHONEPE_WEBHOOK_PASSWORD
+    if not username or not password or not header:
+        return False
+    expected = hashlib.sha256(f"{username}:{password}".encode()).hexdigest()
+    received = header.strip()
+    if received.lower().startswith("sha256 "):
+        received = received[7:].strip()
+    return hmac.compare_digest(received.lower(), expected)
+
+
+def enqueue(body: dict):
+    """Raises redis.RedisError if the queue is unreachable (caller answers 503 so PhonePe retries)."""
+    redis_client.rpush(QUEUE_KEY, json.dumps({"received_at": time.time(), "body": body}))
+
+
+def _parse(item: str) -> Optional[dict]:
+    """Callback -> {merchant_order_id, state, orderId, amount} or None if it isn't a usable order event."""
+    try:
+        body = json.loads(item)["body"]
+        payload = body.get("payload") or {}
+        moid = payload.get("merchantOrderId")
+        state = payload.get("state")
+        amount = payload.get("amount")
+        if amount is not None:
+            amount = int(amount)  # paise; PhonePe sends a number, a numeric string is tolerated
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return None
+    if not moid or not state or not isinstance(moid, str) or not isinstance(state, str):
+        return None
+    return {"merchant_order_id": moid, "state": state, "orderId": payload.get("orderId"), "amount": amount}
+
+
+def _latest_per_order(callbacks: List[dict]) -> Dict[str, dict]:
+    """One callback per merchantOrderId: the last received, but a terminal state beats PENDING."""
+    picked: Dict[str, dict] = {}
+    for cb in callbacks:
+        prev = picked.get(cb["merchant_order_id"])
+        if prev and prev["state"] in PaymentState.TERMINAL and cb["state"] not in PaymentState.TERMINAL:
+            continue
+        picked[cb["merchant_order_id"]] = cb
+    return picked
+
+
+def apply_callbacks(session: Session, items: List[str]) -> Dict[str, int]:
+    callbacks = [cb for cb in (_parse(i) for i in items) if cb]
+    stats = {"received": len(items), "invalid": len(items) - len(callbacks), "unknown": 0, "amount_mismatch": 0}
+    picked = _latest_per_order(callbacks)
+    if not picked:
+        return stats
+
+    attempts = session.exec(
+        select(PaymentAttempt.id, PaymentAttempt.purchase_order_id, PaymentAttempt.merchant_order_id,
+               PaymentAttempt.state, PaymentAttempt.amount)
+        .where(PaymentAttempt.merchant_order_id.in_(list(picked)))
+        .order_by(PaymentAttempt.id)
+    ).all()
+    by_moid = {a[2]: a for a in attempts}  # a reused merchantOrderId maps to its newest attempt
+    results = []
+    for moid, cb in picked.items():
+        row = by_moid.get(moid)
+        if row is None:
+            stats["unknown"] += 1
+            logger.warning("payment webhook for unknown merchantOrderId %s", moid)
+            continue
+        if cb["amount"] is not None and cb["amount"] != row[4]:
+            stats["amount_mismatch"] += 1
+            logger.error("payment webhook amount %s != attempt %s amount %s for %s", cb["amount"], row[0], row[4], moid)
+            continue
+        results.append((tuple(row[:4]), {"state": cb["state"], "orderId": cb["orderId"]}))
+    if results:
+        stats.update(payment_reconciler.apply_results(session, results, datetime.utcnow(), action="payment_webhook"))
+    return stats
+
+
+def drain_job(max_batches: int = 20):
+    """start_periodic entry point: apply queued callbacks until the queue is empty (or max_batches)."""
+    from .database import engine
+
+    for _ in range(max_batches):
+        items = _pop_script(keys=[QUEUE_KEY], args=[settings.PAYMENT_WEBHOOK_BATCH])
+        if not items:
+            return
+        try:
+            with Session(engine) as session:
+                stats = apply_callbacks(session, items)
+        except Exception:
+            _requeue(items)
+            raise
+        logger.info("payment webhooks applied: %s", stats)
+
+
+def _requeue(items: List[str]):
+    """Put a failed batch back in front for the next tick (apply is idempotent), or dead-letter it."""
+    retry, dead = [], []
+    for item in items:
+        try:
+            entry = json.loads(item)
+            entry["attempts"] = int(entry.get("attempts", 0)) + 1
+        except (ValueError, TypeError, AttributeError):
+            dead.append(item)
+            continue
+        (dead if entry["attempts"] >= settings.PAYMENT_WEBHOOK_MAX_ATTEMPTS else retry).append(json.dumps(entry))
+    pipe = redis_client.pipeline(transaction=False)
+    if retry:
+        pipe.lpush(QUEUE_KEY, *reversed(retry))
+    if dead:
+        pipe.rpush(DEAD_KEY, *dead)
+        logger.error("payment webhooks: %d callback(s) moved to %s after repeated failures", len(dead), DEAD_KEY)
+    pipe.execute()
@@ -0,0 +1,164 @@
+# app/payments.py
+"""
+PhonePe payment attempts for PurchaseOrders (payment_attempt).
+
+Creating or regenerating a checkout records one PaymentAttempt; status syncs
+look the attempt up by PO (latest first) or by merchantOrderId. Gateway answers
+(manual sync, webhook, reconciler) are all applied by
+payment_reconciler.apply_results.
+
+Attempts created before this table existed only live in create_payment /
+create_payment_regen audit rows; backfill them once:
+
+    python -m app.payments
+
+Functions here only stage changes on the session; the caller commits.
+"""
+import json
+import logging
+import os
+import re
+from typing import Dict, List, Optional
+
+from sqlalchemy import insert
+from sqlmodel import Session, select
+
+from .models import AuditLog, PaymentAttempt, PaymentState, PurchaseOrder
+
+logger = logging.getLogger(__name__)
+
+# multiplier (e.g. to convert rupee->paise)
+AMOUNT_MULTIPLIER = int(os.getenv("PAYMENT_AMOUNT_MULTIPLIER", "100"))
+
+# gateway state -> PurchaseOrder.status; anything else becomes payment_<state>
+PO_STATUS_BY_STATE = {
+    PaymentState.COMPLETED: "paid",
+    PaymentState.FAILED: "payment_failed",
+    PaymentState.PENDING: "pending_payment",
+}
+
+
+def po_status_for(state: Optional[str], current: str) -> str:
+    if not state:
+        return current
+    return PO_STATUS_BY_STATE.get(state, f"payment_{str(state).lower()}")
+
+
+def record_attempt(session: Session, po_id: int, merchant_order_id: str, amount: int,
+                   pay_resp: dict, user_id: Optional[int] = None) -> PaymentAttempt:
+    attempt = PaymentAttempt(
+        purchase_order_id=po_id,
+        merchant_order_id=merchant_order_id,
+        amount=amount,
+        state=pay_resp.get("state") or PaymentState.PENDING,
+        gateway_order_id=pay_resp.get("orderId"),
+        redirect_url=pay_resp.get("redirectUrl"),
+        created_by=user_id,
+    )
+    session.add(attempt)
+    return attempt
+
+
+def latest_attempt(session: Session, po_id: int, merchant_order_id: Optional[str] = None) -> Optional[PaymentAttempt]:
+    """Newest attempt for a PO, optionally restricted to one merchantOrderId."""
+    stmt = select(PaymentAttempt).where(PaymentAttempt.purchase_order_id == po_id)
+    if merchant_order_id:
+        stmt = stmt.where(PaymentAttempt.merchant_order_id == merchant_order_id)
+    return session.exec(stmt.order_by(PaymentAttempt.id.desc()).limit(1)).first()
+
+
+# ---------------- one-off backfill ----------------
+
+_PO_IN_MERCHANT_ID = re.compile(r"^PO(\d+)-")
+
+
+def _audit_rows(session: Session, actions, batch_size: int):
+    last_id = 0
+    while True:
+        rows = session.exec(
+            select(AuditLog)
+            .where(AuditLog.action.in_(actions), AuditLog.id > last_id)
+            .order_by(AuditLog.id)
+            .limit(batch_size)
+        ).all()
+        if not rows:
+            return
+        last_id = rows[-1].id
+        for r in rows:
+            try:
+                meta = json.loads(r.meta) if r.meta else None
+            except ValueError:
+                meta = None
+            if isinstance(meta, dict):
+                yield r, meta
+
+
+def backfill_from_audit(session: Session, batch_size: int = 1000) -> int:
+    """
+    Build attempts from create_payment / create_payment_regen audit rows whose
+    merchantOrderId is not in the table yet. The PO comes from the sync audit rows
+    (which carry po_id) or the generated "PO<id>-<ts>" id; the state is the last
+    synced gateway state, else the create response's. Returns rows inserted.
+    """
+    known = set(session.exec(select(PaymentAttempt.merchant_order_id).distinct()).all())
+
+    # what the status syncs learned: merchantOrderId -> (po_id, last state)
+    synced: Dict[str, tuple] = {}
+    for _, meta in _audit_rows(session, ("payment_status_sync", "sync_payment_status"), batch_size):
+        moid = meta.get("merchantOrderId")
+        if moid and meta.get("po_id") is not None:
+            synced[moid] = (int(meta["po_id"]), meta.get("gateway_state"))
+
+    pending: List[dict] = []
+    for r, meta in _audit_rows(session, ("create_payment", "create_payment_regen"), batch_size):
+        resp = meta.get("phonepe_response") if isinstance(meta.get("phonepe_response"), dict) else {}
+        moid = meta.get("merchantOrderId") or resp.get("merchantOrderId")
+        if not moid or moid in known:
+            continue
+        po_id = meta.get("po_id") or synced.get(moid, (None,))[0]
+        if po_id is None:
+            m = _PO_IN_MERCHANT_ID.match(moid)
+            po_id = m.group(1) if m else None
+        if po_id is None:
+            logger.warning("skipping payment audit row %s: no PO for %s", r.id, moid)
+            continue
+        known.add(moid)
+        pending.append({
+            "purchase_order_id": int(po_id),
+            "merchant_order_id": moid,
+            "state": (synced.get(moid) or (None, None))[1] or resp.get("state") or PaymentState.PENDING,
+            "gateway_order_id": resp.get("orderId"),
+            "redirect_url": resp.get("redirectUrl"),
+            "created_by": r.user_id,
+            "created_at": r.timestamp,
+        })
+    if not pending:
+        return 0
+
+    totals = dict(session.exec(
+        select(PurchaseOrder.id, PurchaseOrder.total)
+        .where(PurchaseOrder.id.in_({p["purchase_order_id"] for p in pending}))
+    ).all())
+    values = []
+    for p in pending:
+        if p["purchase_order_id"] not in totals:
+            continue  # PO deleted since
+        # the create request's amount was never stored; it was derived from the PO total
+        p["amount"] = int(round((totals[p["purchase_order_id"]] or 0.0) * AMOUNT_MULTIPLIER))
+        p["updated_at"] = None
+        p["last_checked_at"] = None
+        values.append(p)
+    if values:
+        session.execute(insert(PaymentAttempt.__table__), values)
+    return len(values)
+
+
+if __name__ == "__main__":
+    from .database import engine, init_db
+
+    logging.basicConfig(level=logging.INFO)
+    init_db()
+    with Session(engine) as s:
+        n = backfill_from_audit(s)
+        s.commit()
+    print(f"backfilled {n} payment attempt row(s)")
@@ -0,0 +1,481 @@
+# app/phonepe.py
+"""
+PhonePe checkout gateway client.
+
+All calls are async and go through one pooled httpx.AsyncClient per event loop
+(keep-alive connections are reused across requests). Each call:
+
+  - fails fast with CircuitOpenError while the circuit breaker is open
+    (PHONEPE_BREAKER_FAILURES consecutive failed calls open it for
+    PHONEPE_BREAKER_RESET_SECONDS, then a single probe call decides),
+  - retries timeouts, connection errors, 5xx and 429 up to PHONEPE_MAX_RETRIES
+    times with full-jitter exponential backoff (a 401 refreshes the token once),
+  - records latency / outcome in METRICS (see snapshot() / prometheus_text()).
+
+The OAuth token is shared by all workers through Redis and refreshed ahead of
+expiry by whichever worker takes a short lock (see _shared_token).
+
+Errors surface as GatewayError; routers turn them into HTTP responses.
+Sync code running in a request worker thread calls run_sync(create_payment, ...)
+to use the app loop's pool.
+"""
+import asyncio
+import functools
+import json
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+import weakref
+from typing import Any, Dict, Optional
+
+import httpx
+import redis
+import redis.asyncio
+
+from .config import settings
+from .redis_client import async_redis_client
+
+logger = logging.getLogger(__name__)
+
+PHONEPE_CLIENT_ID = os.getenv("PHONEPE_CLIENT_ID", "TEST-M23AZS78T1O0V_25091")
+PHONEPE_CLIENT_SECRET = os.getenv("PHONEPE_CLIENT_SECRET", "YmQyNzFiM2MtYWE0ZS00NjNkLWFlNWItMGFjMTE5OGYzMjYz")
+# PHONEPE_BASE_URL moves all three at once (e.g. to benchmarks/fake_phonepe.py for load tests)
+PHONEPE_BASE_URL = os.getenv("PHONEPE_BASE_URL", "https://api-preprod.phonepe.com/apis/pg-sandbox").rstrip("/")
+PHONEPE_OAUTH_URL = os.getenv("PHONEPE_OAUTH_URL", f"{PHONEPE_BASE_URL}/v1/oauth/token")
+PHONEPE_PAY_URL = os.getenv("PHONEPE_PAY_URL", f"{PHONEPE_BASE_URL}/checkout/v2/pay")
+PHONEPE_STATUS_BASE = os.getenv("PHONEPE_STATUS_BASE", f"{PHONEPE_BASE_URL}/checkout/v2/order")
+
+BACKOFF_BASE_SECONDS = 0.2
+BACKOFF_CAP_SECONDS = 2.0
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class GatewayError(Exception):
+    def __init__(self, message: str, http_status: int = 502):
+        super().__init__(message)
+        self.http_status = http_status
+
+
+class CircuitOpenError(GatewayError):
+    def __init__(self, retry_after: float):
+        super().__init__("Payment gateway temporarily unavailable", http_status=503)
+        self.retry_after = retry_after
+
+
+# ---------------- metrics ----------------
+
+class GatewayMetrics:
+    """Per-process counters and latency histograms, keyed by operation (token / pay / status)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ops: Dict[str, Dict[str, Any]] = {}
+
+    def _op(self, op: str) -> Dict[str, Any]:
+        if op not in self._ops:
+            self._ops[op] = {"calls": 0, "errors": {}, "retries": 0, "latency_sum": 0.0,
+                             "latency_buckets": [0] * (len(LATENCY_BUCKETS) + 1)}
+        return self._ops[op]
+
+    def observe(self, op: str, seconds: float, error: Optional[str] = None):
+        with self._lock:
+            m = self._op(op)
+            m["calls"] += 1
+            m["latency_sum"] += seconds
+            idx = next((i for i, b in enumerate(LATENCY_BUCKETS) if seconds <= b), len(LATENCY_BUCKETS))
+            m["latency_buckets"][idx] += 1
+            if error:
+                m["errors"][error] = m["errors"].get(error, 0) + 1
+
+    def retried(self, op: str):
+        with self._lock:
+            self._op(op)["retries"] += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            ops = {}
+            for op, m in self._ops.items():
+                cumulative, total = [], 0
+                for bound, n in zip(LATENCY_BUCKETS + ("+Inf",), m["latency_buckets"]):
+                    total += n
+                    cumulative.append({"le": bound, "count": total})
+                ops[op] = {
+                    "calls": m["calls"],
+                    "errors": dict(m["errors"]),
+                    "retries": m["retries"],
+                    "latency_sum_seconds": round(m["latency_sum"], 6),
+                    "latency_avg_ms": round(1000 * m["latency_sum"] / m["calls"], 2) if m["calls"] else None,
+                    "latency_buckets": cumulative,
+                }
+        return {"operations": ops, "breaker": BREAKER.snapshot()}
+
+    def prometheus_text(self) -> str:
+        snap = self.snapshot()
+        ops = snap["operations"]
+        lines = ["# TYPE phonepe_calls_total counter"]
+        lines += [f'phonepe_calls_total{{op="{op}"}} {m["calls"]}' for op, m in ops.items()]
+        lines.append("# TYPE phonepe_errors_total counter")
+        lines += [f'phonepe_errors_total{{op="{op}",kind="{kind}"}} {n}'
+                  for op, m in ops.items() for kind, n in m["errors"].items()]
+        lines.append("# TYPE phonepe_retries_total counter")
+        lines += [f'phonepe_retries_total{{op="{op}"}} {m["retries"]}' for op, m in ops.items()]
+        lines.append("# TYPE phonepe_call_seconds histogram")
+        for op, m in ops.items():
+            lines += [f'phonepe_call_seconds_bucket{{op="{op}",le="{b["le"]}"}} {b["count"]}' for b in m["latency_buckets"]]
+            lines.append(f'phonepe_call_seconds_sum{{op="{op}"}} {m["latency_sum_seconds"]}')
+            lines.append(f'phonepe_call_seconds_count{{op="{op}"}} {m["calls"]}')
+        br = snap["breaker"]
+        lines += [
+            "# TYPE phonepe_breaker_open gauge",
+            f"phonepe_breaker_open {0 if br['state'] == 'closed' else 1}",
+            "# TYPE phonepe_breaker_opened_total counter",
+            f"phonepe_breaker_opened_total {br['opened_total']}",
+        ]
+        return "\n".join(lines) + "\n"
+
+
+# ---------------- circuit breaker ----------------
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold: int, reset_seconds: float):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._probing = False
+        self._opened_total = 0
+
+    def before_call(self) -> bool:
+        """
+        Raise CircuitOpenError unless a call may go out (closed, or the single half-open probe).
+        Returns True when the admitted call is the probe.
+        """
+        with self._lock:
+            if self._opened_at is None:
+                return False
+            waited = time.monotonic() - self._opened_at
+            if waited < self.reset_seconds or self._probing:
+                raise CircuitOpenError(retry_after=max(0.0, self.reset_seconds - waited))
+            self._probing = True
+            return True
+
+    def abandon_probe(self, failed: bool):
+        """
+        The probe ended without reporting (cancelled, or an unexpected error). Free the slot
+        so the next call can probe, or count it as a failure; no-op once a result was recorded.
+        """
+        with self._lock:
+            if not self._probing:
+                return
+            if not failed:
+                self._probing = False
+                return
+        self.record_failure()
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._probing or self._failures >= self.failure_threshold:
+                if self._opened_at is None or self._probing:
+                    self._opened_total += 1
+                self._opened_at = time.monotonic()
+                self._probing = False
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            if self._opened_at is None:
+                state = "closed"
+            elif self._probing or time.monotonic() - self._opened_at >= self.reset_seconds:
+                state = "half_open"
+            else:
+                state = "open"
+            return {"state": state, "consecutive_failures": self._failures, "opened_total": self._opened_total}
+
+
+METRICS = GatewayMetrics()
+BREAKER = CircuitBreaker(settings.PHONEPE_BREAKER_FAILURES, settings.PHONEPE_BREAKER_RESET_SECONDS)
+
+
+# ---------------- connection pool ----------------
+
+# one client per event loop: httpx (and asyncio redis) connections belong to the loop that opened them
+_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, httpx.AsyncClient]" = weakref.WeakKeyDictionary()
+_redis_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, redis.asyncio.Redis]" = weakref.WeakKeyDictionary()
+_app_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+def _client() -> httpx.AsyncClient:
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None or client.is_closed:
+        client = httpx.AsyncClient(
+            timeout=settings.PHONEPE_TIMEOUT_SECONDS,
+            limits=httpx.Limits(max_connections=settings.PHONEPE_POOL_SIZE,
+                                max_keepalive_connections=settings.PHONEPE_POOL_SIZE),
+        )
+        _clients[loop] = client
+    return client
+
+
+def _redis() -> redis.asyncio.Redis:
+    """The shared async redis client on the app loop; a private one (same settings) on any other."""
+    loop = asyncio.get_running_loop()
+    if loop is _app_loop:
+        return async_redis_client
+    client = _redis_clients.get(loop)
+    if client is None:
+        pool = async_redis_client.connection_pool
+        client = redis.asyncio.Redis(
+            connection_pool=redis.asyncio.ConnectionPool(connection_class=pool.connection_class, **pool.connection_kwargs)
+        )
+        _redis_clients[loop] = client
+    return client
+
+
+def bind_loop():
+    """Call from the app's startup (inside the event loop) so run_sync can reach its pool."""
+    global _app_loop
+    _app_loop = asyncio.get_running_loop()
+
+
+async def aclose():
+    """Close the current loop's pools (app shutdown, end of a standalone run)."""
+    loop = asyncio.get_running_loop()
+    client = _clients.pop(loop, None)
+    if client is not None:
+        await client.aclose()
+    redis_conn = _redis_clients.pop(loop, None)
+    if redis_conn is not None:
+        await redis_conn.aclose()
+
+
+def run_sync(fn, *args, **kwargs):
+    """Run a coroutine function from sync code: on the app loop if bound, else on a throwaway loop."""
+    coro_fn = functools.partial(fn, *args, **kwargs)
+    if _app_loop is not None and _app_loop.is_running():
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is not _app_loop:
+            return asyncio.run_coroutine_threadsafe(coro_fn(), _app_loop).result()
+
+    async def standalone():
+        try:
+            return await coro_fn()
+        finally:
+            await aclose()
+
+    return asyncio.run(standalone())
+
+
+# ---------------- calls ----------------
+
+def _backoff(attempt: int) -> float:
+    return random.uniform(0, min(BACKOFF_CAP_SECONDS, BACKOFF_BASE_SECONDS * (2 ** attempt)))
+
+
+async def _request(op: str, method: str, url: str, authorized: bool = True, gated: bool = True, **kwargs) -> dict:
+    """
+    One logical gateway call with retries. gated=False skips the breaker check
+    (token fetches made inside an already admitted call) but still reports to it.
+    """
+    probe = BREAKER.before_call() if gated else False
+    try:
+        return await _send(op, method, url, authorized, **kwargs)
+    except asyncio.CancelledError:
+        if probe:
+            BREAKER.abandon_probe(failed=False)
+        raise
+    except BaseException:
+        if probe:
+            BREAKER.abandon_probe(failed=True)
+        raise
+
+
+async def _send(op: str, method: str, url: str, authorized: bool, **kwargs) -> dict:
+    started = time.perf_counter()
+    refreshed = False
+    attempt = 0
+    while True:
+        token = await get_token() if authorized else None
+        headers = {"Authorization": f"O-Bearer {token}"} if authorized else {}
+        try:
+            resp = await _client().request(method, url, headers=headers, **kwargs)
+        except httpx.TimeoutException as e:
+            error, detail = "timeout", f"{op} timed out: {e!r}"
+        except httpx.TransportError as e:
+            error, detail = "transport", f"{op} connection failed: {e!r}"
+        else:
+            if resp.status_code < 400:
+                try:
+                    body = resp.json()
+                except ValueError:
+                    BREAKER.record_failure()
+                    METRICS.observe(op, time.perf_counter() - started, "bad_response")
+                    raise GatewayError(f"{op} returned a non-JSON response")
+                BREAKER.record_success()
+                METRICS.observe(op, time.perf_counter() - started)
+                return body
+            if resp.status_code == 401 and authorized and not refreshed:
+                refreshed = True
+                await invalidate_token(token)
+                continue
+            error, detail = f"http_{resp.status_code}", f"{op} failed: HTTP {resp.status_code} {resp.text[:200]}"
+            if resp.status_code not in RETRY_STATUSES:
+                # the gateway answered; a rejected request is not an outage
+                BREAKER.record_success()
+                METRICS.observe(op, time.perf_counter() - started, error)
+                raise GatewayError(detail)
+        if attempt >= settings.PHONEPE_MAX_RETRIES:
+            BREAKER.record_failure()
+            METRICS.observe(op, time.perf_counter() - started, error)
+            raise GatewayError(detail)
+        METRICS.retried(op)
+        await asyncio.sleep(_backoff(attempt))
+        attempt += 1
+
+
+# ---------------- OAuth token (shared by all workers through Redis) ----------------
+
+TOKEN_KEY = "phonepe:token"
+TOKEN_LOCK_KEY = "phonepe:token:lock"
+
+# delete the lock only if we still own it
+_RELEASE_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+# this worker's copy of the shared token, so most calls never touch Redis
+_token_cache = {"token": None, "expires_at": 0, "refresh_at": 0}
+
+
+def _usable(entry: Optional[dict], now: float) -> bool:
+    return bool(entry and entry.get("token") and entry.get("expires_at", 0) > now + 5)
+
+
+def _fresh(entry: Optional[dict], now: float) -> bool:
+    """Usable and not yet due for the proactive refresh."""
+    return _usable(entry, now) and now < entry.get("refresh_at", 0)
+
+
+async def _read_shared() -> Optional[dict]:
+    raw = await _redis().get(TOKEN_KEY)
+    return json.loads(raw) if raw else None
+
+
+async def _fetch_token() -> dict:
+    data = {
+        "client_id": PHONEPE_CLIENT_ID,
+        "client_version": "1",
+        "client_secret": PHONEPE_CLIENT_SECRET,
+        "grant_type": "client_credentials",
+    }
+    j = await _request("token", "POST", PHONEPE_OAUTH_URL, authorized=False, gated=False, data=data)
+    expires_in = int(j.get("expires_in", 3600))
+    now = int(time.time())
+    # short-lived tokens refresh at half-life rather than on every call
+    margin = min(settings.PHONEPE_TOKEN_REFRESH_MARGIN_SECONDS, expires_in // 2)
+    return {"token": j.get("access_token"), "expires_at": now + expires_in, "refresh_at": now + expires_in - margin}
+
+
+async def _refresh_locked(lock_token: str) -> dict:
+    """Fetch a new token while holding the refresh lock and publish it to every worker."""
+    try:
+        # the previous holder may have published between our GET and SET
+        entry = await _read_shared()
+        if _fresh(entry, time.time()):
+            return entry
+        entry = await _fetch_token()
+        ttl = max(1, entry["expires_at"] - int(time.time()))
+        await _redis().set(TOKEN_KEY, json.dumps(entry), ex=ttl)
+        return entry
+    finally:
+        try:
+            await _redis().eval(_RELEASE_LUA, 1, TOKEN_LOCK_KEY, lock_token)
+        except redis.RedisError:
+            pass  # lock expires on its own
+
+
+async def _shared_token() -> dict:
+    """
+    Token from Redis. Within PHONEPE_TOKEN_REFRESH_MARGIN_SECONDS of expiry one
+    worker (holder of the lock) refreshes while the rest keep using the still-valid
+    token; once expired, the others wait up to PHONEPE_TOKEN_WAIT_SECONDS for it.
+    """
+    deadline = time.monotonic() + settings.PHONEPE_TOKEN_WAIT_SECONDS
+    while True:
+        now = time.time()
+        entry = await _read_shared()
+        if _fresh(entry, now):
+            return entry
+        lock_token = uuid.uuid4().hex
+        if await _redis().set(TOKEN_LOCK_KEY, lock_token, nx=True, ex=settings.PHONEPE_TOKEN_LOCK_SECONDS):
+            return await _refresh_locked(lock_token)
+        if _usable(entry, now):
+            return entry  # someone else is refreshing; ours is still good
+        if time.monotonic() >= deadline:
+            # the refresher is stuck or gone; don't block payments on it
+            logger.warning("timed out waiting for shared PhonePe token refresh, fetching directly")
+            return await _fetch_token()
+        await asyncio.sleep(0.1)
+
+
+async def get_token() -> str:
+    now = time.time()
+    if _fresh(_token_cache, now):
+        return _token_cache["token"]
+    try:
+        entry = await _shared_token()
+    except redis.RedisError:
+        logger.warning("redis unavailable, using a worker-local PhonePe token")
+        entry = _token_cache if _usable(_token_cache, now) else await _fetch_token()
+    _token_cache.update(entry)
+    return entry["token"]
+
+
+async def invalidate_token(rejected: str):
+    """Drop a token the gateway answered 401 to (only if nobody has replaced it already)."""
+    if _token_cache.get("token") == rejected:
+        _token_cache.update(token=None, expires_at=0, refresh_at=0)
+    try:
+        entry = await _read_shared()
+        if entry and entry.get("token") == rejected:
+            await _redis().delete(TOKEN_KEY)
+    except redis.RedisError:
+        pass
+
+
+async def create_payment(merchant_order_id: str, amount: int, meta: dict, redirect_url: str) -> dict:
+    """Create a checkout order; amount is in the smallest currency unit (paise)."""
+    payload = {
+        "merchantOrderId": merchant_order_id,
+        "amount": amount,
+        "expireAfter": 1200,
+        "metaInfo": meta or {},
+        "paymentFlow": {
+            "type": "PG_CHECKOUT",
+            "message": "Payment message",
+            "merchantUrls": {"redirectUrl": redirect_url},
+        },
+    }
+    # safe to retry: the gateway dedupes on merchantOrderId
+    return await _request("pay", "POST", PHONEPE_PAY_URL, json=payload)
+
+
+async def check_status(merchant_order_id: str) -> dict:
+    return await _request("status", "GET", f"{PHONEPE_STATUS_BASE}/{merchant_order_id}/status")
@@ -0,0 +1,139 @@
+# app/receiving.py
+"""
+Goods receipt (GRN) for purchase orders.
+
+receive() books a receipt with a fixed number of statements whatever the line
+count: one SELECT for the existing StockLevel rows, a bulk INSERT for products
+without one, one executemany UPDATE (by id) for the rest, bulk StockMovement and
+StockBatch inserts, and the PurchaseItem.received_qty updates (batched by the
+flush). Nothing is committed here; the caller commits once together with the
+PO status change and its audit row.
+
+A receipt may cover part of the PO: received_qty accumulates per line until it
+reaches the ordered qty, and the PO stays 'partially_received' until every line does.
+"""
+from collections import defaultdict
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from fastapi import HTTPException
+from sqlalchemy import bindparam, func, insert, update
+from sqlmodel import Session, select
+
+from .models import PurchaseItem, PurchaseOrder, StockBatch, StockLevel, StockMovement
+from .schemas import PurchaseReceiveLine
+
+PARTIALLY_RECEIVED = "partially_received"
+RECEIVED = "received"
+RECEIVABLE_STATUSES = ("accepted", PARTIALLY_RECEIVED)
+
+
+def outstanding(item: PurchaseItem) -> int:
+    return max(0, int(item.qty) - int(item.received_qty or 0))
+
+
+def add_stock(session: Session, qty_by_product: Dict[int, int]):
+    """
+    StockLevel.quantity += qty per product; missing levels are inserted with the qty.
+    A product with several StockLevel rows gets the qty on its lowest-id row only
+    (availability sums them, so adding to each would count the receipt N times).
+    """
+    if not qty_by_product:
+        return
+    level_ids = dict(session.exec(
+        select(StockLevel.product_id, func.min(StockLevel.id))
+        .where(StockLevel.product_id.in_(list(qty_by_product)))
+        .group_by(StockLevel.product_id)
+    ).all())
+    sl = StockLevel.__table__
+    missing = [pid for pid in qty_by_product if pid not in level_ids]
+    if missing:
+        session.execute(insert(sl), [{"product_id": pid, "quantity": qty_by_product[pid]} for pid in missing])
+    if level_ids:
+        session.execute(
+            update(sl)
+            .where(sl.c.id == bindparam("b_id"))
+            .values(quantity=sl.c.quantity + bindparam("b_qty")),
+            [{"b_id": level_id, "b_qty": qty_by_product[pid]} for pid, level_id in level_ids.items()],
+        )
+
+
+def _allocate(items: List[PurchaseItem], lines: Optional[List[PurchaseReceiveLine]]
+              ) -> List[Tuple[PurchaseItem, int, Optional[PurchaseReceiveLine]]]:
+    """Match receipt lines to PO items -> (item, qty, line). No lines: everything outstanding."""
+    if lines is None:
+        return [(it, outstanding(it), None) for it in items if outstanding(it) > 0]
+
+    by_id = {it.id: it for it in items}
+    left = {it.id: outstanding(it) for it in items}
+    picked = []
+    for n, line in enumerate(lines, start=1):
+        if line.qty <= 0:
+            raise HTTPException(status_code=400, detail=f"Line {n}: qty must be positive")
+        if line.item_id is not None:
+            it = by_id.get(line.item_id)
+            if it is None or (line.product_id is not None and line.product_id != it.product_id):
+                raise HTTPException(status_code=400, detail=f"Line {n}: item {line.item_id} is not on this PO")
+            candidates = [it]
+        elif line.product_id is not None:
+            candidates = [it for it in items if it.product_id == line.product_id]
+            if not candidates:
+                raise HTTPException(status_code=400, detail=f"Line {n}: product {line.product_id} is not on this PO")
+        else:
+            raise HTTPException(status_code=400, detail=f"Line {n}: item_id or product_id is required")
+
+        # a product ordered on several lines fills them in order
+        qty = line.qty
+        if qty > sum(left[it.id] for it in candidates):
+            raise HTTPException(status_code=400, detail=f"Line {n}: qty {qty} exceeds the outstanding quantity")
+        for it in candidates:
+            take = min(qty, left[it.id])
+            if take:
+                picked.append((it, take, line))
+                left[it.id] -= take
+                qty -= take
+    return picked
+
+
+def receive(session: Session, po: PurchaseOrder, items: List[PurchaseItem],
+            lines: Optional[List[PurchaseReceiveLine]], user_id: Optional[int],
+            notes: Optional[str] = None) -> Dict[str, object]:
+    """
+    Stage a receipt against po (status must be receivable) and set po.status.
+    Returns {"qty_by_product", "batches"} for the response / availability refresh.
+    """
+    picked = _allocate(items, lines)
+    if not picked:
+        raise HTTPException(status_code=400, detail="Nothing left to receive on this PO")
+
+    now = datetime.utcnow()
+    qty_by_product: Dict[int, int] = defaultdict(int)
+    for it, qty, _ in picked:
+        qty_by_product[it.product_id] += qty
+        it.received_qty = int(it.received_qty or 0) + qty
+        session.add(it)
+    add_stock(session, qty_by_product)
+
+    session.execute(insert(StockMovement.__table__), [
+        {"product_id": it.product_id, "qty": qty, "type": "IN", "ref": f"PO#{po.id}", "performed_by": user_id,
+         "timestamp": now, "notes": f"batch {line.batch_no}" if line and line.batch_no else notes}
+        for it, qty, line in picked
+    ])
+
+    # one batch per receipt line that carries batch data (a line split across items is still one batch)
+    batches: Dict[int, dict] = {}
+    for it, qty, line in picked:
+        if line is None or not (line.batch_no or line.expire_date):
+            continue
+        b = batches.setdefault(id(line), {
+            "product_id": it.product_id, "batch_no": line.batch_no, "quantity": 0, "unit": line.unit or "pcs",
+            "expire_date": line.expire_date, "added_at": now, "created_by": user_id,
+            "notes": notes or f"PO#{po.id}", "active": True,
+        })
+        b["quantity"] += qty
+    if batches:
+        session.execute(insert(StockBatch.__table__), list(batches.values()))
+
+    po.status = RECEIVED if all(outstanding(it) == 0 for it in items) else PARTIALLY_RECEIVED
+    session.add(po)
+    return {"qty_by_product": dict(qty_by_product), "batches": len(batches)}
@@ -1,12 +1,15 @@
 import redis
+import redis.asyncio
 import os
 
 
 
-# Prefer REDIS_URL from env, else use your Redis Cloud credentials
+# Prefer REDIS_URL from env, else use your Redis Cloud credentials.
+# async_redis_client is for long-lived async consumers (the SSE event feed) that must not hold a threadpool thread.
 REDIS_URL = os.getenv("REDIS_URL")
 if REDIS_URL:
 	redis_client = redis.Redis.from_url(REDIS_URL, decode_responses=True)
+	async_redis_client = redis.asyncio.Redis.from_url(REDIS_URL, decode_responses=True)
 else:
 	redis_client = redis.Redis(
 		host='redis-12749.crce206.ap-south-1-1.ec2.redns.redis-cloud.com',
@@ -15,6 +18,13 @@ else:
 		username="default",
 		password="PMWx2c9d1W2Xg2XFHVq9eLnqquo9Ydq8",
 	)
+	async_redis_client = redis.asyncio.Redis(
+		host='redis-12749.crce206.ap-south-1-1.ec2.redns.redis-cloud.com',
+		port=12749,
+		decode_responses=True,
+		username="default",
+		password="PMWx2c9d1W2Xg2XFHVq9eLnqquo9Ydq8",
+	)
 
 # Usage example:
 # redis_client.set("foo", "bar")
@@ -0,0 +1,283 @@
+# app/reservations.py
+"""
+Stock reservation ledger for NewOrders.
+
+Placing an order writes one active StockReservation per product (bulk insert, same
+transaction as the order). Cancelling releases them, dispatch converts them to
+consumed and takes the qty out of StockLevel, and a periodic sweeper expires
+reservations whose TTL has passed.
+
+Functions here only stage changes on the session; the caller commits and then
+hands the returned availability deltas to availability.adjust().
+"""
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional
+
+from fastapi import HTTPException
+from sqlalchemy import bindparam, insert, update
+from sqlmodel import Session, select
+
+from .config import settings
+from .models import NewOrder, NewOrderItem, ReservationStatus, StockLevel, StockMovement, StockReservation
+from . import availability
+
+CONSUME_STATUSES = ("dispatched", "received")
+
+
+def _held_by_product(items: Iterable) -> Dict[int, int]:
+    held: Dict[int, int] = defaultdict(int)
+    for it in items:
+        held[int(it.product_id)] += int(it.qty or 0)
+    return {pid: q for pid, q in held.items() if q > 0}
+
+
+def _active_rows(session: Session, order_id: int) -> List[StockReservation]:
+    stmt = select(StockReservation).where(
+        StockReservation.new_order_id == order_id,
+        StockReservation.status == ReservationStatus.ACTIVE,
+    )
+    return session.exec(stmt).all()
+
+
+def reserve_order(session: Session, order_id: int, items: Iterable, expires_at: Optional[datetime] = None) -> Dict[int, int]:
+    """Bulk-insert active reservations for a freshly placed order. Returns qty held per product."""
+    held = _held_by_product(items)
+    if not held:
+        return {}
+    now = datetime.utcnow()
+    expires_at = expires_at or now + timedelta(hours=settings.RESERVATION_TTL_HOURS)
+    session.execute(
+        insert(StockReservation.__table__),
+        [
+            {"new_order_id": order_id, "product_id": pid, "qty": qty, "status": ReservationStatus.ACTIVE,
+             "expires_at": expires_at, "created_at": now}
+            for pid, qty in held.items()
+        ],
+    )
+    return held
+
+
+def release_order(session: Session, order_id: int, status: str = ReservationStatus.RELEASED) -> Dict[int, int]:
+    """Release every active reservation of an order. Returns qty released per product."""
+    return release_orders(session, [order_id], status)
+
+
+def release_orders(session: Session, order_ids: Iterable[int], status: str = ReservationStatus.RELEASED) -> Dict[int, int]:
+    """release_order for many orders: one SELECT + one UPDATE. Returns qty released per product."""
+    order_ids = list(order_ids)
+    if not order_ids:
+        return {}
+    rows = session.exec(
+        select(StockReservation).where(
+            StockReservation.new_order_id.in_(order_ids),
+            StockReservation.status == ReservationStatus.ACTIVE,
+        )
+    ).all()
+    if not rows:
+        return {}
+    released = _held_by_product(rows)
+    session.execute(
+        update(StockReservation.__table__)
+        .where(StockReservation.__table__.c.id.in_([r.id for r in rows]))
+        .values(status=status, updated_at=datetime.utcnow())
+    )
+    return released
+
+
+def sync_order(session: Session, order_id: int, items: Iterable) -> Dict[int, int]:
+    """
+    Make the active reservations of an open order match its current items.
+    Changed rows are updated, new products inserted, dropped products released.
+    Returns availability deltas.
+    """
+    rows = {r.product_id: r for r in _active_rows(session, order_id)}
+    wanted = _held_by_product(items)
+    now = datetime.utcnow()
+    deltas: Dict[int, int] = {}
+
+    expires_at = min((r.expires_at for r in rows.values() if r.expires_at), default=None)
+    to_insert = {pid: qty for pid, qty in wanted.items() if pid not in rows}
+    for pid, row in rows.items():
+        qty = wanted.get(pid, 0)
+        if qty == row.qty:
+            continue
+        deltas[pid] = row.qty - qty
+        if qty:
+            row.qty = qty
+        else:
+            row.status = ReservationStatus.RELEASED
+        row.updated_at = now
+        session.add(row)
+
+    if to_insert:
+        # a product may have a released/expired row for this order already (unique per order+product)
+        stale = session.exec(
+            select(StockReservation).where(
+                StockReservation.new_order_id == order_id,
+                StockReservation.product_id.in_(list(to_insert)),
+            )
+        ).all()
+        for row in stale:
+            if row.status == ReservationStatus.CONSUMED:
+                # already taken out of StockLevel; holding it again would count the stock twice
+                to_insert.pop(row.product_id)
+                continue
+            row.qty = to_insert.pop(row.product_id)
+            row.status = ReservationStatus.ACTIVE
+            row.expires_at = expires_at or now + timedelta(hours=settings.RESERVATION_TTL_HOURS)
+            row.updated_at = now
+            session.add(row)
+            deltas[row.product_id] = -row.qty
+        reserve_order(session, order_id, [_Line(pid, q) for pid, q in to_insert.items()], expires_at)
+        for pid, qty in to_insert.items():
+            deltas[pid] = -qty
+    return deltas
+
+
+def _take_stock(session: Session, wanted: Dict[int, int]):
+    """
+    StockLevel.quantity -= qty per product, one executemany UPDATE by row id. A product with
+    several StockLevel rows is taken from in id order (availability sums them), never below zero;
+    409 if the product's rows don't hold enough.
+    """
+    rows = session.exec(
+        select(StockLevel.id, StockLevel.product_id, StockLevel.quantity)
+        .where(StockLevel.product_id.in_(list(wanted)))
+        .order_by(StockLevel.id)
+        .with_for_update()
+    ).all()
+    on_hand: Dict[int, int] = defaultdict(int)
+    for _, pid, qty in rows:
+        on_hand[pid] += max(0, int(qty or 0))
+    short = [{"product_id": pid, "requested": qty, "on_hand": on_hand.get(pid, 0)}
+             for pid, qty in wanted.items() if qty > on_hand.get(pid, 0)]
+    if short:
+        raise HTTPException(status_code=409, detail={"message": "Insufficient stock to dispatch", "items": short})
+
+    left = dict(wanted)
+    params = []
+    for level_id, pid, qty in rows:
+        take = min(left[pid], max(0, int(qty or 0)))
+        if take:
+            params.append({"b_id": level_id, "b_qty": take})
+            left[pid] -= take
+    sl = StockLevel.__table__
+    session.execute(
+        update(sl).where(sl.c.id == bindparam("b_id")).values(quantity=sl.c.quantity - bindparam("b_qty")),
+        params,
+    )
+
+
+def consume_order(session: Session, order_id: int, items: Iterable, user_id: Optional[int] = None) -> Dict[int, int]:
+    """
+    Take an order's items out of StockLevel (see _take_stock; plus bulk movements)
+    and mark its reservations consumed. Returns availability deltas: zero for lines
+    that were still reserved, -qty for lines whose reservation had lapsed.
+    """
+    return consume_orders(session, {order_id: items}, user_id)
+
+
+def consume_orders(session: Session, items_by_order: Dict[int, Iterable], user_id: Optional[int] = None) -> Dict[int, int]:
+    """consume_order for many orders at once; StockLevel is decremented once per product."""
+    wanted_by_order = {oid: _held_by_product(items) for oid, items in items_by_order.items()}
+    released = release_orders(session, list(items_by_order), status=ReservationStatus.CONSUMED)
+    wanted: Dict[int, int] = defaultdict(int)
+    for held in wanted_by_order.values():
+        for pid, qty in held.items():
+            wanted[pid] += qty
+    if not wanted:
+        return released
+    _take_stock(session, wanted)
+    now = datetime.utcnow()
+    session.execute(
+        insert(StockMovement.__table__),
+        [
+            {"product_id": pid, "qty": qty, "type": "OUT", "ref": f"NEWORDER#{oid}",
+             "performed_by": user_id, "timestamp": now, "notes": "order dispatched"}
+            for oid, held in wanted_by_order.items()
+            for pid, qty in held.items()
+        ],
+    )
+    return {pid: released.get(pid, 0) - wanted.get(pid, 0) for pid in set(wanted) | set(released)}
+
+
+def apply_order_change(session: Session, order: NewOrder, items: Iterable, old_status: Optional[str], user_id: Optional[int] = None) -> Dict[int, int]:
+    """
+    Route an order edit / status change to sync, release or consume.
+    Call before commit; returns availability deltas for after the commit.
+    """
+    if order.status in availability.OPEN_ORDER_STATUSES:
+        return sync_order(session, order.id, items)
+    if order.status in CONSUME_STATUSES:
+        if old_status in CONSUME_STATUSES:
+            return {}
+        return consume_order(session, order.id, items, user_id)
+    return release_order(session, order.id)
+
+
+def sweep_expired(session: Session, batch_size: int = 500) -> int:
+    """Expire lapsed active reservations in batches; returns how many were released."""
+    total = 0
+    while True:
+        rows = session.exec(
+            select(StockReservation)
+            .where(StockReservation.status == ReservationStatus.ACTIVE, StockReservation.expires_at < datetime.utcnow())
+            .limit(batch_size)
+        ).all()
+        if not rows:
+            break
+        released = _held_by_product(rows)
+        session.execute(
+            update(StockReservation.__table__)
+            .where(StockReservation.__table__.c.id.in_([r.id for r in rows]))
+            .values(status=ReservationStatus.EXPIRED, updated_at=datetime.utcnow())
+        )
+        session.commit()
+        availability.adjust(released)
+        total += len(rows)
+        if len(rows) < batch_size:
+            break
+    return total
+
+
+def sweep_job():
+    from .database import engine
+
+    with Session(engine) as session:
+        sweep_expired(session)
+
+
+def backfill_open_orders(session: Session) -> int:
+    """One-off: reserve stock for open orders placed before the ledger existed."""
+    has_rows = select(StockReservation.new_order_id).distinct()
+    orders = session.exec(
+        select(NewOrder.id).where(NewOrder.status.in_(availability.OPEN_ORDER_STATUSES), NewOrder.id.not_in(has_rows))
+    ).all()
+    if not orders:
+        return 0
+    items = session.exec(select(NewOrderItem).where(NewOrderItem.new_order_id.in_(orders))).all()
+    by_order: Dict[int, list] = defaultdict(list)
+    for it in items:
+        by_order[it.new_order_id].append(it)
+    for oid, its in by_order.items():
+        reserve_order(session, oid, its)
+    session.commit()
+    return len(by_order)
+
+
+class _Line:
+    __slots__ = ("product_id", "qty")
+
+    def __init__(self, product_id: int, qty: int):
+        self.product_id = product_id
+        self.qty = qty
+
+
+if __name__ == "__main__":
+    from .database import engine
+
+    with Session(engine) as s:
+        n = backfill_open_orders(s)
+        availability.reconcile(s)
+        print(f"Reserved stock for {n} open orders")
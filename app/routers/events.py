@@ -0,0 +1,90 @@
+# app/routers/events.py
+import asyncio
+import time
+from typing import Optional
+
+import redis
+from fastapi import APIRouter, HTTPException, Query, Request, status
+from fastapi.responses import StreamingResponse
+from sqlmodel import Session, select
+from starlette.concurrency import run_in_threadpool
+
+from ..auth import decode_token
+from ..database import engine
+from ..models import User
+from .. import events
+
+router = APIRouter(prefix="/api/events", tags=["events"])
+
+HEARTBEAT_SECONDS = 15
+
+
+def _resolve_user(request: Request, token: Optional[str]):
+    """Bearer header or ?token= (EventSource cannot send headers). Returns (id, role)."""
+    auth = request.headers.get("authorization", "")
+    if auth.lower().startswith("bearer "):
+        token = auth.split(" ", 1)[1]
+    payload = decode_token(token) if token else None
+    if not payload or "sub" not in payload:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid auth credentials")
+    # short-lived session: the stream itself must not pin a DB connection
+    with Session(engine) as session:
+        user = session.exec(select(User).where(User.id == int(payload["sub"]))).one_or_none()
+        if not user:
+            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="User not found")
+        if user.role not in events.EVENT_RULES:
+            raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Operation not permitted")
+        return user.id, user.role
+
+
+@router.get("/stream")
+async def stream_status_events(
+    request: Request,
+    kinds: Optional[str] = Query(None, description="Comma separated: new_order,purchase_order (default: all allowed)"),
+    token: Optional[str] = Query(None, description="Access token, for EventSource clients"),
+):
+    """
+    Server-sent events feed of order / PO status transitions.
+    Each event is `event: status` with JSON data {kind, id, from, to, vendor_id, by, at, ...};
+    vendors only see their own orders, drivers only POs assigned to them.
+    """
+    user_id, role = await run_in_threadpool(_resolve_user, request, token)
+    wanted = {k.strip() for k in kinds.split(",") if k.strip()} if kinds else set(events.KINDS)
+    unknown = wanted - set(events.KINDS)
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown kind(s): {', '.join(sorted(unknown))}")
+
+    try:
+        queue = await events.hub.join()
+    except redis.RedisError:
+        raise HTTPException(status_code=503, detail="Event feed unavailable")
+
+    async def event_source():
+        try:
+            yield f"retry: 3000\n: connected as {role}\n\n"
+            last_sent = time.monotonic()
+            while not await request.is_disconnected():
+                try:
+                    item = await asyncio.wait_for(queue.get(), timeout=1.0)
+                except asyncio.TimeoutError:
+                    item = ()
+                if item is None:
+                    yield "event: error\ndata: {\"message\": \"event feed interrupted\"}\n\n"
+                    break
+                if item:
+                    evt, raw = item
+                    if evt.get("kind") in wanted and events.visible_to(evt, user_id, role):
+                        yield f"event: status\ndata: {raw}\n\n"
+                        last_sent = time.monotonic()
+                        continue
+                if time.monotonic() - last_sent >= HEARTBEAT_SECONDS:
+                    yield ": ping\n\n"
+                    last_sent = time.monotonic()
+        finally:
+            events.hub.leave(queue)
+
+    return StreamingResponse(
+        event_source(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
@@ -1,21 +1,43 @@
 # app/routers/new_orders.py
-from fastapi import APIRouter, Depends, HTTPException, status, Body, Query
-from typing import List, Optional
+from fastapi import APIRouter, Depends, HTTPException, status, Body, Query, Header, Response
+from fastapi.encoders import jsonable_encoder
+from typing import Dict, List, Optional
+from sqlalchemy import func, insert, update
 from sqlmodel import Session, select
 from ..database import get_session
-from ..models import NewOrder, NewOrderItem, Product, User, Vehicle, Role
+from ..models import AuditLog, NewOrder, NewOrderItem, Product, StockLevel, User, Vehicle, Role
 from ..schemas import (
     NewOrderCreate, NewOrderRead, NewOrderItemRead,
-    NewOrderUpdateIn, NewOrderItemCreate
+    NewOrderUpdateIn, NewOrderItemCreate,
+    NewOrderBulkStatusIn, NewOrderBulkStatusOut, NewOrderStatusOutcome,
+    NewOrderDetailRead, ExpandedProduct, VehicleRead, UserRead,
 )
 from ..deps import require_roles, get_current_user
+from .. import audit, availability, events, load_planner, order_items, reservations, totals, vendor_spend
+from ..idempotency import IdempotentRequest
+from ..concurrency import check_if_match, versioned_write, set_etag
+from collections import defaultdict
 from datetime import datetime
+import json
 
 router = APIRouter(prefix="/api/new-orders", tags=["new-orders"])
 
 # Helper to build response object
 def build_order_response(session: Session, order: NewOrder) -> NewOrderRead:
     items = session.exec(select(NewOrderItem).where(NewOrderItem.new_order_id == order.id)).all()
+    return _to_order_read(order, items)
+
+# Batched variant for listings: one IN query for the items of the whole page
+def build_order_responses(session: Session, orders: List[NewOrder]) -> List[NewOrderRead]:
+    if not orders:
+        return []
+    items_by_order = defaultdict(list)
+    stmt = select(NewOrderItem).where(NewOrderItem.new_order_id.in_([o.id for o in orders])).order_by(NewOrderItem.id)
+    for it in session.exec(stmt).all():
+        items_by_order[it.new_order_id].append(it)
+    return [_to_order_read(o, items_by_order.get(o.id, [])) for o in orders]
+
+def _to_order_read(order: NewOrder, items: List[NewOrderItem]) -> NewOrderRead:
     item_objs = [
         NewOrderItemRead(
             id=i.id,
@@ -35,46 +57,72 @@ def build_order_response(session: Session, order: NewOrder) -> NewOrderRead:
         items=item_objs,
         shipping_address=order.shipping_address,
         notes=order.notes,
+        delivery_lat=order.delivery_lat,
+        delivery_lng=order.delivery_lng,
         vehicle_id=order.vehicle_id,
         verified=bool(order.verified),
         verified_by=order.verified_by,
-        verified_at=order.verified_at
+        verified_at=order.verified_at,
+        version=order.version,
     )
 
-# ----------------------
-# Vendor: create order
-# ----------------------
-@router.post("/", response_model=NewOrderRead, status_code=status.HTTP_201_CREATED)
-def create_new_order(payload: NewOrderCreate,
-                     session: Session = Depends(get_session),
-                     vendor: User = Depends(require_roles(Role.VENDOR))):
+# Resolve every line's product/price with one IN query; unknown products reject the whole order
+def _resolve_prices(session: Session, items: List[NewOrderItemCreate]) -> Dict[int, float]:
+    ids = {it.product_id for it in items}
+    rows = session.exec(select(Product.id, Product.price).where(Product.id.in_(ids))).all()
+    prices = {pid: float(price or 0.0) for pid, price in rows}
+    missing = sorted(ids - prices.keys())
+    if missing:
+        raise HTTPException(status_code=404, detail=f"Product {', '.join(str(m) for m in missing)} not found")
+    return prices
+
+# Shared intake for vendor and admin-created orders: validate everything first,
+# then insert the order + all items (one multi-row INSERT) and commit once.
+def _place_order(session: Session, vendor_id: int, payload: NewOrderCreate) -> NewOrder:
     if not payload.items or len(payload.items) == 0:
         raise HTTPException(status_code=400, detail="Order must contain at least one item")
+    bad_qty = [it.product_id for it in payload.items if int(it.qty) <= 0]
+    if bad_qty:
+        raise HTTPException(status_code=400, detail=f"qty must be > 0 (product {', '.join(str(b) for b in bad_qty)})")
+    prices = _resolve_prices(session, payload.items)
 
-    order = NewOrder(vendor_id=vendor.id, shipping_address=payload.shipping_address, notes=payload.notes)
-    session.add(order)
-    session.commit()
-    session.refresh(order)
-
+    lines = []
     total = 0.0
     for it in payload.items:
-        prod = session.get(Product, it.product_id)
-        if not prod:
-            session.delete(order)
-            session.commit()
-            raise HTTPException(status_code=404, detail=f"Product {it.product_id} not found")
-        unit_price = float(it.unit_price) if (it.unit_price is not None) else float(prod.price or 0.0)
+        unit_price = float(it.unit_price) if (it.unit_price is not None) else prices[it.product_id]
         subtotal = unit_price * int(it.qty)
-        oi = NewOrderItem(new_order_id=order.id, product_id=it.product_id, qty=it.qty, unit_price=unit_price, subtotal=subtotal, notes=it.notes)
-        session.add(oi)
+        lines.append({"product_id": it.product_id, "qty": it.qty, "unit_price": unit_price, "subtotal": subtotal, "notes": it.notes})
         total += subtotal
 
-    order.total_amount = total
-    session.add(order)
-    session.commit()
+    # the stock is taken up front and given back if anything below fails before the commit
+    with availability.holding(availability.order_reservation(payload.items, "placed")):
+        vendor_spend.charge(session, vendor_id, total, sum(int(it.qty) for it in payload.items))
+        order = NewOrder(vendor_id=vendor_id, shipping_address=payload.shipping_address, notes=payload.notes,
+                         total_amount=total, delivery_lat=payload.delivery_lat, delivery_lng=payload.delivery_lng)
+        session.add(order)
+        session.flush()  # assigns order.id inside the open transaction
+        session.execute(insert(NewOrderItem.__table__), [dict(line, new_order_id=order.id) for line in lines])
+        reservations.reserve_order(session, order.id, payload.items)
+        session.commit()
     session.refresh(order)
+    events.publish(events.status_event("new_order", order.id, order.status, vendor_id=vendor_id))
+    return order
 
-    return build_order_response(session, order)
+# ----------------------
+# Vendor: create order
+# ----------------------
+@router.post("/", response_model=NewOrderRead, status_code=status.HTTP_201_CREATED)
+def create_new_order(payload: NewOrderCreate,
+                     session: Session = Depends(get_session),
+                     vendor: User = Depends(require_roles(Role.VENDOR)),
+                     idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")):
+    with IdempotentRequest(idempotency_key, scope=f"new-order:{vendor.id}", payload=payload) as idem:
+        if idem.replay is not None:
+            return idem.replay
+        order = _place_order(session, vendor.id, payload)
+        resp = build_order_response(session, order)
+        idem.save(resp, status_code=status.HTTP_201_CREATED)
+        return resp
 
 # ----------------------
 # List orders (role aware)
@@ -90,19 +138,116 @@ def list_orders(limit: int = Query(200, ge=1, le=2000),
     # staff/admin/accountant/master see all
     stmt = stmt.limit(limit).order_by(NewOrder.created_at.desc())
     rows = session.exec(stmt).all()
-    return [build_order_response(session, o) for o in rows]
+    return build_order_responses(session, rows)
+
+# ----------------------
+# Load planning (admin/master): propose vehicle assignments for pending orders
+# GET /load-plan?vehicle_ids=1,2&order_ids=10,11  (both optional)
+# ----------------------
+def _parse_ids(raw: Optional[str], name: str) -> Optional[List[int]]:
+    if not raw:
+        return None
+    try:
+        return [int(x) for x in raw.split(",") if x.strip()]
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"{name} must be comma separated integers")
+
+
+@router.get("/load-plan")
+def get_load_plan(vehicle_ids: Optional[str] = Query(None, description="Comma separated vehicle ids (default: all active)"),
+                  order_ids: Optional[str] = Query(None, description="Comma separated order ids (default: unassigned placed/processing orders)"),
+                  session: Session = Depends(get_session),
+                  admin: User = Depends(require_roles(Role.ADMIN, Role.MASTER))):
+    """
+    Packs pending orders onto active vehicles by weight (first-fit-decreasing),
+    respecting each vehicle's remaining capacity. Read-only: apply with PATCH /{order_id}/vehicle.
+    """
+    return load_planner.plan_loads(session, _parse_ids(vehicle_ids, "vehicle_ids"), _parse_ids(order_ids, "order_ids"))
 
 # ----------------------
 # Get single order (role-aware)
 # ----------------------
-@router.get("/{order_id}", response_model=NewOrderRead)
-def get_order(order_id: int, session: Session = Depends(get_session), current: User = Depends(get_current_user)):
+EXPANDABLE = ("products", "vehicle", "users")
+
+
+def _parse_expand(expand: Optional[str]) -> set:
+    wanted = {x.strip().lower() for x in (expand or "").split(",") if x.strip()}
+    unknown = wanted - set(EXPANDABLE)
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown expand value(s): {', '.join(sorted(unknown))}; allowed: {', '.join(EXPANDABLE)}")
+    return wanted
+
+
+def build_order_detail(session: Session, order: NewOrder, expand: set) -> NewOrderDetailRead:
+    """Order plus referenced rows, one batched query per expanded type."""
+    base = build_order_response(session, order)
+    detail = NewOrderDetailRead(**base.dict(), last_modified_by=order.last_modified_by, last_modified_at=order.last_modified_at)
+
+    if "products" in expand:
+        product_ids = sorted({it.product_id for it in base.items})
+        if product_ids:
+            stock = (
+                select(StockLevel.product_id, func.sum(StockLevel.quantity).label("qty"))
+                .where(StockLevel.product_id.in_(product_ids))
+                .group_by(StockLevel.product_id)
+                .subquery()
+            )
+            rows = session.exec(
+                select(Product, func.coalesce(stock.c.qty, 0))
+                .outerjoin(stock, stock.c.product_id == Product.id)
+                .where(Product.id.in_(product_ids))
+            ).all()
+            detail.products = [
+                ExpandedProduct(id=p.id, sku=p.sku, name=p.name, price=float(p.price or 0.0), weight=p.weight,
+                                gst_rate=float(p.gst_rate or 0.0), image_url=p.image_path, active=bool(p.active),
+                                stocklevel_quantity=int(qty or 0))
+                for p, qty in rows
+            ]
+        else:
+            detail.products = []
+
+    vehicle = None
+    if "vehicle" in expand and order.vehicle_id:
+        vehicle = session.get(Vehicle, order.vehicle_id)
+        detail.vehicle = VehicleRead.from_orm(vehicle) if vehicle else None
+
+    if "users" in expand:
+        user_ids = {order.vendor_id, order.verified_by, order.last_modified_by}
+        if vehicle:
+            user_ids.add(vehicle.driver_id)
+        user_ids.discard(None)
+        users = session.exec(select(User).where(User.id.in_(user_ids))).all() if user_ids else []
+        detail.users = [UserRead.from_orm(u) for u in users]
+    return detail
+
+
+# ----------------------
+# Get single order (role-aware)
+# ?expand=products,vehicle,users embeds the referenced rows (one query per type)
+# ----------------------
+@router.get("/{order_id}", response_model=NewOrderDetailRead)
+def get_order(order_id: int, response: Response,
+              expand: Optional[str] = Query(None, description="Comma separated: products,vehicle,users"),
+              session: Session = Depends(get_session), current: User = Depends(get_current_user)):
+    wanted = _parse_expand(expand)
     order = session.get(NewOrder, order_id)
     if not order:
         raise HTTPException(status_code=404, detail="Order not found")
     if current.role == Role.VENDOR and order.vendor_id != current.id:
         raise HTTPException(status_code=403, detail="Not allowed")
-    return build_order_response(session, order)
+    set_etag(response, order)
+    if not wanted:
+        return build_order_response(session, order)
+    return build_order_detail(session, order, wanted)
+
+# allowed status moves (PATCH and /bulk-status); anything else is rejected
+ORDER_TRANSITIONS: Dict[str, tuple] = {
+    "placed": ("processing", "cancelled"),
+    "processing": ("dispatched", "cancelled"),
+    "dispatched": ("received",),
+    "received": (),
+    "cancelled": (),
+}
 
 # ----------------------
 # Update order (staff/admin/master can add/edit items & change basic fields)
@@ -110,107 +255,256 @@ def get_order(order_id: int, session: Session = Depends(get_session), current: U
 # ----------------------
 @router.patch("/{order_id}", response_model=NewOrderRead)
 def update_order(order_id: int,
+                 response: Response,
                  payload: NewOrderUpdateIn = Body(...),
                  session: Session = Depends(get_session),
-                 user: User = Depends(require_roles(Role.STAFF, Role.ADMIN, Role.MASTER))):
+                 user: User = Depends(require_roles(Role.STAFF, Role.ADMIN, Role.MASTER)),
+                 if_match: Optional[str] = Header(None, alias="If-Match")):
     order = session.get(NewOrder, order_id)
     if not order:
         raise HTTPException(status_code=404, detail="Order not found")
+    current = lambda: build_order_response(session, order)
+    check_if_match(order, if_match, current)
+    old_status = order.status
+    if payload.status is not None and payload.status != old_status:
+        if payload.status not in ORDER_TRANSITIONS:
+            raise HTTPException(status_code=400, detail=f"Unknown status '{payload.status}'")
+        if payload.status not in ORDER_TRANSITIONS.get(old_status, ()):
+            raise HTTPException(status_code=409, detail=f"Cannot move order from '{old_status}' to '{payload.status}'")
 
-    # replace items if provided
-    if payload.items is not None:
-        # delete existing
-        existing = session.exec(select(NewOrderItem).where(NewOrderItem.new_order_id == order.id)).all()
-        for e in existing:
-            session.delete(e)
-        session.commit()
-        # add new
-        total = 0.0
-        for it in payload.items:
-            prod = session.get(Product, it.product_id)
-            if not prod:
-                raise HTTPException(status_code=404, detail=f"Product {it.product_id} not found")
-            unit_price = float(it.unit_price) if (it.unit_price is not None) else float(prod.price or 0.0)
-            subtotal = unit_price * int(it.qty)
-            oi = NewOrderItem(new_order_id=order.id, product_id=it.product_id, qty=it.qty, unit_price=unit_price, subtotal=subtotal, notes=it.notes)
-            session.add(oi)
-            total += subtotal
-        order.total_amount = total
-
-    # simple field updates
-    if payload.shipping_address is not None:
-        order.shipping_address = payload.shipping_address
-    if payload.notes is not None:
-        order.notes = payload.notes
-    if payload.status is not None:
-        order.status = payload.status
-
-    order.last_modified_by = user.id
-    order.last_modified_at = datetime.utcnow()
-
-    session.add(order)
-    session.commit()
+    # stock for grown lines is taken before the commit (409 on a shortage) and given back if it fails
+    with availability.holding() as hold, versioned_write(session, order, current), \
+            vendor_spend.tracking(session, vendor_spend.NEW_ORDER, [order.id]):
+        # diff the item list against the stored rows (by id, else product_id)
+        if payload.items is not None:
+            prices = _resolve_prices(session, payload.items)
+            order_items.patch_new_order_items(session, order, payload.items, prices)
+
+        # simple field updates
+        if payload.shipping_address is not None:
+            order.shipping_address = payload.shipping_address
+        if payload.notes is not None:
+            order.notes = payload.notes
+        if payload.delivery_lat is not None:
+            order.delivery_lat = payload.delivery_lat
+        if payload.delivery_lng is not None:
+            order.delivery_lng = payload.delivery_lng
+        if payload.status is not None:
+            order.status = payload.status
+
+        order.last_modified_by = user.id
+        order.last_modified_at = datetime.utcnow()
+
+        if payload.items is not None:
+            current_items = payload.items
+        else:
+            current_items = session.exec(select(NewOrderItem).where(NewOrderItem.new_order_id == order.id)).all()
+        held_delta = reservations.apply_order_change(session, order, current_items, old_status, user.id)
+        hold.take({pid: -d for pid, d in held_delta.items() if d < 0})
+        session.add(order)
     session.refresh(order)
+    availability.adjust({pid: d for pid, d in held_delta.items() if d > 0})
+    if order.status != old_status:
+        events.publish(events.status_event("new_order", order.id, order.status, from_status=old_status,
+                                           vendor_id=order.vendor_id, actor_id=user.id))
+    set_etag(response, order)
     return build_order_response(session, order)
 
+# ----------------------
+# Bulk status transitions (dispatch desk)
+# POST body: {"order_ids": [..], "status": "processing", "all_or_nothing": false}
+# ----------------------
+@router.post("/bulk-status", response_model=NewOrderBulkStatusOut)
+def bulk_update_status(payload: NewOrderBulkStatusIn,
+                       session: Session = Depends(get_session),
+                       user: User = Depends(require_roles(Role.STAFF, Role.ADMIN, Role.MASTER))):
+    """
+    Move many orders to one status. Every order is checked against ORDER_TRANSITIONS,
+    then the ones still in a source status are locked (SELECT ... FOR UPDATE) and flipped with one UPDATE,
+    one audit row each is bulk-inserted and reservations are released / consumed in bulk.
+    Returns an outcome per order instead of the rebuilt orders.
+    """
+    target = payload.status
+    if target not in ORDER_TRANSITIONS:
+        raise HTTPException(status_code=400, detail=f"Unknown status '{target}'")
+    order_ids = list(dict.fromkeys(payload.order_ids))
+    if not order_ids:
+        raise HTTPException(status_code=400, detail="order_ids must not be empty")
+    if len(order_ids) > 1000:
+        raise HTTPException(status_code=400, detail="At most 1000 orders per request")
+
+    allowed_from = [src for src, dests in ORDER_TRANSITIONS.items() if target in dests]
+    rows = session.exec(
+        select(NewOrder.id, NewOrder.status, NewOrder.version, NewOrder.vendor_id).where(NewOrder.id.in_(order_ids))
+    ).all()
+    found = {oid: (st, ver, vid) for oid, st, ver, vid in rows}
+
+    results: Dict[int, NewOrderStatusOutcome] = {}
+    candidates: List[int] = []
+    for oid in order_ids:
+        if oid not in found:
+            results[oid] = NewOrderStatusOutcome(order_id=oid, outcome="not_found")
+            continue
+        st, ver, _ = found[oid]
+        if st == target:
+            results[oid] = NewOrderStatusOutcome(order_id=oid, outcome="unchanged", from_status=st, version=ver)
+        elif st not in allowed_from:
+            results[oid] = NewOrderStatusOutcome(order_id=oid, outcome="invalid_transition", from_status=st, version=ver)
+        else:
+            candidates.append(oid)
+
+    rejected = [r for r in results.values() if r.outcome in ("not_found", "invalid_transition")]
+    if payload.all_or_nothing and rejected:
+        raise HTTPException(status_code=409, detail={
+            "message": f"{len(rejected)} order(s) cannot move to '{target}'",
+            "results": jsonable_encoder(rejected),
+        })
+
+    held_delta: Dict[int, int] = {}
+    updated: List[int] = []
+    if candidates:
+        # lock the rows still in a source status, so a concurrent bulk move of the same
+        # orders waits here and then sees them as unchanged instead of flipping them twice
+        locked = session.exec(
+            select(NewOrder.id, NewOrder.status, NewOrder.version)
+            .where(NewOrder.id.in_(candidates), NewOrder.status.in_(allowed_from))
+            .with_for_update()
+        ).all()
+        for oid, st, ver in locked:
+            found[oid] = (st, ver, found[oid][2])
+        updated = [oid for oid, _, _ in locked]
+
+    if updated:
+        # only a cancellation changes what counts against the vendor's monthly limit
+        spend = vendor_spend.snapshot(session, vendor_spend.NEW_ORDER,
+                                      updated if target in vendor_spend.EXCLUDED_STATUSES else [])
+        now = datetime.utcnow()
+        t = NewOrder.__table__
+        session.execute(
+            update(t)
+            .where(t.c.id.in_(updated))
+            .values(status=target, version=t.c.version + 1, last_modified_by=user.id, last_modified_at=now)
+        )
+        session.execute(
+            insert(AuditLog.__table__),
+            [
+                {"user_id": user.id, "action": "order_status", "timestamp": now,
+                 "metadata": json.dumps({"order_id": oid, "from": found[oid][0], "to": target}),
+                 "entity_type": audit.NEW_ORDER, "entity_id": oid}
+                for oid in updated
+            ],
+        )
+        if target in reservations.CONSUME_STATUSES:
+            to_consume = [oid for oid in updated if found[oid][0] not in reservations.CONSUME_STATUSES]
+            if to_consume:
+                items = session.exec(select(NewOrderItem).where(NewOrderItem.new_order_id.in_(to_consume))).all()
+                by_order: Dict[int, list] = {oid: [] for oid in to_consume}
+                for it in items:
+                    by_order[it.new_order_id].append(it)
+                held_delta = reservations.consume_orders(session, by_order, user.id)
+        elif target not in availability.OPEN_ORDER_STATUSES:
+            held_delta = reservations.release_orders(session, updated)
+        vendor_spend.apply_changes(session, spend)
+        session.commit()
+        availability.adjust(held_delta)
+        events.publish(*[
+            events.status_event("new_order", oid, target, from_status=found[oid][0], vendor_id=found[oid][2], actor_id=user.id)
+            for oid in updated
+        ])
+
+    updated_set = set(updated)
+    for oid in candidates:
+        st, ver, _ = found[oid]
+        if oid in updated_set:
+            results[oid] = NewOrderStatusOutcome(order_id=oid, outcome="updated", from_status=st, version=ver + 1)
+        else:
+            results[oid] = NewOrderStatusOutcome(order_id=oid, outcome="conflict", from_status=st, version=ver)
+    return NewOrderBulkStatusOut(status=target, updated=len(updated), results=[results[oid] for oid in order_ids])
+
 # ----------------------
 # Assign / remove vehicle (admin/master)
 # PATCH body: {"vehicle_id": <int or 0 to remove>}
 # ----------------------
 @router.patch("/{order_id}/vehicle", response_model=NewOrderRead)
-def assign_vehicle(order_id: int, vehicle_id: int = Body(...), session: Session = Depends(get_session), admin: User = Depends(require_roles(Role.ADMIN, Role.MASTER))):
+def assign_vehicle(order_id: int, response: Response, vehicle_id: int = Body(...), session: Session = Depends(get_session), admin: User = Depends(require_roles(Role.ADMIN, Role.MASTER)),
+                   if_match: Optional[str] = Header(None, alias="If-Match"),
+                   force: bool = Query(False, description="assign even if the vehicle's capacity would be exceeded")):
     order = session.get(NewOrder, order_id)
     if not order:
         raise HTTPException(status_code=404, detail="Order not found")
-    if vehicle_id == 0:
-        order.vehicle_id = None
-    else:
-        v = session.get(Vehicle, vehicle_id)
-        if not v:
-            raise HTTPException(status_code=404, detail="Vehicle not found")
-        order.vehicle_id = vehicle_id
-    order.last_modified_by = admin.id
-    order.last_modified_at = datetime.utcnow()
-    session.add(order)
-    session.commit()
+    current = lambda: build_order_response(session, order)
+    check_if_match(order, if_match, current)
+    with versioned_write(session, order, current):
+        if vehicle_id == 0:
+            order.vehicle_id = None
+        else:
+            v = session.get(Vehicle, vehicle_id)
+            if not v:
+                raise HTTPException(status_code=404, detail="Vehicle not found")
+            capacity_kg = load_planner.to_kg(v.capacity_weight, v.capacity_unit)
+            if capacity_kg is not None and not force:
+                order_kg = load_planner.order_weights(session, [order.id]).get(order.id, 0.0)
+                loaded_kg = load_planner.vehicle_loads(session, [v.id], exclude_order_id=order.id).get(v.id, 0.0)
+                if loaded_kg + order_kg > capacity_kg:
+                    raise HTTPException(status_code=409, detail={
+                        "message": "Vehicle capacity exceeded",
+                        "capacity_kg": capacity_kg, "current_load_kg": loaded_kg, "order_weight_kg": order_kg,
+                    })
+            order.vehicle_id = vehicle_id
+        order.last_modified_by = admin.id
+        order.last_modified_at = datetime.utcnow()
+        session.add(order)
     session.refresh(order)
+    set_etag(response, order)
     return build_order_response(session, order)
 
 # ----------------------
 # Accountant: verify order
 # ----------------------
 @router.post("/{order_id}/verify", response_model=NewOrderRead)
-def verify_order(order_id: int, session: Session = Depends(get_session), acct: User = Depends(require_roles(Role.ACCOUNTANT))):
+def verify_order(order_id: int, response: Response, session: Session = Depends(get_session), acct: User = Depends(require_roles(Role.ACCOUNTANT)),
+                 if_match: Optional[str] = Header(None, alias="If-Match")):
     order = session.get(NewOrder, order_id)
     if not order:
         raise HTTPException(status_code=404, detail="Order not found")
-    order.verified = True
-    order.verified_by = acct.id
-    order.verified_at = datetime.utcnow()
-    session.add(order)
-    session.commit()
+    current = lambda: build_order_response(session, order)
+    check_if_match(order, if_match, current)
+    with versioned_write(session, order, current):
+        order.verified = True
+        order.verified_by = acct.id
+        order.verified_at = datetime.utcnow()
+        session.add(order)
     session.refresh(order)
+    set_etag(response, order)
     return build_order_response(session, order)
 
 # ----------------------
 # Remove single item (staff/admin/master)
 # ----------------------
 @router.delete("/{order_id}/items/{item_id}", status_code=status.HTTP_204_NO_CONTENT)
-def delete_order_item(order_id: int, item_id: int, session: Session = Depends(get_session), user: User = Depends(require_roles(Role.STAFF, Role.ADMIN, Role.MASTER))):
+def delete_order_item(order_id: int, item_id: int, session: Session = Depends(get_session), user: User = Depends(require_roles(Role.STAFF, Role.ADMIN, Role.MASTER)),
+                      if_match: Optional[str] = Header(None, alias="If-Match")):
     order = session.get(NewOrder, order_id)
     if not order:
         raise HTTPException(status_code=404, detail="Order not found")
+    current = lambda: build_order_response(session, order)
+    check_if_match(order, if_match, current)
     item = session.get(NewOrderItem, item_id)
     if not item or item.new_order_id != order.id:
         raise HTTPException(status_code=404, detail="Item not found")
-    session.delete(item)
-    # recalc total
-    remaining = session.exec(select(NewOrderItem).where(NewOrderItem.new_order_id == order.id)).all()
-    order.total_amount = sum((i.subtotal or 0.0) for i in remaining)
-    order.last_modified_by = user.id
-    order.last_modified_at = datetime.utcnow()
-    session.add(order)
-    session.commit()
+    with versioned_write(session, order, current), vendor_spend.tracking(session, vendor_spend.NEW_ORDER, [order.id]):
+        session.delete(item)
+        session.flush()
+        totals.assign_new_order_total(order)
+        order.last_modified_by = user.id
+        order.last_modified_at = datetime.utcnow()
+        # only open orders hold reservations that have to follow the item list
+        remaining = []
+        if order.status in availability.OPEN_ORDER_STATUSES:
+            remaining = session.exec(select(NewOrderItem).where(NewOrderItem.new_order_id == order.id)).all()
+        held_delta = reservations.apply_order_change(session, order, remaining, order.status, user.id)
+        session.add(order)
+    availability.adjust(held_delta)
     return {}
 
 # GET vendor's orders (admin/master)
@@ -250,7 +544,7 @@ def list_vendor_orders(
 
     stmt = stmt.order_by(NewOrder.created_at.desc()).offset(offset).limit(limit)
     rows = session.exec(stmt).all()
-    return [build_order_response(session, o) for o in rows]
+    return build_order_responses(session, rows)
 
 # ----------------------
 # Admin create order on behalf of a vendor
@@ -260,48 +554,22 @@ def admin_create_order_for_vendor(
     vendor_id: int,
     payload: NewOrderCreate,
     session: Session = Depends(get_session),
-    admin: User = Depends(require_roles(Role.ADMIN, Role.MASTER))
+    admin: User = Depends(require_roles(Role.ADMIN, Role.MASTER)),
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
 ):
     """
     Admin/Master can create an order for a specific vendor.
     Works same as vendor creating their own order.
     """
-    if not payload.items or len(payload.items) == 0:
-        raise HTTPException(status_code=400, detail="Order must contain at least one item")
-
-    # check vendor exists and role is vendor
-    vendor = session.get(User, vendor_id)
-    if not vendor or vendor.role != Role.VENDOR:
-        raise HTTPException(status_code=404, detail="Vendor not found")
-
-    order = NewOrder(vendor_id=vendor_id, shipping_address=payload.shipping_address, notes=payload.notes)
-    session.add(order)
-    session.commit()
-    session.refresh(order)
+    with IdempotentRequest(idempotency_key, scope=f"new-order-admin:{admin.id}:{vendor_id}", payload=payload) as idem:
+        if idem.replay is not None:
+            return idem.replay
+        # check vendor exists and role is vendor
+        vendor = session.get(User, vendor_id)
+        if not vendor or vendor.role != Role.VENDOR:
+            raise HTTPException(status_code=404, detail="Vendor not found")
 
-    total = 0.0
-    for it in payload.items:
-        prod = session.get(Product, it.product_id)
-        if not prod:
-            session.delete(order)
-            session.commit()
-            raise HTTPException(status_code=404, detail=f"Product {it.product_id} not found")
-        unit_price = float(it.unit_price) if (it.unit_price is not None) else float(prod.price or 0.0)
-        subtotal = unit_price * int(it.qty)
-        oi = NewOrderItem(
-            new_order_id=order.id,
-            product_id=it.product_id,
-            qty=it.qty,
-            unit_price=unit_price,
-            subtotal=subtotal,
-            notes=it.notes,
-        )
-        session.add(oi)
-        total += subtotal
-
-    order.total_amount = total
-    session.add(order)
-    session.commit()
-    session.refresh(order)
-
-    return build_order_response(session, order)
+        order = _place_order(session, vendor_id, payload)
+        resp = build_order_response(session, order)
+        idem.save(resp, status_code=status.HTTP_201_CREATED)
+        return resp
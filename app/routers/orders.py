@@ -1,232 +1,244 @@
 # app/routers/vendor.py
-from fastapi import APIRouter, Depends, HTTPException, status, Query
+from fastapi import APIRouter, Depends, HTTPException, status, Query, Header, Response
+from fastapi.responses import PlainTextResponse
 from typing import List, Optional
 
 from pydantic import BaseModel, conint
 from sqlmodel import select
 from ..database import get_session
-from ..models import PurchaseOrder, PurchaseItem, Product, AuditLog, User
-from ..schemas import PurchaseOrderCreate, PurchaseOrderRead, PurchaseItemRead
+from ..models import PurchaseOrder, PurchaseItem, PurchaseItemHistory, PaymentAttempt, PaymentState, AuditLog, User
+from ..schemas import PurchaseOrderCreate, PurchaseOrderRead, PurchaseOrderUpdate, PurchaseItemRead
 from ..deps import require_roles, get_current_user
 from ..models import Role
+from .. import driver_assignments, events, order_items, pagination, payment_reconciler, payments, phonepe, totals, vendor_spend
+from ..idempotency import IdempotentRequest
+from ..concurrency import check_if_match, versioned_write, set_etag
 from sqlmodel import Session
+from starlette.concurrency import run_in_threadpool
 from datetime import datetime
 import os
-import requests
 import json
-import time
 
 router = APIRouter(prefix="/api/vendor", tags=["vendor"])
 
 # --- Payment configuration (env override) ---------------------------------
 PAYMENT_ENABLED = os.getenv("PAYMENT_ENABLED", "true").lower() in ("1", "true", "yes")
-PHONEPE_CLIENT_ID = os.getenv("PHONEPE_CLIENT_ID", "TEST-M23AZS78T1O0V_25091")
-PHONEPE_CLIENT_SECRET = os.getenv("PHONEPE_CLIENT_SECRET", "YmQyNzFiM2MtYWE0ZS00NjNkLWFlNWItMGFjMTE5OGYzMjYz")
-PHONEPE_OAUTH_URL = os.getenv("PHONEPE_OAUTH_URL", "https://api-preprod.phonepe.com/apis/pg-sandbox/v1/oauth/token")
-PHONEPE_PAY_URL = os.getenv("PHONEPE_PAY_URL", "https://api-preprod.phonepe.com/apis/pg-sandbox/checkout/v2/pay")
-PHONEPE_STATUS_BASE = os.getenv("PHONEPE_STATUS_BASE", "https://api-preprod.phonepe.com/apis/pg-sandbox/checkout/v2/order")
 # Optional fixed merchantOrderId (for testing). If set, will be used instead of generated id.
 PAYMENT_MERCHANT_ORDER_ID = os.getenv("PAYMENT_MERCHANT_ORDER_ID", None)
 # multiplier (e.g. to convert rupee->paise)
-PAYMENT_AMOUNT_MULTIPLIER = int(os.getenv("PAYMENT_AMOUNT_MULTIPLIER", "100"))
+PAYMENT_AMOUNT_MULTIPLIER = payments.AMOUNT_MULTIPLIER
 # redirect on payment complete
 PAYMENT_REDIRECT_URL = os.getenv("PAYMENT_REDIRECT_URL", "https://your-frontend.example.com/payment-callback")
 
-# simple in-memory token cache
-_token_cache = {"token": None, "expires_at": 0}
+# -------------------- helpers: PhonePe gateway ----------------------------
+# Gateway URLs / credentials (PHONEPE_* env) and the pooled client live in app/phonepe.py.
+def _gateway_http_error(e: phonepe.GatewayError) -> HTTPException:
+    headers = None
+    if isinstance(e, phonepe.CircuitOpenError):
+        headers = {"Retry-After": str(int(e.retry_after) + 1)}
+    return HTTPException(status_code=e.http_status, detail=str(e), headers=headers)
 
 
-# -------------------- helpers: PhonePe token / API -------------------------
-def _get_phonepe_token():
-    """
-    Obtain OAuth token from PhonePe sandbox. Returns token string.
-    Uses simple in-memory caching for expires_in.
-    """
-    global _token_cache
-    now = int(time.time())
-    if _token_cache.get("token") and _token_cache.get("expires_at", 0) > now + 5:
-        return _token_cache["token"]
-
-    data = {
-        "client_id": PHONEPE_CLIENT_ID,
-        "client_version": "1",
-        "client_secret": PHONEPE_CLIENT_SECRET,
-        "grant_type": "client_credentials",
-    }
-    headers = {"Content-Type": "application/x-www-form-urlencoded"}
-    try:
-        resp = requests.post(PHONEPE_OAUTH_URL, data=data, headers=headers, timeout=10)
-        resp.raise_for_status()
-        j = resp.json()
-        token = j.get("access_token")
-        expires_in = int(j.get("expires_in", 3600))
-        _token_cache["token"] = token
-        _token_cache["expires_at"] = now + expires_in
-        return token
-    except requests.RequestException as e:
-        raise HTTPException(status_code=502, detail=f"Payment token request failed: {e}")
-
-
-def _create_phonepe_payment(merchant_order_id: str, amount: int, meta: dict, redirect_url: str):
-    """
-    Create a PhonePe checkout order and return the JSON response.
-    amount is in smallest currency unit (paise).
-    """
-    token = _get_phonepe_token()
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"O-Bearer {token}",
-    }
-    payload = {
-        "merchantOrderId": merchant_order_id,
-        "amount": amount,
-        "expireAfter": 1200,
-        "metaInfo": meta or {},
-        "paymentFlow": {
-            "type": "PG_CHECKOUT",
-            "message": "Payment message",
-            "merchantUrls": {"redirectUrl": redirect_url},
-        },
-    }
-    try:
-        resp = requests.post(PHONEPE_PAY_URL, json=payload, headers=headers, timeout=10)
-        resp.raise_for_status()
-        return resp.json()
-    except requests.RequestException as e:
-        raise HTTPException(status_code=502, detail=f"Payment create failed: {e}")
-
-
-def _phonepe_check_status_by_merchant_order(merchant_order_id: str):
-    """
-    Call PhonePe status endpoint for given merchantOrderId.
-    Endpoint: {PHONEPE_STATUS_BASE}/{merchantOrderId}/status
-    """
-    token = _get_phonepe_token()
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"O-Bearer {token}",
-    }
-    url = f"{PHONEPE_STATUS_BASE}/{merchant_order_id}/status"
-    try:
-        resp = requests.get(url, headers=headers, timeout=10)
-        resp.raise_for_status()
-        return resp.json()
-    except requests.RequestException as e:
-        raise HTTPException(status_code=502, detail=f"Payment status request failed: {e}")
-
-
-def _get_product_and_price(session: Session, product_id: int):
-    prod = session.get(Product, product_id)
-    if not prod:
-        raise HTTPException(status_code=400, detail=f"Product id {product_id} not found")
-    price = float(getattr(prod, "price", 0.0) or 0.0)
-    return prod, price
+def _po_payment_attempt(session: Session, user: User, po_id: int, merchant_order_id: Optional[str], not_found: str):
+    """Vendor's own PO and its latest (or the named) payment attempt; 404/403 otherwise."""
+    po = session.get(PurchaseOrder, po_id)
+    if not po:
+        raise HTTPException(status_code=404, detail="Purchase order not found")
+    if po.vendor_id != user.id:
+        raise HTTPException(status_code=403, detail="Forbidden")
+    attempt = payments.latest_attempt(session, po.id, merchant_order_id)
+    if not attempt:
+        raise HTTPException(status_code=404, detail=not_found)
+    return po, attempt
 
 
 # -------------------- PO helpers ------------------------------------------
 def _get_po_response(session: Session, po: PurchaseOrder) -> PurchaseOrderRead:
-    stmt = select(PurchaseItem).where(PurchaseItem.purchase_order_id == po.id)
-    items = session.exec(stmt).all()
-    items_read = [PurchaseItemRead(id=i.id, product_id=i.product_id, qty=i.qty, unit_price=i.unit_price) for i in items]
-    po_read = PurchaseOrderRead(
-        id=po.id,
-        vendor_id=po.vendor_id,
-        created_by=po.created_by,
-        status=po.status,
-        total=po.total,
-        expected_date=po.expected_date,
-        created_at=po.created_at,
-        items=items_read,
-    )
-    return po_read
+    return _get_pos_response(session, [po])[0]
+
+
+def _get_pos_response(session: Session, pos: List[PurchaseOrder]) -> List[PurchaseOrderRead]:
+    """_get_po_response for a page of POs: one IN query for all their items."""
+    if not pos:
+        return []
+    items_by_po = {p.id: [] for p in pos}
+    stmt = select(PurchaseItem).where(PurchaseItem.purchase_order_id.in_(list(items_by_po))).order_by(PurchaseItem.id)
+    for i in session.exec(stmt).all():
+        items_by_po[i.purchase_order_id].append(
+            PurchaseItemRead(id=i.id, product_id=i.product_id, qty=i.qty, unit_price=i.unit_price, received_qty=i.received_qty or 0)
+        )
+    return [
+        PurchaseOrderRead(
+            id=po.id,
+            vendor_id=po.vendor_id,
+            created_by=po.created_by,
+            status=po.status,
+            total=po.total,
+            expected_date=po.expected_date,
+            created_at=po.created_at,
+            items=items_by_po[po.id],
+            version=po.version,
+        )
+        for po in pos
+    ]
+
+
+def _apply_payment_status(session: Session, user: User, po: PurchaseOrder, attempt, status_resp: dict, action: str):
+    """
+    Apply a gateway status response through payment_reconciler.apply_results (the webhook /
+    reconciler path: row locks, terminal states kept, only a PO still awaiting payment moves,
+    and only by its latest attempt unless COMPLETED) and commit.
+    Returns (attempt state, PO status) as stored afterwards, so async callers don't lazy-load on the loop.
+    """
+    row = (attempt.id, po.id, attempt.merchant_order_id, attempt.state)
+    payment_reconciler.apply_results(session, [(row, status_resp)], datetime.utcnow(), action=action, user_id=user.id)
+    state, po_status = session.exec(
+        select(PaymentAttempt.state, PurchaseOrder.status)
+        .join(PurchaseOrder, PurchaseOrder.id == PaymentAttempt.purchase_order_id)
+        .where(PaymentAttempt.id == row[0])
+    ).one()
+    return state, po_status
 
 
 # -------------------- endpoints -------------------------------------------
 @router.post("/orders", status_code=201, response_model=PurchaseOrderRead)
-def vendor_create_order(payload: PurchaseOrderCreate, session: Session = Depends(get_session), user: User = Depends(require_roles(Role.VENDOR))):
+def vendor_create_order(
+    payload: PurchaseOrderCreate,
+    session: Session = Depends(get_session),
+    user: User = Depends(require_roles(Role.VENDOR)),
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
+):
     """
     Vendor places an order. Vendor identity taken from JWT (user.id).
-    If PAYMENT_ENABLED is true, a PhonePe checkout order is created and its redirectUrl
-    is stored in AuditLog meta (including merchantOrderId). Response includes payment info.
+    If PAYMENT_ENABLED is true, a PhonePe checkout order is created and recorded as a
+    PaymentAttempt (merchantOrderId, amount, redirectUrl). Response includes payment info.
+    Send an Idempotency-Key header to make retries safe: a replay returns the first
+    response without creating another PO or PhonePe payment, and a retry after a
+    gateway error reuses the PO already created and only retries the payment.
     """
+    with IdempotentRequest(idempotency_key, scope=f"vendor-po:{user.id}", payload=payload) as idem:
+        if idem.replay is not None:
+            return idem.replay
+        resp = _create_vendor_po(session, user, payload, idem)
+        idem.save(resp, status_code=201)
+        return resp
+
+
+def _create_vendor_po(session: Session, user: User, payload: PurchaseOrderCreate, idem: IdempotentRequest):
+    po = None
+    if idem.progress and idem.progress.get("po_id"):
+        # an earlier attempt with this key committed the PO, then failed at the gateway
+        po = session.get(PurchaseOrder, idem.progress["po_id"])
+        if po is not None and po.vendor_id != user.id:
+            po = None
+    if po is None:
+        po = _insert_vendor_po(session, user, payload)
+        idem.checkpoint({"po_id": po.id})
+
+    # PAYMENT (optional)
+    payment_info = None
+    if PAYMENT_ENABLED:
+        if po.status == "placed":
+            payment_info = _start_vendor_payment(session, user, po)
+        else:
+            attempt = payments.latest_attempt(session, po.id)
+            if attempt:
+                payment_info = {"merchantOrderId": attempt.merchant_order_id, "amount": attempt.amount,
+                                "orderId": attempt.gateway_order_id, "state": attempt.state,
+                                "redirectUrl": attempt.redirect_url, "raw": None}
+
+    po_with_items = _get_po_response(session, po)
+    resp = po_with_items.dict() if hasattr(po_with_items, "dict") else po_with_items
+    if payment_info:
+        resp = dict(resp)
+        resp["payment"] = payment_info
+    return resp
+
+
+def _insert_vendor_po(session: Session, user: User, payload: PurchaseOrderCreate) -> PurchaseOrder:
     vendor_id = user.id
 
-    # create skeleton PO
+    # master product price (ignore client-sent price); the monthly limit is checked before anything is written
+    prices = order_items.product_prices(session, [it.product_id for it in payload.items])
+    total = sum(float(it.qty) * prices[it.product_id] for it in payload.items)
+    vendor_spend.charge(session, vendor_id, total, sum(int(it.qty) for it in payload.items))
+
     po = PurchaseOrder(
         vendor_id=vendor_id,
         created_by=user.id,
         status="placed",
-        total=0.0,
+        total=total,
         expected_date=payload.expected_date,
         created_at=datetime.utcnow(),
     )
     session.add(po)
-    session.commit()
-    session.refresh(po)
+    session.flush()  # assigns po.id; PO, items and the spend counter commit together
 
-    # insert items using master product price (ignore client-sent price)
-    total = 0.0
     for it in payload.items:
-        _, price = _get_product_and_price(session, it.product_id)
-        pi = PurchaseItem(purchase_order_id=po.id, product_id=it.product_id, qty=it.qty, unit_price=price)
-        total += float(it.qty) * price
-        session.add(pi)
-
-    po.total = total
-    session.add(po)
+        session.add(PurchaseItem(purchase_order_id=po.id, product_id=it.product_id, qty=it.qty, unit_price=prices[it.product_id]))
 
     # audit: po created
     session.add(AuditLog(user_id=user.id, action="create_po", meta=f"po:{po.id},vendor:{vendor_id},total:{total}"))
 
     session.commit()
     session.refresh(po)
+    events.publish(events.status_event("purchase_order", po.id, po.status, vendor_id=vendor_id, actor_id=user.id))
+    return po
 
-    # PAYMENT (optional)
-    payment_info = None
-    if PAYMENT_ENABLED:
-        # merchant_order_id from env if set else generated
-        merchant_order_id = PAYMENT_MERCHANT_ORDER_ID or f"PO{po.id}-{int(datetime.utcnow().timestamp())}"
-        amount_int = int(round(po.total * PAYMENT_AMOUNT_MULTIPLIER))
-        meta = {"po_id": str(po.id), "vendor_id": str(vendor_id)}
-        redirect_url = PAYMENT_REDIRECT_URL
 
-        pay_resp = _create_phonepe_payment(merchant_order_id=merchant_order_id, amount=amount_int, meta=meta, redirect_url=redirect_url)
-
-        # Store merchantOrderId + response in audit log for later status checks
-        audit_meta = {"merchantOrderId": merchant_order_id, "phonepe_response": pay_resp}
-        session.add(AuditLog(user_id=user.id, action="create_payment", meta=json.dumps(audit_meta)))
-        session.commit()
+def _start_vendor_payment(session: Session, user: User, po: PurchaseOrder) -> dict:
+    """Create the PhonePe checkout for a placed PO, record the attempt and move the PO to pending_payment."""
+    # merchant_order_id from env if set else generated
+    merchant_order_id = PAYMENT_MERCHANT_ORDER_ID or f"PO{po.id}-{int(datetime.utcnow().timestamp())}"
+    amount_int = int(round(po.total * PAYMENT_AMOUNT_MULTIPLIER))
+    meta = {"po_id": str(po.id), "vendor_id": str(po.vendor_id)}
+    redirect_url = PAYMENT_REDIRECT_URL
 
-        payment_info = {
-            "merchantOrderId": merchant_order_id,
-            "amount": amount_int,
-            "orderId": pay_resp.get("orderId"),
-            "state": pay_resp.get("state"),
-            "redirectUrl": pay_resp.get("redirectUrl"),
-            "raw": pay_resp,
-        }
-        po.status = "pending_payment"
-        session.add(po)
-        session.commit()
-        session.refresh(po)
+    # sync handler (idempotency lock may wait): run the call on the app loop's pooled client
+    try:
+        pay_resp = phonepe.run_sync(phonepe.create_payment, merchant_order_id=merchant_order_id,
+                                    amount=amount_int, meta=meta, redirect_url=redirect_url)
+    except phonepe.GatewayError as e:
+        raise _gateway_http_error(e)
+
+    # Store the attempt for later status checks; PO status moves in the same commit
+    payments.record_attempt(session, po.id, merchant_order_id, amount_int, pay_resp, user_id=user.id)
+    audit_meta = {"po_id": po.id, "merchantOrderId": merchant_order_id, "phonepe_response": pay_resp}
+    session.add(AuditLog(user_id=user.id, action="create_payment", meta=json.dumps(audit_meta)))
+    po.status = "pending_payment"
+    session.add(po)
+    session.commit()
+    session.refresh(po)
 
-    po_with_items = _get_po_response(session, po)
-    resp = po_with_items.dict() if hasattr(po_with_items, "dict") else po_with_items
-    if payment_info:
-        resp = dict(resp)
-        resp["payment"] = payment_info
-    return resp
+    return {
+        "merchantOrderId": merchant_order_id,
+        "amount": amount_int,
+        "orderId": pay_resp.get("orderId"),
+        "state": pay_resp.get("state"),
+        "redirectUrl": pay_resp.get("redirectUrl"),
+        "raw": pay_resp,
+    }
 
 
 @router.get("/orders/me", response_model=List[PurchaseOrderRead])
-def vendor_list_orders(session: Session = Depends(get_session), user: User = Depends(require_roles(Role.VENDOR))):
-    stmt = select(PurchaseOrder).where(PurchaseOrder.vendor_id == user.id).order_by(PurchaseOrder.created_at.desc())
-    pos = session.exec(stmt).all()
-    return [ _get_po_response(session, p) for p in pos ]
+def vendor_list_orders(
+    response: Response,
+    status: Optional[str] = Query(None, description="PO status, or several comma separated"),
+    date_from: Optional[datetime] = Query(None, description="Created_at >= (ISO datetime)"),
+    date_to: Optional[datetime] = Query(None, description="Created_at <= (ISO datetime)"),
+    limit: int = Query(100, ge=1, le=1000),
+    cursor: Optional[str] = Query(None, description="X-Next-Cursor header of the previous page"),
+    session: Session = Depends(get_session),
+    user: User = Depends(require_roles(Role.VENDOR)),
+):
+    """Vendor's own POs, newest first, one page at a time (see app/pagination.py)."""
+    stmt = select(PurchaseOrder).where(PurchaseOrder.vendor_id == user.id)
+    pos = pagination.filtered_page(session, response, stmt, PurchaseOrder, status, date_from, date_to, limit, cursor)
+    return _get_pos_response(session, pos)
 
 
 @router.get("/orders/{po_id}/payment-status")
-def check_and_sync_payment_status(
+async def check_and_sync_payment_status(
     po_id: int,
     merchant_order_id: Optional[str] = Query(None, description="Optional merchantOrderId (if you have it)."),
     session: Session = Depends(get_session),
@@ -234,8 +246,10 @@ def check_and_sync_payment_status(
 ):
     """
     Check PhonePe payment status for a given PO and also update PurchaseOrder.status.
-    - If merchant_order_id provided, use it.
-    - Otherwise find merchantOrderId from audit logs.
+    - If merchant_order_id provided, use that payment attempt of this PO.
+    - Otherwise use the PO's latest payment attempt.
+    - If the attempt is already final (webhook / reconciler applied it), answers from the
+      DB without calling the gateway (source="db").
     - Updates PurchaseOrder.status:
         COMPLETED -> paid
         PENDING   -> pending_payment
@@ -243,79 +257,54 @@ def check_and_sync_payment_status(
         Others    -> payment_<state_lower>
     - Returns both gateway status + updated PO info.
     """
-    # verify PO belongs to vendor
-    po = session.get(PurchaseOrder, po_id)
-    if not po:
-        raise HTTPException(status_code=404, detail="Purchase order not found")
-    if po.vendor_id != user.id:
-        raise HTTPException(status_code=403, detail="Forbidden")
-
-    moid = merchant_order_id
-
-    # search AuditLog if merchant_order_id not provided
-    if not moid:
-        stmt = select(AuditLog).where(
-            AuditLog.user_id == user.id,
-            AuditLog.action.in_(["create_payment", "create_payment_regen"])
-        ).order_by(AuditLog.id.desc())
-        logs = session.exec(stmt).all()
-        for log in logs:
-            try:
-                meta = json.loads(log.meta)
-            except Exception:
-                continue
-            if isinstance(meta, dict):
-                if "merchantOrderId" in meta:
-                    moid = meta["merchantOrderId"]
-                    break
-                if "phonepe_response" in meta and isinstance(meta["phonepe_response"], dict):
-                    nested = meta["phonepe_response"]
-                    moid = nested.get("merchantOrderId") or nested.get("merchantOrderID") or nested.get("merchantOrder")
-                    if moid:
-                        break
-
-    if not moid:
-        raise HTTPException(status_code=404, detail="merchantOrderId not found. Provide it explicitly or ensure payment was created.")
-
-    # call PhonePe status endpoint
-    status_resp = _phonepe_check_status_by_merchant_order(moid)
-    state = status_resp.get("state")
-
-    # map state to PO.status
-    if state == "COMPLETED":
-        po.status = "paid"
-    elif state == "FAILED":
-        po.status = "payment_failed"
-    elif state == "PENDING":
-        po.status = "pending_payment"
-    else:
-        po.status = f"payment_{str(state).lower()}" if state else po.status
+    po, attempt = await run_in_threadpool(
+        _po_payment_attempt, session, user, po_id, merchant_order_id,
+        "merchantOrderId not found. Provide it explicitly or ensure payment was created.",
+    )
+    moid = attempt.merchant_order_id
+    if attempt.state in PaymentState.TERMINAL:
+        return {"po_id": po.id, "merchantOrderId": moid, "gateway_state": attempt.state,
+                "updated_status": po.status, "gateway_raw": None, "source": "db"}
 
+    # call PhonePe status endpoint (async: no worker thread waits on the gateway)
     try:
-        session.add(po)
-        session.add(AuditLog(
-            user_id=user.id,
-            action="payment_status_sync",
-            meta=json.dumps({"po_id": po.id, "merchantOrderId": moid, "gateway_state": state, "raw": status_resp})
-        ))
-        session.commit()
-        session.refresh(po)
-    except Exception as e:
-        session.rollback()
-        raise HTTPException(status_code=500, detail=f"Failed to update PO status: {e}")
+        status_resp = await phonepe.check_status(moid)
+    except phonepe.GatewayError as e:
+        raise _gateway_http_error(e)
+    state, po_status = await run_in_threadpool(_apply_payment_status, session, user, po, attempt, status_resp,
+                                               "payment_status_sync")
 
     return {
-        "po_id": po.id,
+        "po_id": po_id,
         "merchantOrderId": moid,
         "gateway_state": state,
-        "updated_status": po.status,
+        "updated_status": po_status,
         "gateway_raw": status_resp,
+        "source": "gateway",
     }
 
 
+def _vendor_po_for_payment(session: Session, user: User, po_id: int) -> PurchaseOrder:
+    po = session.get(PurchaseOrder, po_id)
+    if not po:
+        raise HTTPException(status_code=404, detail="PO not found")
+    if po.vendor_id != user.id:
+        raise HTTPException(status_code=403, detail="Forbidden")
+    return po
+
+
+def _record_regenerated_payment(session: Session, user: User, po: PurchaseOrder, merchant_order_id: str, amount: int, pay_resp: dict):
+    try:
+        payments.record_attempt(session, po.id, merchant_order_id, amount, pay_resp, user_id=user.id)
+        audit_meta = {"po_id": po.id, "merchantOrderId": merchant_order_id, "phonepe_response": pay_resp}
+        session.add(AuditLog(user_id=user.id, action="create_payment_regen", meta=json.dumps(audit_meta)))
+        session.commit()
+    except Exception:
+        session.rollback()
+
 
 @router.post("/orders/{po_id}/regenerate-payment")
-def regenerate_payment_for_po(
+async def regenerate_payment_for_po(
     po_id: int,
     redirect_url: Optional[str] = None,
     session: Session = Depends(get_session),
@@ -324,13 +313,9 @@ def regenerate_payment_for_po(
     """
     Regenerate PhonePe checkout for existing PO and return redirectUrl.
     - Uses PAYMENT_MERCHANT_ORDER_ID env if set; otherwise generates unique merchantOrderId.
-    - Stores payment raw response in AuditLog (create_payment_regen).
+    - Records a new PaymentAttempt (and an AuditLog create_payment_regen entry).
     """
-    po = session.get(PurchaseOrder, po_id)
-    if not po:
-        raise HTTPException(status_code=404, detail="PO not found")
-    if po.vendor_id != user.id:
-        raise HTTPException(status_code=403, detail="Forbidden")
+    po = await run_in_threadpool(_vendor_po_for_payment, session, user, po_id)
 
     if not PAYMENT_ENABLED:
         raise HTTPException(status_code=400, detail="Payment disabled on server")
@@ -340,21 +325,19 @@ def regenerate_payment_for_po(
     meta = {"po_id": str(po.id), "vendor_id": str(user.id)}
     redirect = redirect_url or PAYMENT_REDIRECT_URL
 
-    pay_resp = _create_phonepe_payment(merchant_order_id=merchant_order_id, amount=amount_int, meta=meta, redirect_url=redirect)
-
-    # persist audit log
     try:
-        audit_meta = {"merchantOrderId": merchant_order_id, "phonepe_response": pay_resp}
-        session.add(AuditLog(user_id=user.id, action="create_payment_regen", meta=json.dumps(audit_meta)))
-        session.commit()
-    except Exception:
-        session.rollback()
+        pay_resp = await phonepe.create_payment(merchant_order_id=merchant_order_id, amount=amount_int, meta=meta, redirect_url=redirect)
+    except phonepe.GatewayError as e:
+        raise _gateway_http_error(e)
+
+    # persist the attempt + audit log
+    await run_in_threadpool(_record_regenerated_payment, session, user, po, merchant_order_id, amount_int, pay_resp)
 
     return {"merchantOrderId": merchant_order_id, "redirectUrl": pay_resp.get("redirectUrl"), "raw": pay_resp}
 
 
 @router.post("/orders/{po_id}/sync-payment-status")
-def sync_payment_status(
+async def sync_payment_status(
     po_id: int,
     session: Session = Depends(get_session),
     user: User = Depends(require_roles(Role.VENDOR)),
@@ -366,59 +349,48 @@ def sync_payment_status(
       - PENDING   -> pending_payment
       - FAILED    -> payment_failed
       - others    -> payment_<state_lower>
+    A final attempt (applied by the webhook / reconciler) is answered from the DB.
     """
-    po = session.get(PurchaseOrder, po_id)
-    if not po:
-        raise HTTPException(status_code=404, detail="Purchase order not found")
-    if po.vendor_id != user.id:
-        raise HTTPException(status_code=403, detail="Forbidden")
-
-    # find merchantOrderId from latest create_payment / create_payment_regen audit logs
-    stmt = select(AuditLog).where(AuditLog.user_id == user.id, AuditLog.action.in_(["create_payment", "create_payment_regen"])).order_by(AuditLog.id.desc())
-    logs = session.exec(stmt).all()
-    merchant_order_id = None
-    for log in logs:
-        try:
-            meta = json.loads(log.meta)
-        except Exception:
-            continue
-        if isinstance(meta, dict):
-            if "merchantOrderId" in meta:
-                merchant_order_id = meta["merchantOrderId"]
-                break
-            if "phonepe_response" in meta and isinstance(meta["phonepe_response"], dict):
-                nested = meta["phonepe_response"]
-                merchant_order_id = nested.get("merchantOrderId") or nested.get("merchantOrderID") or nested.get("merchantOrder")
-                if merchant_order_id:
-                    break
-
-    if not merchant_order_id:
-        raise HTTPException(status_code=404, detail="No merchantOrderId found for this PO. Create payment first or provide merchantOrderId.")
+    po, attempt = await run_in_threadpool(
+        _po_payment_attempt, session, user, po_id, None,
+        "No merchantOrderId found for this PO. Create payment first or provide merchantOrderId.",
+    )
+    merchant_order_id = attempt.merchant_order_id
+    if attempt.state in PaymentState.TERMINAL:
+        return {"po_id": po.id, "merchantOrderId": merchant_order_id, "gateway_state": attempt.state,
+                "updated_status": po.status, "source": "db"}
 
     # call PhonePe status
-    status_resp = _phonepe_check_status_by_merchant_order(merchant_order_id)
-    state = status_resp.get("state")
-
-    # map state to PO.status
-    if state == "COMPLETED":
-        po.status = "paid"
-    elif state == "FAILED":
-        po.status = "payment_failed"
-    elif state == "PENDING":
-        po.status = "pending_payment"
-    else:
-        po.status = f"payment_{str(state).lower()}" if state else po.status
-
     try:
-        session.add(po)
-        session.add(AuditLog(user_id=user.id, action="sync_payment_status", meta=json.dumps({"po_id": po.id, "merchantOrderId": merchant_order_id, "gateway_state": state, "raw": status_resp})))
-        session.commit()
-        session.refresh(po)
-    except Exception as e:
-        session.rollback()
-        raise HTTPException(status_code=500, detail=f"Failed to update PO status: {e}")
+        status_resp = await phonepe.check_status(merchant_order_id)
+    except phonepe.GatewayError as e:
+        raise _gateway_http_error(e)
+    state, po_status = await run_in_threadpool(_apply_payment_status, session, user, po, attempt, status_resp,
+                                               "sync_payment_status")
 
-    return {"po_id": po.id, "merchantOrderId": merchant_order_id, "gateway_state": state, "updated_status": po.status}
+    return {"po_id": po_id, "merchantOrderId": merchant_order_id, "gateway_state": state, "updated_status": po_status,
+            "source": "gateway"}
+
+
+@router.get("/admin/payment-gateway/metrics", dependencies=[Depends(require_roles(Role.MASTER, Role.ADMIN))])
+def payment_gateway_metrics(format: str = Query("json", regex="^(json|prometheus)$")):
+    """
+    PhonePe client metrics of this worker process: calls, errors by kind, retries,
+    latency histogram per operation, and circuit breaker state.
+    ?format=prometheus returns the text exposition format for scraping.
+    """
+    if format == "prometheus":
+        return PlainTextResponse(phonepe.METRICS.prometheus_text(), media_type="text/plain; version=0.0.4")
+    return phonepe.METRICS.snapshot()
+
+
+@router.get("/admin/payments/reconciliation", dependencies=[Depends(require_roles(Role.MASTER, Role.ADMIN, Role.ACCOUNTANT))])
+def payment_reconciliation_lag(session: Session = Depends(get_session)):
+    """
+    Background payment reconciler lag: non-terminal attempts, age of the oldest one,
+    age of the least recently reconciled one, and the last run's counters.
+    """
+    return payment_reconciler.lag(session)
 
 
 
@@ -426,32 +398,29 @@ def sync_payment_status(
 # ---------------- Admin/Staff view endpoints ----------------
 @router.get("/admin/orders", response_model=List[PurchaseOrderRead], dependencies=[Depends(require_roles(Role.MASTER, Role.ADMIN, Role.STAFF, Role.ACCOUNTANT))])
 def admin_list_orders(
+    response: Response,
     vendor_id: Optional[int] = Query(None, description="Filter by vendor id"),
     status: Optional[str] = Query(None, description="Filter by PO status"),
     date_from: Optional[datetime] = Query(None, description="Created_at >= (ISO datetime)"),
     date_to: Optional[datetime] = Query(None, description="Created_at <= (ISO datetime)"),
-    skip: int = Query(0, ge=0),
+    skip: int = Query(0, ge=0, description="Deprecated offset paging; prefer cursor"),
     limit: int = Query(100, ge=1, le=1000),
+    cursor: Optional[str] = Query(None, description="X-Next-Cursor header of the previous page"),
     session: Session = Depends(get_session),
     user: User = Depends(get_current_user)  # ensures authenticated & role check above
 ):
     """
     Admin/staff/accountant can list all vendor purchase orders.
-    Supports filtering by vendor_id, status and created_at date range, with pagination.
+    Supports filtering by vendor_id, status (comma separated for several) and created_at
+    date range. Newest first; pass the X-Next-Cursor response header back as ?cursor=.
     """
     stmt = select(PurchaseOrder)
     if vendor_id is not None:
         stmt = stmt.where(PurchaseOrder.vendor_id == vendor_id)
-    if status is not None:
-        stmt = stmt.where(PurchaseOrder.status == status)
-    if date_from is not None:
-        stmt = stmt.where(PurchaseOrder.created_at >= date_from)
-    if date_to is not None:
-        stmt = stmt.where(PurchaseOrder.created_at <= date_to)
-    stmt = stmt.order_by(PurchaseOrder.created_at.desc())
-
-    pos = session.exec(stmt.offset(skip).limit(limit)).all()
-    return [ _get_po_response(session, p) for p in pos ]
+    if skip and not cursor:
+        stmt = stmt.offset(skip)
+    pos = pagination.filtered_page(session, response, stmt, PurchaseOrder, status, date_from, date_to, limit, cursor)
+    return _get_pos_response(session, pos)
 
 
 @router.get("/admin/orders/{po_id}", response_model=PurchaseOrderRead, dependencies=[Depends(require_roles(Role.MASTER, Role.ADMIN, Role.STAFF, Role.ACCOUNTANT))])
@@ -470,48 +439,47 @@ from fastapi import Body
 @router.patch("/admin/orders/{po_id}", dependencies=[Depends(require_roles(Role.MASTER, Role.ADMIN, Role.STAFF))])
 def admin_patch_order(
     po_id: int,
-    payload: Optional[PurchaseOrderCreate] = None,
+    response: Response,
+    payload: Optional[PurchaseOrderUpdate] = None,
     status: Optional[str] = Body(None, embed=True, description="Optional status string"),
     session: Session = Depends(get_session),
     user: User = Depends(get_current_user),
+    if_match: Optional[str] = Header(None, alias="If-Match"),
 ):
     """
     Admin/Staff can patch PO: change status and/or replace items (if payload provided).
     Mirrors behaviour of purchases.update_po but exposed under admin path.
+    Send If-Match: "<version>" to get 409 instead of overwriting a concurrent change.
     """
     po = session.get(PurchaseOrder, po_id)
     if not po:
         raise HTTPException(status_code=404, detail="Purchase order not found")
+    current = lambda: _get_po_response(session, po)
+    check_if_match(po, if_match, current)
+    old_status = po.status
 
-    # Update status if provided (basic)
-    if status:
-        po.status = status
+    with versioned_write(session, po, current), vendor_spend.tracking(session, vendor_spend.PURCHASE_ORDER, [po.id]):
+        # Update status if provided (basic)
+        if status:
+            po.status = status
 
-    # If payload provided (items/expected_date), reuse purchases.update_po logic:
-    if payload and payload.items is not None:
-        # remove existing items
-        stmt = select(PurchaseItem).where(PurchaseItem.purchase_order_id == po.id)
-        for row in session.exec(stmt).all():
-            session.delete(row)
-        session.commit()
-        total = 0.0
-        for it in payload.items:
-            prod = session.get(Product, it.product_id)
-            if not prod:
-                session.rollback()
-                raise HTTPException(status_code=400, detail=f"Product id {it.product_id} not found")
-            pi = PurchaseItem(purchase_order_id=po.id, product_id=it.product_id, qty=it.qty, unit_price=it.unit_price)
-            total += float(it.qty) * float(it.unit_price)
-            session.add(pi)
-        po.total = total
+        # If payload provided (items/expected_date), reuse purchases.update_po logic:
+        if payload and payload.items is not None:
+            # only the differences are written; total is recomputed from the item rows in SQL
+            prices = order_items.product_prices(session, [it.product_id for it in payload.items])
+            order_items.patch_purchase_items(session, po, payload.items, prices)
 
-    if payload and payload.expected_date is not None:
-        po.expected_date = payload.expected_date
+        if payload and payload.expected_date is not None:
+            po.expected_date = payload.expected_date
 
-    session.add(po)
-    session.add(AuditLog(user_id=user.id, action="update_po", meta=json.dumps({"po_id": po.id, "status": po.status})))
-    session.commit()
+        session.add(po)
+        session.add(AuditLog(user_id=user.id, action="update_po", meta=json.dumps({"po_id": po.id, "status": po.status})))
     session.refresh(po)
+    if po.status != old_status:
+        events.publish(events.status_event("purchase_order", po.id, po.status, from_status=old_status,
+                                           vendor_id=po.vendor_id, actor_id=user.id,
+                                           driver_id=driver_assignments.current_driver(session, po.id)))
+    set_etag(response, po)
     return _get_po_response(session, po)
 
 
@@ -547,11 +515,18 @@ def vendor_or_staff_update_item_quantities(
         missing = [iid for iid in item_ids if iid not in found_ids]
         raise HTTPException(status_code=400, detail=f"PurchaseItem ids not found: {missing}")
 
+    pos = {
+        po.id: po
+        for po in session.exec(select(PurchaseOrder).where(PurchaseOrder.id.in_({it.purchase_order_id for it in items}))).all()
+    }
+    by_id = {it.id: it for it in items}
+
+    spend = vendor_spend.snapshot(session, vendor_spend.PURCHASE_ORDER, pos)
     affected_po_ids = set()
     updated = []
     for upd in payload.items:
-        pi = next(x for x in items if x.id == upd.id)
-        po = session.get(PurchaseOrder, pi.purchase_order_id)
+        pi = by_id[upd.id]
+        po = pos.get(pi.purchase_order_id)
         if not po:
             raise HTTPException(status_code=400, detail=f"PurchaseOrder {pi.purchase_order_id} not found")
         # vendor callers already enforced match; staff/admin allowed
@@ -572,36 +547,31 @@ def vendor_or_staff_update_item_quantities(
             session.add(pi)
 
             # 2) Create a history row
-            try:
-                history = PurchaseItemHistory(
-                    purchase_item_id=pi.id,
-                    purchase_order_id=pi.purchase_order_id,
-                    old_qty=old_qty,
-                    new_qty=new_qty,
-                    changed_by=user.id,
-                    reason=None  # optional: you can pass reason via payload if desired
-                )
-                session.add(history)
-            except Exception:
-                # don't block update if history insert fails, but log it into AuditLog
-                session.add(AuditLog(user_id=user.id, action="history_insert_failed", meta=json.dumps({"purchase_item_id": pi.id})))
+            history = PurchaseItemHistory(
+                purchase_item_id=pi.id,
+                purchase_order_id=pi.purchase_order_id,
+                old_qty=old_qty,
+                new_qty=new_qty,
+                changed_by=user.id,
+                reason=None  # optional: you can pass reason via payload if desired
+            )
+            session.add(history)
 
             # 3) AuditLog (existing)
             meta = {"po_id": pi.purchase_order_id, "purchase_item_id": pi.id, "old_qty": old_qty, "new_qty": new_qty, "by": user.id}
             session.add(AuditLog(user_id=user.id, action="update_item_qty", meta=json.dumps(meta)))
             updated.append({"item_id": pi.id, "old_qty": old_qty, "new_qty": new_qty})
-
-        affected_po_ids.add(pi.purchase_order_id)
-
-    # recalc totals for affected POs
-    for po_id in affected_po_ids:
-        stmt2 = select(PurchaseItem).where(PurchaseItem.purchase_order_id == po_id)
-        po_items = session.exec(stmt2).all()
-        total = sum((float(it.unit_price or 0.0) * float(it.qty or 0)) for it in po_items)
-        po = session.get(PurchaseOrder, po_id)
-        po.total = total
-        session.add(po)
-        session.add(AuditLog(user_id=user.id, action="recalc_total", meta=json.dumps({"po_id":po_id,"new_total":total,"by":user.id})))
+            affected_po_ids.add(pi.purchase_order_id)
+
+    # recalc totals for affected POs in one UPDATE ... SET total = (SELECT SUM(...))
+    if affected_po_ids:
+        totals.recompute_po_totals(session, affected_po_ids)
+        new_totals = session.exec(
+            select(PurchaseOrder.id, PurchaseOrder.total).where(PurchaseOrder.id.in_(affected_po_ids))
+        ).all()
+        for po_id, total in new_totals:
+            session.add(AuditLog(user_id=user.id, action="recalc_total", meta=json.dumps({"po_id": po_id, "new_total": total, "by": user.id})))
+        vendor_spend.apply_changes(session, spend, enforce=user.role == Role.VENDOR)
 
     session.commit()
     return {"updated": updated, "message": "Quantities updated"}
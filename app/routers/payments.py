@@ -0,0 +1,30 @@
+# app/routers/payments.py
+import redis
+from fastapi import APIRouter, Header, HTTPException, Request
+from typing import Optional
+
+from .. import payment_webhooks
+
+router = APIRouter(prefix="/api/payments", tags=["payments"])
+
+
+@router.post("/phonepe/webhook")
+async def phonepe_webhook(request: Request, authorization: Optional[str] = Header(None)):
+    """
+    PhonePe payment callback. Verified and queued only; PO / payment attempt
+    updates are applied by the webhook worker within a few seconds.
+    """
+    if not payment_webhooks.verify_authorization(authorization):
+        raise HTTPException(status_code=401, detail="Invalid webhook authorization")
+    try:
+        body = await request.json()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid JSON body")
+    if not isinstance(body, dict):
+        raise HTTPException(status_code=400, detail="Invalid callback body")
+    try:
+        payment_webhooks.enqueue(body)
+    except redis.RedisError:
+        # non-2xx makes PhonePe redeliver later
+        raise HTTPException(status_code=503, detail="Webhook queue unavailable")
+    return {"status": "queued"}
@@ -13,6 +13,7 @@ from ..models import (
 )
 from ..schemas import ProductRead
 from ..deps import require_roles
+from .. import availability
 from ..models import Role
 from sqlmodel import Session
 import os
@@ -136,6 +137,7 @@ def create_product(
     sl = StockLevel(product_id=prod.id, quantity=0)
     session.add(sl)
     session.commit()
+    availability.refresh(session, [prod.id])
 
     # create associations
     _attach_categories_and_tags(session, prod.id, category_ids_list, tag_ids_list)
@@ -356,6 +358,7 @@ def delete_product(
         # finally delete product
         session.delete(prod)
         session.commit()
+        availability.forget([product_id])
         return {"status": "deleted", "product_id": product_id, "hard": True}
     else:
         # soft delete
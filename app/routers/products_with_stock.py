@@ -9,6 +9,7 @@ from uuid import uuid4
 
 from ..database import get_session
 from ..deps import require_roles, get_current_user
+from .. import availability
 from ..models import (
     Product,
     StockLevel,
@@ -263,6 +264,8 @@ def create_product_with_stock(
         except Exception:
             session.rollback()
 
+    availability.refresh(session, [prod.id])
+
     # attach categories & tags
     try:
         _attach_categories_and_tags(session, prod.id, category_ids_list, tag_ids_list)
@@ -481,6 +484,8 @@ def update_product(
 
     session.commit()
     session.refresh(p)
+    if stocklevel_quantity is not None:
+        availability.refresh(session, [p.id])
 
     # build response similar to get_product
     sl = session.exec(select(StockLevel).where(StockLevel.product_id == p.id)).one_or_none()
@@ -584,6 +589,7 @@ def delete_product(
 
         session.delete(p)
         session.commit()
+        availability.forget([product_id])
         return {"status": "deleted", "product_id": product_id, "hard": True}
     except IntegrityError as ie:
         session.rollback()
@@ -667,6 +673,7 @@ def create_batch(payload: BatchCreateIn = Body(...), session: Session = Depends(
 
     session.commit()
     session.refresh(b)
+    availability.refresh(session, [b.product_id])
     return b
 
 @router.patch("/stock/batches/{batch_id}", response_model=BatchOut)
@@ -719,6 +726,8 @@ def update_batch(batch_id: int, payload: BatchUpdateIn = Body(...), session: Ses
 
     session.commit()
     session.refresh(b)
+    if delta != 0:
+        availability.refresh(session, [b.product_id])
     return b
 
 @router.delete("/stock/batches/{batch_id}")
@@ -752,6 +761,7 @@ def deactivate_batch(batch_id: int, session: Session = Depends(get_session), use
         pass
 
     session.commit()
+    availability.refresh(session, [b.product_id])
     return {"status": "deactivated", "batch_id": batch_id, "removed_qty": qty}
 
 @router.get("/stock/product/{product_id}/summary")
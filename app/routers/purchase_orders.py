@@ -1,25 +1,40 @@
 # app/routers/purchase_orders.py
 import json
+from datetime import datetime
 from typing import Optional, List, Any
 
-from fastapi import APIRouter, Body, Depends, HTTPException, Query
+import redis
+from fastapi import APIRouter, Body, Depends, Header, HTTPException, Query, Response
+from sqlalchemy import func, literal, union_all
 from sqlmodel import Session, select
 
 from app.database import get_session
 from app.deps import get_current_user, require_roles
-from app.models import AuditLog, PurchaseOrder, Role, User
+from app import audit, driver_assignments, events, pagination
+from app.concurrency import check_if_match, versioned_write, set_etag
+from app.config import settings
+from app.models import AuditLog, NewOrder, PurchaseOrder, Role, User
+from app.redis_client import redis_client
 
 router = APIRouter(prefix="/purchase-orders", tags=["PurchaseOrders"])
 
 
 # ---------------- workflow endpoints ----------------
+# Each transition is a versioned compare-and-swap; clients may send If-Match: "<version>".
+
+def _current_state(session: Session, po: PurchaseOrder):
+    from app.routers.purchases import _get_po_with_items
+    return lambda: _get_po_with_items(session, po)
+
 
 @router.post("/{po_id}/verify-payment", dependencies=[Depends(require_roles(Role.ACCOUNTANT, Role.ADMIN, Role.MASTER))])
 def accountant_verify_payment(
     po_id: int,
+    response: Response,
     note: Optional[str] = Body(None, description="Optional note from accountant"),
     session: Session = Depends(get_session),
     user: User = Depends(get_current_user),
+    if_match: Optional[str] = Header(None, alias="If-Match"),
 ):
     """
     Accountant / Admin / Master manually verifies payment for a PO.
@@ -28,29 +43,36 @@ def accountant_verify_payment(
     po = session.get(PurchaseOrder, po_id)
     if not po:
         raise HTTPException(status_code=404, detail="PurchaseOrder not found")
+    current = _current_state(session, po)
+    check_if_match(po, if_match, current)
+    old_status = po.status
 
     if po.status not in ("received", "pending_payment", "paid", "payment_failed", "payment_pending"):
         raise HTTPException(status_code=400, detail=f"Cannot verify payment from current status '{po.status}'")
 
-    po.status = "payment_verified"
-    session.add(po)
-
-    meta = {"po_id": po.id, "action": "verified_payment", "by": user.id}
-    if note:
-        meta["note"] = note
-    session.add(AuditLog(user_id=user.id, action="verify_payment", meta=json.dumps(meta)))
+    with versioned_write(session, po, current):
+        po.status = "payment_verified"
+        session.add(po)
 
-    session.commit()
-    session.refresh(po)
-    return {"status": "payment_verified", "po_id": po.id}
+        meta = {"po_id": po.id, "action": "verified_payment", "by": user.id}
+        if note:
+            meta["note"] = note
+        session.add(AuditLog(user_id=user.id, action="verify_payment", meta=json.dumps(meta)))
+    events.publish(events.status_event("purchase_order", po.id, po.status, from_status=old_status,
+                                       vendor_id=po.vendor_id, actor_id=user.id,
+                                       driver_id=driver_assignments.current_driver(session, po.id)))
+    set_etag(response, po)
+    return {"status": "payment_verified", "po_id": po.id, "version": po.version}
 
 
 @router.post("/{po_id}/mark-packed", dependencies=[Depends(require_roles(Role.STAFF, Role.ADMIN, Role.MASTER))])
 def staff_mark_packed(
     po_id: int,
+    response: Response,
     box_count: Optional[int] = Body(None, description="Optional: number of boxes/packages packed"),
     session: Session = Depends(get_session),
     user: User = Depends(get_current_user),
+    if_match: Optional[str] = Header(None, alias="If-Match"),
 ):
     """
     Staff marks the PO as packed. Requires status == 'payment_verified'.
@@ -58,38 +80,48 @@ def staff_mark_packed(
     po = session.get(PurchaseOrder, po_id)
     if not po:
         raise HTTPException(status_code=404, detail="PurchaseOrder not found")
+    current = _current_state(session, po)
+    check_if_match(po, if_match, current)
+    old_status = po.status
 
     if po.status != "payment_verified":
         raise HTTPException(status_code=400, detail=f"PO must be in 'payment_verified' to be packed (current: {po.status})")
 
-    po.status = "packed"
-    session.add(po)
+    with versioned_write(session, po, current):
+        po.status = "packed"
+        session.add(po)
 
-    meta = {"po_id": po.id, "action": "packed", "by": user.id}
-    if box_count is not None:
-        meta["box_count"] = box_count
-    session.add(AuditLog(user_id=user.id, action="pack_po", meta=json.dumps(meta)))
-
-    session.commit()
-    session.refresh(po)
-    return {"status": "packed", "po_id": po.id}
+        meta = {"po_id": po.id, "action": "packed", "by": user.id}
+        if box_count is not None:
+            meta["box_count"] = box_count
+        session.add(AuditLog(user_id=user.id, action="pack_po", meta=json.dumps(meta)))
+    events.publish(events.status_event("purchase_order", po.id, po.status, from_status=old_status,
+                                       vendor_id=po.vendor_id, actor_id=user.id,
+                                       driver_id=driver_assignments.current_driver(session, po.id)))
+    set_etag(response, po)
+    return {"status": "packed", "po_id": po.id, "version": po.version}
 
 
 @router.post("/{po_id}/assign-driver", dependencies=[Depends(require_roles(Role.ACCOUNTANT, Role.ADMIN, Role.MASTER))])
 def accountant_assign_driver(
     po_id: int,
+    response: Response,
     driver_id: int = Body(..., description="User.id of driver to assign"),
     eta_days: Optional[int] = Body(None, description="Optional ETA in days"),
     notes: Optional[str] = Body(None, description="Optional notes/instructions"),
     session: Session = Depends(get_session),
     user: User = Depends(get_current_user),
+    if_match: Optional[str] = Header(None, alias="If-Match"),
 ):
     """
-    Assign a driver to a packed PO. Stores assignment in AuditLog.
+    Assign a driver to a packed PO. Records a po_driver_assignment row (plus an AuditLog entry).
     """
     po = session.get(PurchaseOrder, po_id)
     if not po:
         raise HTTPException(status_code=404, detail="PurchaseOrder not found")
+    current = _current_state(session, po)
+    check_if_match(po, if_match, current)
+    old_status = po.status
 
     if po.status != "packed":
         raise HTTPException(status_code=400, detail=f"PO must be in 'packed' state before assigning driver (current: {po.status})")
@@ -98,27 +130,33 @@ def accountant_assign_driver(
     if not drv:
         raise HTTPException(status_code=404, detail="Driver user not found")
 
-    po.status = "driver_assigned"
-    session.add(po)
+    with versioned_write(session, po, current):
+        po.status = "driver_assigned"
+        session.add(po)
 
-    meta = {"po_id": po.id, "action": "assign_driver", "by": user.id, "driver_id": driver_id}
-    if eta_days is not None:
-        meta["eta_days"] = eta_days
-    if notes:
-        meta["notes"] = notes
+        meta = {"po_id": po.id, "action": "assign_driver", "by": user.id, "driver_id": driver_id}
+        if eta_days is not None:
+            meta["eta_days"] = eta_days
+        if notes:
+            meta["notes"] = notes
 
-    session.add(AuditLog(user_id=user.id, action="assign_driver", meta=json.dumps(meta)))
-    session.commit()
-    session.refresh(po)
-    return {"status": "driver_assigned", "po_id": po.id, "driver_id": driver_id}
+        session.add(AuditLog(user_id=user.id, action="assign_driver", meta=json.dumps(meta)))
+        driver_assignments.record_assignment(session, po.id, driver_id, assigned_by=user.id,
+                                             eta_days=eta_days, notes=notes)
+    events.publish(events.status_event("purchase_order", po.id, po.status, from_status=old_status,
+                                       vendor_id=po.vendor_id, actor_id=user.id, driver_id=driver_id))
+    set_etag(response, po)
+    return {"status": "driver_assigned", "po_id": po.id, "driver_id": driver_id, "version": po.version}
 
 
 @router.post("/{po_id}/ship", dependencies=[Depends(require_roles(Role.ACCOUNTANT, Role.ADMIN, Role.MASTER))])
 def mark_shipped(
     po_id: int,
+    response: Response,
     tracking_id: Optional[str] = Body(None, description="Optional tracking id / AWB"),
     session: Session = Depends(get_session),
     user: User = Depends(get_current_user),
+    if_match: Optional[str] = Header(None, alias="If-Match"),
 ):
     """
     Mark PO as shipped. Requires status == 'driver_assigned'.
@@ -126,79 +164,115 @@ def mark_shipped(
     po = session.get(PurchaseOrder, po_id)
     if not po:
         raise HTTPException(status_code=404, detail="PurchaseOrder not found")
+    current = _current_state(session, po)
+    check_if_match(po, if_match, current)
+    old_status = po.status
 
     if po.status != "driver_assigned":
         raise HTTPException(status_code=400, detail=f"PO must be in 'driver_assigned' to be shipped (current: {po.status})")
 
-    po.status = "shipped"
-    session.add(po)
-
-    meta = {"po_id": po.id, "action": "ship", "by": user.id}
-    if tracking_id:
-        meta["tracking_id"] = tracking_id
-    session.add(AuditLog(user_id=user.id, action="ship_po", meta=json.dumps(meta)))
+    with versioned_write(session, po, current):
+        po.status = "shipped"
+        session.add(po)
 
-    session.commit()
-    session.refresh(po)
-    return {"status": "shipped", "po_id": po.id, "tracking_id": tracking_id}
+        meta = {"po_id": po.id, "action": "ship", "by": user.id}
+        if tracking_id:
+            meta["tracking_id"] = tracking_id
+        session.add(AuditLog(user_id=user.id, action="ship_po", meta=json.dumps(meta)))
+        driver_assignments.mark_shipped(session, po.id)
+    events.publish(events.status_event("purchase_order", po.id, po.status, from_status=old_status,
+                                       vendor_id=po.vendor_id, actor_id=user.id,
+                                       driver_id=driver_assignments.current_driver(session, po.id)))
+    set_etag(response, po)
+    return {"status": "shipped", "po_id": po.id, "tracking_id": tracking_id, "version": po.version}
 
 
 # ---------------- dashboard helpers ----------------
 # These import _get_po_with_items at runtime to avoid circular imports.
 
-@router.get("/admin/pending/verify", dependencies=[Depends(require_roles(Role.ACCOUNTANT, Role.ADMIN, Role.MASTER))])
-def list_pending_verification(session: Session = Depends(get_session), limit: int = Query(100, le=1000)):
-    from app.routers.purchases import _get_po_with_items  # runtime import to avoid circular import
+# PO statuses behind each dashboard queue (lists below, badge counts in /admin/pending/counts)
+PENDING_QUEUES = {
+    "verify": ["received", "pending_payment", "payment_failed", "paid"],
+    "pack": ["payment_verified"],
+    "assign_driver": ["packed"],
+}
+COUNTS_CACHE_KEY = "dashboard:pending:counts"
 
-    stmt = select(PurchaseOrder).where(PurchaseOrder.status.in_(["received", "pending_payment", "payment_failed", "paid"]))
-    rows = session.exec(stmt.limit(limit)).all()
-    return {"count": len(rows), "results": [_get_po_with_items(session, p) for p in rows]}
+def _pending_page(session: Session, response: Response, statuses: List[str], limit: int, cursor: Optional[str]):
+    from app.routers.purchases import _get_pos_with_items  # runtime import to avoid circular import
 
+    stmt = select(PurchaseOrder).where(PurchaseOrder.status.in_(statuses))
+    rows, next_cursor = pagination.keyset_page(session, stmt, PurchaseOrder, limit, cursor)
+    pagination.set_next_cursor(response, next_cursor)
+    return {"count": len(rows), "results": _get_pos_with_items(session, rows), "next_cursor": next_cursor}
+
+
+@router.get("/admin/pending/verify", dependencies=[Depends(require_roles(Role.ACCOUNTANT, Role.ADMIN, Role.MASTER))])
+def list_pending_verification(response: Response, session: Session = Depends(get_session), limit: int = Query(100, le=1000),
+                              cursor: Optional[str] = Query(None)):
+    return _pending_page(session, response, PENDING_QUEUES["verify"], limit, cursor)
 
-@router.get("/admin/pending/pack", dependencies=[Depends(require_roles(Role.STAFF, Role.ADMIN, Role.MASTER))])
-def list_to_pack(session: Session = Depends(get_session), limit: int = Query(100, le=1000)):
-    from app.routers.purchases import _get_po_with_items
 
-    stmt = select(PurchaseOrder).where(PurchaseOrder.status == "payment_verified")
-    rows = session.exec(stmt.limit(limit)).all()
-    return {"count": len(rows), "results": [_get_po_with_items(session, p) for p in rows]}
+@router.get("/admin/pending/pack", dependencies=[Depends(require_roles(Role.STAFF, Role.ADMIN, Role.MASTER))])
+def list_to_pack(response: Response, session: Session = Depends(get_session), limit: int = Query(100, le=1000),
+                 cursor: Optional[str] = Query(None)):
+    return _pending_page(session, response, PENDING_QUEUES["pack"], limit, cursor)
 
 
 @router.get("/admin/pending/assign-driver", dependencies=[Depends(require_roles(Role.ACCOUNTANT, Role.ADMIN, Role.MASTER))])
-def list_to_assign_driver(session: Session = Depends(get_session), limit: int = Query(100, le=1000)):
-    from app.routers.purchases import _get_po_with_items
+def list_to_assign_driver(response: Response, session: Session = Depends(get_session), limit: int = Query(100, le=1000),
+                          cursor: Optional[str] = Query(None)):
+    return _pending_page(session, response, PENDING_QUEUES["assign_driver"], limit, cursor)
+
+
+def _status_counts(session: Session) -> dict:
+    """PO and NewOrder counts per status in one round trip (two GROUP BYs, UNION ALL)."""
+    stmt = union_all(
+        select(literal("po").label("kind"), PurchaseOrder.status, func.count().label("n")).group_by(PurchaseOrder.status),
+        select(literal("new_order").label("kind"), NewOrder.status, func.count().label("n")).group_by(NewOrder.status),
+    )
+    by_kind = {"po": {}, "new_order": {}}
+    for kind, status, n in session.execute(stmt).all():
+        by_kind[kind][status] = n
+    po = by_kind["po"]
+    return {
+        "queues": {name: sum(po.get(s, 0) for s in statuses) for name, statuses in PENDING_QUEUES.items()},
+        "purchase_orders": po,
+        "new_orders": by_kind["new_order"],
+        "generated_at": datetime.utcnow().isoformat(),
+    }
 
-    stmt = select(PurchaseOrder).where(PurchaseOrder.status == "packed")
-    rows = session.exec(stmt.limit(limit)).all()
-    return {"count": len(rows), "results": [_get_po_with_items(session, p) for p in rows]}
+
+@router.get("/admin/pending/counts", dependencies=[Depends(require_roles(Role.ACCOUNTANT, Role.STAFF, Role.ADMIN, Role.MASTER))])
+def pending_counts(session: Session = Depends(get_session)):
+    """
+    Badge counts for the dashboards: per-queue PO counts (same statuses as the
+    /admin/pending/* lists) plus PO and NewOrder counts per status. Shared across
+    workers for PENDING_COUNTS_CACHE_SECONDS; falls back to the DB when Redis is down.
+    """
+    try:
+        raw = redis_client.get(COUNTS_CACHE_KEY)
+        if raw:
+            return json.loads(raw)
+    except redis.RedisError:
+        pass
+    counts = _status_counts(session)
+    try:
+        redis_client.set(COUNTS_CACHE_KEY, json.dumps(counts), ex=max(1, settings.PENDING_COUNTS_CACHE_SECONDS))
+    except redis.RedisError:
+        pass
+    return counts
 
 
 @router.get("/driver/my-assignments", dependencies=[Depends(require_roles(Role.DRIVER))])
 def driver_my_assignments(session: Session = Depends(get_session), user: User = Depends(get_current_user), limit: int = Query(200, le=1000)):
     """
-    Return POs assigned to current driver by reading AuditLog entries (action='assign_driver').
+    Return POs assigned to (or shipped by) the current driver, newest assignment first.
     """
-    from app.routers.purchases import _get_po_with_items
-
-    stmt = select(AuditLog).where(AuditLog.action == "assign_driver").order_by(AuditLog.timestamp.desc())
-    rows = session.exec(stmt.limit(limit)).all()
+    from app.routers.purchases import _get_pos_with_items
 
-    assigned_po_ids: List[int] = []
-    for r in rows:
-        try:
-            meta = json.loads(r.meta) if r.meta else {}
-            if int(meta.get("driver_id", 0)) == int(user.id):
-                assigned_po_ids.append(int(meta.get("po_id")))
-        except Exception:
-            continue
-
-    # dedupe and fetch POs
-    assigned_po_ids = list(dict.fromkeys(assigned_po_ids))
-    results: List[Any] = []
-    for pid in assigned_po_ids:
-        po = session.get(PurchaseOrder, pid)
-        if po:
-            results.append(_get_po_with_items(session, po))
+    pos = session.exec(driver_assignments.driver_pos_stmt(user.id, limit)).all()
+    results = _get_pos_with_items(session, pos)
     return {"count": len(results), "results": results}
 
 
@@ -217,33 +291,20 @@ def get_purchase_order_status(
     if not po:
         raise HTTPException(status_code=404, detail="PurchaseOrder not found")
 
-    # fetch audit logs (descending by timestamp) and filter entries that reference this PO
-    stmt = select(AuditLog).order_by(AuditLog.timestamp.desc())
-    rows = session.exec(stmt.limit(200)).all()
-
     audit_entries: List[dict[str, Any]] = []
-    for r in rows:
+    for r in audit.entity_history(session, audit.PURCHASE_ORDER, po_id, limit=10):
         raw_meta = r.meta or ""
         try:
             meta = json.loads(raw_meta) if raw_meta else {}
         except Exception:
             meta = {}
-
-        po_in_meta = False
-        if isinstance(meta, dict) and int(meta.get("po_id", -1)) == int(po_id):
-            po_in_meta = True
-        else:
-            if f'"po_id": {po_id}' in raw_meta or f'"po_id":"{po_id}"' in raw_meta or f"'po_id': {po_id}" in raw_meta:
-                po_in_meta = True
-
-        if po_in_meta:
-            audit_entries.append({
-                "id": r.id,
-                "action": r.action,
-                "user_id": r.user_id,
-                "timestamp": getattr(r, "timestamp", None),
-                "meta": meta if meta else raw_meta,
-            })
+        audit_entries.append({
+            "id": r.id,
+            "action": r.action,
+            "user_id": r.user_id,
+            "timestamp": getattr(r, "timestamp", None),
+            "meta": meta if meta else raw_meta,
+        })
 
     return {
         "po_id": po.id,
@@ -251,5 +312,5 @@ def get_purchase_order_status(
         "status": getattr(po, "status", None),
         "total": getattr(po, "total", None),
         "last_updated": getattr(po, "updated_at", None) or getattr(po, "modified_at", None),
-        "recent_audit": audit_entries[:10],
+        "recent_audit": audit_entries,
     }
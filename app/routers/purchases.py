@@ -1,20 +1,21 @@
 # app/routers/purchase_orders.py
-from fastapi import APIRouter, Depends, HTTPException, status, Query
+from fastapi import APIRouter, Body, Depends, HTTPException, status, Query, Header, Response
 from sqlmodel import select
 from ..database import get_session
 from ..models import (
     PurchaseOrder,
     PurchaseItem,
-    StockLevel,
-    StockMovement,
     Product,
     AuditLog,
     User,
 )
-from ..schemas import PurchaseOrderCreate, PurchaseOrderRead, PurchaseItemRead
+from ..schemas import PurchaseOrderCreate, PurchaseOrderRead, PurchaseOrderUpdate, PurchaseItemRead, PurchaseReceive
 from ..deps import require_roles, get_current_user
+from .. import availability, driver_assignments, events, order_items, pagination, receiving, vendor_spend
+from ..concurrency import check_if_match, versioned_write, set_etag
 from ..models import Role
 from sqlmodel import Session
+from sqlalchemy.orm.exc import StaleDataError
 from typing import Optional, List
 from datetime import datetime
 
@@ -32,7 +33,7 @@ def _get_po_with_items(session: Session, po: PurchaseOrder):
     # fetch items
     stmt = select(PurchaseItem).where(PurchaseItem.purchase_order_id == po.id)
     items = session.exec(stmt).all()
-    items_read = [PurchaseItemRead(id=i.id, product_id=i.product_id, qty=i.qty, unit_price=i.unit_price) for i in items]
+    items_read = [PurchaseItemRead(id=i.id, product_id=i.product_id, qty=i.qty, unit_price=i.unit_price, received_qty=i.received_qty or 0) for i in items]
     return PurchaseOrderRead(
         id=po.id,
         vendor_id=po.vendor_id,
@@ -42,9 +43,36 @@ def _get_po_with_items(session: Session, po: PurchaseOrder):
         expected_date=po.expected_date,
         created_at=po.created_at,
         items=items_read,
+        version=po.version,
     )
 
 
+def _get_pos_with_items(session: Session, pos: List[PurchaseOrder]) -> List[PurchaseOrderRead]:
+    """_get_po_with_items for many POs: one IN query for all their items."""
+    if not pos:
+        return []
+    items_by_po = {p.id: [] for p in pos}
+    stmt = select(PurchaseItem).where(PurchaseItem.purchase_order_id.in_(list(items_by_po))).order_by(PurchaseItem.id)
+    for i in session.exec(stmt).all():
+        items_by_po[i.purchase_order_id].append(
+            PurchaseItemRead(id=i.id, product_id=i.product_id, qty=i.qty, unit_price=i.unit_price, received_qty=i.received_qty or 0)
+        )
+    return [
+        PurchaseOrderRead(
+            id=po.id,
+            vendor_id=po.vendor_id,
+            created_by=po.created_by,
+            status=po.status,
+            total=po.total,
+            expected_date=po.expected_date,
+            created_at=po.created_at,
+            items=items_by_po[po.id],
+            version=po.version,
+        )
+        for po in pos
+    ]
+
+
 @router.post("/", status_code=201, response_model=PurchaseOrderRead)
 def create_purchase_order(
     payload: PurchaseOrderCreate,
@@ -57,87 +85,96 @@ def create_purchase_order(
     👉 Product.price master table se uthaya jata hai.
     """
     vendor_id = user.id
+
+    # ✅ vendor price ignore, master price use karo (one IN query; 400 for unknown products)
+    prices = order_items.product_prices(session, [it.product_id for it in payload.items])
+    total = sum(it.qty * prices[it.product_id] for it in payload.items)
+    vendor_spend.charge(session, vendor_id, total, sum(int(it.qty) for it in payload.items))
+
     po = PurchaseOrder(
         vendor_id=vendor_id,
         created_by=user.id,
         status="placed",
-        total=0.0,
+        total=total,
         expected_date=payload.expected_date,
         created_at=datetime.utcnow(),
     )
     session.add(po)
-    session.commit()
-    session.refresh(po)
+    session.flush()  # assigns po.id; PO, items and the spend counter commit together
 
-    total = 0.0
     for it in payload.items:
-        prod = session.get(Product, it.product_id)
-        if not prod:
-            session.rollback()
-            raise HTTPException(status_code=400, detail=f"Product id {it.product_id} not found")
-
-        # ✅ vendor price ignore, master price use karo
-        used_price = float(prod.price or 0.0)
-
-        pi = PurchaseItem(
+        session.add(PurchaseItem(
             purchase_order_id=po.id,
             product_id=it.product_id,
             qty=it.qty,
-            unit_price=used_price,
-        )
-        total += it.qty * used_price
-        session.add(pi)
-
-    po.total = total
-    session.add(po)
+            unit_price=prices[it.product_id],
+        ))
 
     # audit log
     log = AuditLog(user_id=user.id, action="create_po", meta=f"po:{po.id},vendor:{vendor_id},total:{total}")
     session.add(log)
     session.commit()
     session.refresh(po)
+    events.publish(events.status_event("purchase_order", po.id, po.status, vendor_id=vendor_id, actor_id=user.id))
 
     return _get_po_with_items(session, po)
 
 
 @router.get("/me", response_model=List[PurchaseOrderRead])
-def list_my_orders(session: Session = Depends(get_session), user: User = Depends(require_roles(Role.VENDOR))):
-    stmt = select(PurchaseOrder).where(PurchaseOrder.vendor_id == user.id).order_by(PurchaseOrder.created_at.desc())
-    pos = session.exec(stmt).all()
-    return [ _get_po_with_items(session, p) for p in pos ]
+def list_my_orders(response: Response,
+                   status: Optional[str] = Query(None, description="Status, or several comma separated"),
+                   date_from: Optional[datetime] = Query(None, description="created_at >= (ISO datetime)"),
+                   date_to: Optional[datetime] = Query(None, description="created_at <= (ISO datetime)"),
+                   limit: int = Query(100, ge=1, le=1000),
+                   cursor: Optional[str] = Query(None, description="X-Next-Cursor of the previous page"),
+                   session: Session = Depends(get_session), user: User = Depends(require_roles(Role.VENDOR))):
+    stmt = select(PurchaseOrder).where(PurchaseOrder.vendor_id == user.id)
+    pos = pagination.filtered_page(session, response, stmt, PurchaseOrder, status, date_from, date_to, limit, cursor)
+    return _get_pos_with_items(session, pos)
 
 
 @router.get("/", response_model=List[PurchaseOrderRead])
-def list_orders(status: Optional[str] = Query(None), session: Session = Depends(get_session), user: User = Depends(require_roles(Role.STAFF, Role.ADMIN, Role.MASTER, Role.ACCOUNTANT))):
+def list_orders(response: Response,
+                status: Optional[str] = Query(None, description="Status, or several comma separated"),
+                vendor_id: Optional[int] = Query(None),
+                date_from: Optional[datetime] = Query(None, description="created_at >= (ISO datetime)"),
+                date_to: Optional[datetime] = Query(None, description="created_at <= (ISO datetime)"),
+                limit: int = Query(100, ge=1, le=1000),
+                cursor: Optional[str] = Query(None, description="X-Next-Cursor of the previous page"),
+                session: Session = Depends(get_session), user: User = Depends(require_roles(Role.STAFF, Role.ADMIN, Role.MASTER, Role.ACCOUNTANT))):
     stmt = select(PurchaseOrder)
-    if status:
-        stmt = stmt.where(PurchaseOrder.status == status)
-    stmt = stmt.order_by(PurchaseOrder.created_at.desc())
-    pos = session.exec(stmt).all()
-    return [ _get_po_with_items(session, p) for p in pos ]
+    if vendor_id is not None:
+        stmt = stmt.where(PurchaseOrder.vendor_id == vendor_id)
+    pos = pagination.filtered_page(session, response, stmt, PurchaseOrder, status, date_from, date_to, limit, cursor)
+    return _get_pos_with_items(session, pos)
 
 
 @router.get("/{po_id}", response_model=PurchaseOrderRead)
-def get_po(po_id: int, session: Session = Depends(get_session), user: User = Depends(get_current_user)):
+def get_po(po_id: int, response: Response, session: Session = Depends(get_session), user: User = Depends(get_current_user)):
     po = session.get(PurchaseOrder, po_id)
     if not po:
         raise HTTPException(status_code=404, detail="PO not found")
     # allow vendor to see only their own; staff/admin/master can view all
     if user.role == Role.VENDOR and po.vendor_id != user.id:
         raise HTTPException(status_code=403, detail="Forbidden")
+    set_etag(response, po)
     return _get_po_with_items(session, po)
 
 
 @router.patch("/{po_id}", response_model=PurchaseOrderRead)
-def update_po(po_id: int, payload: Optional[PurchaseOrderCreate] = None, session: Session = Depends(get_session), user: User = Depends(get_current_user)):
+def update_po(po_id: int, response: Response, payload: Optional[PurchaseOrderUpdate] = None, session: Session = Depends(get_session), user: User = Depends(get_current_user),
+              if_match: Optional[str] = Header(None, alias="If-Match")):
     """
     Vendor can update their own PO while status is 'placed'.
     Staff/Admin/Master can update PO while status is 'accepted' (for minor corrections) — they must have appropriate role.
-    Payload may include items (replace) and expected_date (optional).
+    Payload may include items (full list; matched by id or product_id) and expected_date (optional).
+    Send If-Match: "<version>" to fail with 409 instead of overwriting a concurrent edit.
     """
     po = session.get(PurchaseOrder, po_id)
     if not po:
         raise HTTPException(status_code=404, detail="PO not found")
+    current = lambda: _get_po_with_items(session, po)
+    check_if_match(po, if_match, current)
 
     # permission checks
     if user.role == Role.VENDOR:
@@ -150,125 +187,137 @@ def update_po(po_id: int, payload: Optional[PurchaseOrderCreate] = None, session
         if po.status not in ("placed", "accepted"):
             raise HTTPException(status_code=400, detail="PO not editable in current status")
 
-    # if items provided, replace existing items
-    if payload and payload.items is not None:
-        # delete existing items
-        stmt = select(PurchaseItem).where(PurchaseItem.purchase_order_id == po.id)
-        for row in session.exec(stmt).all():
-            session.delete(row)
-        session.commit()
-        total = 0.0
-        for it in payload.items:
-            prod = session.get(Product, it.product_id)
-            if not prod:
-                session.rollback()
-                raise HTTPException(status_code=400, detail=f"Product id {it.product_id} not found")
-            pi = PurchaseItem(purchase_order_id=po.id, product_id=it.product_id, qty=it.qty, unit_price=it.unit_price)
-            total += float(it.qty) * float(it.unit_price)
-            session.add(pi)
-        po.total = total
-
-    if payload and payload.expected_date is not None:
-        po.expected_date = payload.expected_date
+    with versioned_write(session, po, current), \
+            vendor_spend.tracking(session, vendor_spend.PURCHASE_ORDER, [po.id], enforce=user.role == Role.VENDOR):
+        # if items provided, sync them with the stored rows
+        if payload and payload.items is not None:
+            # only the differences are written; total is recomputed from the item rows in SQL
+            prices = order_items.product_prices(session, [it.product_id for it in payload.items])
+            order_items.patch_purchase_items(session, po, payload.items, prices)
 
-    session.add(po)
-    log = AuditLog(user_id=user.id, action="update_po", meta=f"po:{po.id}")
-    session.add(log)
-    session.commit()
+        if payload and payload.expected_date is not None:
+            po.expected_date = payload.expected_date
+
+        session.add(po)
+        log = AuditLog(user_id=user.id, action="update_po", meta=f"po:{po.id}")
+        session.add(log)
     session.refresh(po)
+    set_etag(response, po)
     return _get_po_with_items(session, po)
 
 
 @router.post("/{po_id}/accept")
-def accept_po(po_id: int, payload: Optional[PurchaseOrderCreate] = None, session: Session = Depends(get_session), user: User = Depends(require_roles(Role.STAFF, Role.ADMIN, Role.MASTER))):
+def accept_po(po_id: int, response: Response, payload: Optional[PurchaseOrderUpdate] = None, session: Session = Depends(get_session), user: User = Depends(require_roles(Role.STAFF, Role.ADMIN, Role.MASTER)),
+              if_match: Optional[str] = Header(None, alias="If-Match")):
     po = session.get(PurchaseOrder, po_id)
     if not po:
         raise HTTPException(status_code=404, detail="PO not found")
+    current = lambda: _get_po_with_items(session, po)
+    check_if_match(po, if_match, current)
+    old_status = po.status
     if po.status not in ("placed", "pending"):
         raise HTTPException(status_code=400, detail=f"PO cannot be accepted from status '{po.status}'")
 
-    # Staff may replace items at acceptance if payload provided
-    if payload and payload.items is not None:
-        stmt = select(PurchaseItem).where(PurchaseItem.purchase_order_id == po.id)
-        for row in session.exec(stmt).all():
-            session.delete(row)
-        session.commit()
-        total = 0.0
-        for it in payload.items:
-            prod = session.get(Product, it.product_id)
-            if not prod:
-                session.rollback()
-                raise HTTPException(status_code=400, detail=f"Product id {it.product_id} not found")
-            pi = PurchaseItem(purchase_order_id=po.id, product_id=it.product_id, qty=it.qty, unit_price=it.unit_price)
-            total += float(it.qty) * float(it.unit_price)
-            session.add(pi)
-        po.total = total
-
-    if payload and payload.expected_date is not None:
-        po.expected_date = payload.expected_date
-
-    po.status = "accepted"
-    session.add(po)
-    log = AuditLog(user_id=user.id, action="accept_po", meta=f"po:{po.id}")
-    session.add(log)
-    session.commit()
+    with versioned_write(session, po, current), vendor_spend.tracking(session, vendor_spend.PURCHASE_ORDER, [po.id]):
+        # Staff may replace items at acceptance if payload provided
+        if payload and payload.items is not None:
+            # only the differences are written; total is recomputed from the item rows in SQL
+            prices = order_items.product_prices(session, [it.product_id for it in payload.items])
+            order_items.patch_purchase_items(session, po, payload.items, prices)
+
+        if payload and payload.expected_date is not None:
+            po.expected_date = payload.expected_date
+
+        po.status = "accepted"
+        session.add(po)
+        log = AuditLog(user_id=user.id, action="accept_po", meta=f"po:{po.id}")
+        session.add(log)
     session.refresh(po)
-    return {"status": "accepted", "po_id": po.id, "total": po.total}
+    events.publish(events.status_event("purchase_order", po.id, po.status, from_status=old_status,
+                                       vendor_id=po.vendor_id, actor_id=user.id,
+                                       driver_id=driver_assignments.current_driver(session, po.id)))
+    set_etag(response, po)
+    return {"status": "accepted", "po_id": po.id, "total": po.total, "version": po.version}
 
 
 @router.post("/{po_id}/receive")
-def receive_po(po_id: int, session: Session = Depends(get_session), user: User = Depends(require_roles(Role.STAFF, Role.ADMIN, Role.MASTER))):
+def receive_po(po_id: int, response: Response, payload: Optional[PurchaseReceive] = Body(None),
+               session: Session = Depends(get_session), user: User = Depends(require_roles(Role.STAFF, Role.ADMIN, Role.MASTER)),
+               if_match: Optional[str] = Header(None, alias="If-Match")):
+    """
+    Book a goods receipt. Without a body everything still outstanding is received;
+    with lines only those quantities are, optionally with batch_no / expire_date
+    per line (creates StockBatch rows). The PO is 'partially_received' until all
+    ordered quantities are in, then 'received'.
+    """
     po = session.get(PurchaseOrder, po_id)
     if not po:
         raise HTTPException(status_code=404, detail="PO not found")
-    if po.status != "accepted":
-        raise HTTPException(status_code=400, detail="Only accepted PO can be received")
+    current = lambda: _get_po_with_items(session, po)
+    check_if_match(po, if_match, current)
+    old_status = po.status
+    if po.status not in receiving.RECEIVABLE_STATUSES:
+        raise HTTPException(status_code=400, detail="Only accepted or partially received PO can be received")
 
-    stmt = select(PurchaseItem).where(PurchaseItem.purchase_order_id == po_id)
+    stmt = select(PurchaseItem).where(PurchaseItem.purchase_order_id == po_id).order_by(PurchaseItem.id)
     items = session.exec(stmt).all()
-    try:
-        for it in items:
-            # ensure stocklevel
-            sl_stmt = select(StockLevel).where(StockLevel.product_id == it.product_id)
-            sl = session.exec(sl_stmt).one_or_none()
-            if not sl:
-                sl = StockLevel(product_id=it.product_id, quantity=0)
-                session.add(sl)
-                session.commit()
-                session.refresh(sl)
-            prev_qty = sl.quantity
-            sl.quantity += it.qty
-            session.add(sl)
-            mv = StockMovement(product_id=it.product_id, qty=it.qty, type="IN", ref=f"PO#{po.id}", performed_by=user.id)
-            session.add(mv)
-        po.status = "received"
-        session.add(po)
-        log = AuditLog(user_id=user.id, action="receive_po", meta=f"po:{po.id}")
-        session.add(log)
-        session.commit()
-    except Exception as e:
-        session.rollback()
-        raise HTTPException(status_code=500, detail=f"Failed to receive PO: {e}")
-    return {"status": "received", "po_id": po.id}
+    with versioned_write(session, po, current):
+        try:
+            receipt = receiving.receive(session, po, items, payload.lines if payload else None, user.id,
+                                        notes=payload.notes if payload else None)
+            received_qty = sum(receipt["qty_by_product"].values())
+            log = AuditLog(user_id=user.id, action="receive_po", meta=f"po:{po.id},qty:{received_qty}")
+            session.add(log)
+            session.flush()
+            # read before the commit expires the items
+            items_out = [{"id": it.id, "product_id": it.product_id, "qty": it.qty, "received_qty": it.received_qty} for it in items]
+        except (StaleDataError, HTTPException):
+            raise
+        except Exception as e:
+            session.rollback()
+            raise HTTPException(status_code=500, detail=f"Failed to receive PO: {e}")
+    availability.adjust(receipt["qty_by_product"])
+    if po.status != old_status:
+        events.publish(events.status_event("purchase_order", po.id, po.status, from_status=old_status,
+                                           vendor_id=po.vendor_id, actor_id=user.id,
+                                           driver_id=driver_assignments.current_driver(session, po.id)))
+    set_etag(response, po)
+    return {
+        "status": po.status,
+        "po_id": po.id,
+        "version": po.version,
+        "received_qty": received_qty,
+        "batches": receipt["batches"],
+        "items": items_out,
+    }
 
 
 @router.post("/{po_id}/dispatch")
-def dispatch_po(po_id: int, session: Session = Depends(get_session), user: User = Depends(require_roles(Role.ADMIN, Role.MASTER))):
+def dispatch_po(po_id: int, response: Response, session: Session = Depends(get_session), user: User = Depends(require_roles(Role.ADMIN, Role.MASTER)),
+                if_match: Optional[str] = Header(None, alias="If-Match")):
     po = session.get(PurchaseOrder, po_id)
     if not po:
         raise HTTPException(status_code=404, detail="PO not found")
+    current = lambda: _get_po_with_items(session, po)
+    check_if_match(po, if_match, current)
+    old_status = po.status
     if po.status != "received":
         raise HTTPException(status_code=400, detail="PO must be in 'received' state before dispatch")
-    po.status = "dispatched"
-    session.add(po)
-    log = AuditLog(user_id=user.id, action="dispatch_po", meta=f"po:{po.id}")
-    session.add(log)
-    session.commit()
-    return {"status": "dispatched", "po_id": po.id}
+    with versioned_write(session, po, current):
+        po.status = "dispatched"
+        session.add(po)
+        log = AuditLog(user_id=user.id, action="dispatch_po", meta=f"po:{po.id}")
+        session.add(log)
+    events.publish(events.status_event("purchase_order", po.id, po.status, from_status=old_status,
+                                       vendor_id=po.vendor_id, actor_id=user.id,
+                                       driver_id=driver_assignments.current_driver(session, po.id)))
+    set_etag(response, po)
+    return {"status": "dispatched", "po_id": po.id, "version": po.version}
 
 
 @router.post("/{po_id}/cancel")
-def cancel_po(po_id: int, session: Session = Depends(get_session), user: User = Depends(get_current_user)):
+def cancel_po(po_id: int, response: Response, session: Session = Depends(get_session), user: User = Depends(get_current_user),
+              if_match: Optional[str] = Header(None, alias="If-Match")):
     """
     Vendor can cancel their own PO while it's in 'placed' status.
     Staff/admin/master can cancel in other statuses if needed.
@@ -276,6 +325,9 @@ def cancel_po(po_id: int, session: Session = Depends(get_session), user: User =
     po = session.get(PurchaseOrder, po_id)
     if not po:
         raise HTTPException(status_code=404, detail="PO not found")
+    current = lambda: _get_po_with_items(session, po)
+    check_if_match(po, if_match, current)
+    old_status = po.status
 
     if user.role == Role.VENDOR:
         if po.vendor_id != user.id:
@@ -286,9 +338,13 @@ def cancel_po(po_id: int, session: Session = Depends(get_session), user: User =
         # staff/admin/master can cancel any PO
         pass
 
-    po.status = "cancelled"
-    session.add(po)
-    log = AuditLog(user_id=user.id, action="cancel_po", meta=f"po:{po.id}")
-    session.add(log)
-    session.commit()
-    return {"status": "cancelled", "po_id": po.id}
+    with versioned_write(session, po, current), vendor_spend.tracking(session, vendor_spend.PURCHASE_ORDER, [po.id]):
+        po.status = "cancelled"
+        session.add(po)
+        log = AuditLog(user_id=user.id, action="cancel_po", meta=f"po:{po.id}")
+        session.add(log)
+    events.publish(events.status_event("purchase_order", po.id, po.status, from_status=old_status,
+                                       vendor_id=po.vendor_id, actor_id=user.id,
+                                       driver_id=driver_assignments.current_driver(session, po.id)))
+    set_etag(response, po)
+    return {"status": "cancelled", "po_id": po.id, "version": po.version}
@@ -9,6 +9,7 @@ from ..models import StockBatch, Product
 from ..schemas import StockBatchCreate, StockBatchRead, StockConsumeIn
 from ..deps import require_roles
 from ..models import Role
+from .. import availability
 
 router = APIRouter(prefix="/api/stock", tags=["stock"])
 
@@ -120,3 +121,22 @@ def delete_batch(batch_id: int, session: Session = Depends(get_session), user =
     session.add(b)
     session.commit()
     return {"status": "deactivated", "batch_id": batch_id}
+
+# available-to-order qty (stock level minus open orders), served from the redis cache
+@router.get("/availability")
+def get_availability(
+    product_ids: str = Query(..., description="Comma separated product ids, e.g. 1,2,3"),
+    session: Session = Depends(get_session),
+    user = Depends(require_roles(Role.MASTER, Role.ADMIN, Role.STAFF, Role.ACCOUNTANT, Role.VENDOR)),
+):
+    try:
+        ids = [int(x) for x in product_ids.split(",") if x.strip()]
+    except ValueError:
+        raise HTTPException(status_code=400, detail="product_ids must be comma separated integers")
+    avail = availability.get_available(session, ids)
+    return [{"product_id": pid, "available": max(0, qty)} for pid, qty in avail.items()]
+
+# force a full cache rebuild from MySQL (also runs periodically in the background)
+@router.post("/availability/reconcile")
+def reconcile_availability(session: Session = Depends(get_session), user = Depends(require_roles(Role.MASTER, Role.ADMIN))):
+    return availability.reconcile(session)
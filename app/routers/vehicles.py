@@ -4,6 +4,7 @@ from ..database import get_session
 from ..models import Vehicle, User, Role
 from ..schemas import VehicleCreate, VehicleRead, VehicleUpdate
 from ..deps import get_current_user, require_roles
+from .. import routing
 from datetime import datetime
 from typing import List, Optional
 
@@ -60,6 +61,29 @@ def get_vehicle(vehicle_id: int, session: Session = Depends(get_session), user:
     return v
 
 
+# Delivery sequence for the vehicle's open orders (driver owns it OR admin/master/staff)
+@router.get("/{vehicle_id}/route")
+def get_vehicle_route(
+    vehicle_id: int,
+    start_lat: Optional[float] = Query(None, description="Override start point (default: vehicle lat/lng)"),
+    start_lng: Optional[float] = Query(None),
+    closed: bool = Query(False, description="Return to the start point at the end"),
+    session: Session = Depends(get_session),
+    user: User = Depends(get_current_user),
+):
+    v = session.get(Vehicle, vehicle_id)
+    if not v:
+        raise HTTPException(status_code=404, detail="Vehicle not found")
+    if user.role == Role.DRIVER and v.driver_id != user.id:
+        raise HTTPException(status_code=403, detail="Forbidden")
+    if user.role not in (Role.DRIVER, Role.ADMIN, Role.MASTER, Role.STAFF):
+        raise HTTPException(status_code=403, detail="Forbidden")
+    if (start_lat is None) != (start_lng is None):
+        raise HTTPException(status_code=400, detail="start_lat and start_lng must be given together")
+    start = (start_lat, start_lng) if start_lat is not None else None
+    return routing.plan_vehicle_route(session, v, start=start, closed=closed)
+
+
 # Update vehicle (driver can update their own vehicle; admin/master can update any)
 @router.patch("/{vehicle_id}", response_model=VehicleRead)
 def update_vehicle(vehicle_id: int, payload: VehicleUpdate, session: Session = Depends(get_session), user: User = Depends(get_current_user)):
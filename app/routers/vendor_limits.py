@@ -5,6 +5,7 @@ from ..database import get_session
 from ..models import VendorLimit, User, AuditLog, Role
 from ..schemas import VendorLimitCreate, VendorLimitRead
 from ..deps import get_current_user, require_roles
+from .. import vendor_spend
 from typing import List, Optional
 from datetime import datetime
 from sqlalchemy import desc
@@ -53,6 +54,16 @@ def assign_vendor_limit(payload: VendorLimitCreate, session: Session = Depends(g
 
 
 
+@router.get("/utilization", dependencies=[Depends(require_roles(Role.MASTER, Role.ADMIN, Role.ACCOUNTANT))])
+def vendor_limit_utilization(month: Optional[str] = Query(None, description="YYYY-MM, default current month"), session: Session = Depends(get_session)):
+    """
+    Month-to-date spend and boxes against the limit for every vendor with a limit or
+    orders in the month, most utilized first. Reads the vendor_month_spend rollup.
+    """
+    month = vendor_spend.parse_month(month)
+    return {"month": month, "vendors": vendor_spend.utilization(session, month)}
+
+
 @router.get("/{vendor_id}", response_model=List[VendorLimitRead])
 def get_vendor_limits_for_month(vendor_id: int, month: Optional[str] = Query(None, description="YYYY-MM or omit to get all"), session: Session = Depends(get_session), user: User = Depends(get_current_user)):
     # vendor can view only their own; admin/master can view any
@@ -0,0 +1,152 @@
+# app/routing.py
+"""
+Delivery route sequencing for a vehicle's stops.
+
+Builds a haversine distance matrix with NumPy (one vectorised pass over all
+stop pairs), seeds a route with nearest-neighbour from the start point and
+improves it with 2-opt (segment reversals, each pass vectorised over the
+second cut). Node 0 is always the start (vehicle position) and stays first.
+Routes are open paths by default; pass closed=True to return to the start.
+"""
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+from sqlmodel import Session, select
+
+from .models import NewOrder, Vehicle
+
+EARTH_RADIUS_M = 6371000.0
+ROUTE_STATUSES = ("placed", "processing", "dispatched")
+
+
+def distance_matrix(coords: Sequence[Tuple[float, float]]) -> np.ndarray:
+    """Pairwise great-circle distances in metres for (lat, lng) points in degrees."""
+    pts = np.radians(np.asarray(coords, dtype=float).reshape(-1, 2))
+    lat = pts[:, 0][:, None]
+    lng = pts[:, 1][:, None]
+    dlat = lat - lat.T
+    dlng = lng - lng.T
+    a = np.sin(dlat / 2.0) ** 2 + np.cos(lat) * np.cos(lat.T) * np.sin(dlng / 2.0) ** 2
+    return 2.0 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+
+def nearest_neighbour(dist: np.ndarray, start: int = 0) -> List[int]:
+    n = dist.shape[0]
+    visited = np.zeros(n, dtype=bool)
+    route = [start]
+    visited[start] = True
+    for _ in range(n - 1):
+        row = np.where(visited, np.inf, dist[route[-1]])
+        nxt = int(np.argmin(row))
+        route.append(nxt)
+        visited[nxt] = True
+    return route
+
+
+def route_length(route: Sequence[int], dist: np.ndarray, closed: bool = False) -> float:
+    r = np.asarray(route)
+    total = float(dist[r[:-1], r[1:]].sum()) if len(r) > 1 else 0.0
+    if closed and len(r) > 1:
+        total += float(dist[r[-1], r[0]])
+    return total
+
+
+def two_opt(route: Sequence[int], dist: np.ndarray, closed: bool = False, max_passes: int = 50) -> List[int]:
+    """
+    Improve a route by reversing segments route[i..j] (i >= 1, so the start stays put).
+    For each i the gain of every j is evaluated at once; the best improving j is applied.
+    """
+    r = np.asarray(route, dtype=int)
+    n = len(r)
+    if n < 4:
+        return r.tolist()
+    for _ in range(max_passes):
+        improved = False
+        for i in range(1, n - 1):
+            a, b = r[i - 1], r[i]
+            js = np.arange(i + 1, n)
+            c = r[js]
+            if closed:
+                d = r[(js + 1) % n]
+                old_tail = dist[c, d]
+                new_tail = dist[b, d]
+            else:
+                # reversing up to the last stop leaves no edge after the segment
+                has_next = js + 1 < n
+                d = r[np.minimum(js + 1, n - 1)]
+                old_tail = np.where(has_next, dist[c, d], 0.0)
+                new_tail = np.where(has_next, dist[b, d], 0.0)
+            gain = dist[a, b] + old_tail - dist[a, c] - new_tail
+            k = int(np.argmax(gain))
+            if gain[k] > 1e-6:
+                j = int(js[k])
+                r[i:j + 1] = r[i:j + 1][::-1]
+                improved = True
+        if not improved:
+            break
+    return r.tolist()
+
+
+def sequence(coords: Sequence[Tuple[float, float]], closed: bool = False) -> Tuple[List[int], np.ndarray]:
+    """Visit order for coords (index 0 = start) and the distance matrix used."""
+    dist = distance_matrix(coords)
+    route = two_opt(nearest_neighbour(dist, 0), dist, closed=closed)
+    return route, dist
+
+
+def plan_vehicle_route(session: Session, vehicle: Vehicle, start: Optional[Tuple[float, float]] = None,
+                       closed: bool = False) -> dict:
+    """
+    Sequence the vehicle's open orders. Stops are the orders' delivery coordinates;
+    the route starts at `start`, else the vehicle's stored lat/lng, else the first stop.
+    Orders without coordinates are listed under `unlocated`.
+    """
+    orders = session.exec(
+        select(NewOrder)
+        .where(NewOrder.vehicle_id == vehicle.id, NewOrder.status.in_(ROUTE_STATUSES))
+        .order_by(NewOrder.id)
+    ).all()
+    located = [o for o in orders if o.delivery_lat is not None and o.delivery_lng is not None]
+    located_ids = {o.id for o in located}
+    unlocated = [o.id for o in orders if o.id not in located_ids]
+
+    if start is None and vehicle.lat is not None and vehicle.lng is not None:
+        start = (vehicle.lat, vehicle.lng)
+    result = {
+        "vehicle_id": vehicle.id,
+        "start": {"lat": start[0], "lng": start[1]} if start else None,
+        "closed": closed,
+        "total_distance_km": 0.0,
+        "stops": [],
+        "unlocated": unlocated,
+    }
+    if not located:
+        return result
+
+    coords = [(o.delivery_lat, o.delivery_lng) for o in located]
+    if start is not None:
+        route, dist = sequence([start] + coords, closed=closed)
+        stop_nodes = route[1:]
+        order_at = lambda node: located[node - 1]
+    else:
+        route, dist = sequence(coords, closed=closed)
+        stop_nodes = route
+        order_at = lambda node: located[node]
+
+    prev = route[0]
+    stops = []
+    for seq, node in enumerate(stop_nodes, start=1):
+        o = order_at(node)
+        stops.append({
+            "seq": seq,
+            "order_id": o.id,
+            "vendor_id": o.vendor_id,
+            "lat": o.delivery_lat,
+            "lng": o.delivery_lng,
+            "shipping_address": o.shipping_address,
+            "leg_km": round(float(dist[prev, node]) / 1000.0, 3),
+        })
+        prev = node
+    result["stops"] = stops
+    result["total_distance_km"] = round(route_length(route, dist, closed) / 1000.0, 3)
+    return result
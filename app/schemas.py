@@ -129,11 +129,31 @@ class PurchaseItemIn(BaseModel):
 
 class PurchaseItemRead(PurchaseItemIn):
     id: int
+    received_qty: int = 0
 
 class PurchaseOrderCreate(BaseModel):
     items: List[PurchaseItemIn]
     expected_date: Optional[datetime] = None
 
+class PurchaseItemUpdate(PurchaseItemIn):
+    id: Optional[int] = None  # existing item id; lines without one are matched by product_id
+
+class PurchaseOrderUpdate(BaseModel):
+    items: Optional[List[PurchaseItemUpdate]] = None  # full item list; only the differences are written
+    expected_date: Optional[datetime] = None
+
+class PurchaseReceiveLine(BaseModel):
+    item_id: Optional[int] = None      # PO item id; or give product_id to match by product
+    product_id: Optional[int] = None
+    qty: int
+    batch_no: Optional[str] = None     # batch_no / expire_date create a StockBatch for this line
+    expire_date: Optional[datetime] = None
+    unit: Optional[str] = "pcs"
+
+class PurchaseReceive(BaseModel):
+    lines: Optional[List[PurchaseReceiveLine]] = None  # omitted: receive everything still outstanding
+    notes: Optional[str] = None
+
 class PurchaseOrderRead(BaseModel):
     id: int
     vendor_id: int
@@ -143,6 +163,7 @@ class PurchaseOrderRead(BaseModel):
     expected_date: Optional[datetime] = None
     created_at: datetime
     items: List[PurchaseItemRead]
+    version: int = 1
 
 
 
@@ -308,6 +329,8 @@ class NewOrderCreate(BaseModel):
     items: List[NewOrderItemCreate]
     shipping_address: Optional[str] = None
     notes: Optional[str] = None
+    delivery_lat: Optional[float] = None
+    delivery_lng: Optional[float] = None
 
 class NewOrderItemRead(BaseModel):
     id: int
@@ -329,21 +352,65 @@ class NewOrderRead(BaseModel):
     items: List[NewOrderItemRead]
     shipping_address: Optional[str] = None
     notes: Optional[str] = None
+    delivery_lat: Optional[float] = None
+    delivery_lng: Optional[float] = None
     vehicle_id: Optional[int] = None
     verified: bool = False
     verified_by: Optional[int] = None
     verified_at: Optional[datetime] = None
+    version: int = 1
 
     class Config:
         orm_mode = True
 
+class ExpandedProduct(BaseModel):
+    id: int
+    sku: str
+    name: str
+    price: float
+    weight: Optional[float] = None
+    gst_rate: float = 0.0
+    image_url: Optional[str] = None
+    active: bool = True
+    stocklevel_quantity: int = 0
+
+class NewOrderDetailRead(NewOrderRead):
+    """NewOrderRead plus the rows it references, filled in per ?expand=products,vehicle,users."""
+    last_modified_by: Optional[int] = None
+    last_modified_at: Optional[datetime] = None
+    products: Optional[List[ExpandedProduct]] = None
+    vehicle: Optional[VehicleRead] = None
+    users: Optional[List[UserRead]] = None
+
+class NewOrderItemUpdate(NewOrderItemCreate):
+    id: Optional[int] = None  # existing item id; lines without one are matched by product_id
+
 class NewOrderUpdateIn(BaseModel):
-    items: Optional[List[NewOrderItemCreate]] = None  # replace item list if provided
+    items: Optional[List[NewOrderItemUpdate]] = None  # full item list; only the differences are written
     shipping_address: Optional[str] = None
     notes: Optional[str] = None
+    delivery_lat: Optional[float] = None
+    delivery_lng: Optional[float] = None
     status: Optional[str] = None
 
 
+class NewOrderBulkStatusIn(BaseModel):
+    order_ids: List[int]
+    status: str
+    all_or_nothing: bool = False  # reject the whole set if any order cannot make the transition
+
+class NewOrderStatusOutcome(BaseModel):
+    order_id: int
+    outcome: str                  # updated / unchanged / invalid_transition / not_found / conflict
+    from_status: Optional[str] = None
+    version: Optional[int] = None
+
+class NewOrderBulkStatusOut(BaseModel):
+    status: str
+    updated: int
+    results: List[NewOrderStatusOutcome]
+
+
 
 class InvoiceItemIn(BaseModel):
     sku: str
@@ -0,0 +1,80 @@
+# app/totals.py
+"""
+Order totals recomputed by the database from the item rows.
+
+    NewOrder.total_amount = SUM(new_order_item.subtotal)
+    PurchaseOrder.total   = SUM(purchaseitem.qty * purchaseitem.unit_price)
+
+Two ways in, depending on whether the caller holds the parent as a versioned
+ORM object:
+
+    assign_new_order_total(order) / assign_po_total(po)
+        sets the attribute to the SUM sub-select, so it is evaluated inside the
+        parent's own compare-and-swap UPDATE at flush.
+
+    recompute_new_order_totals(session, ids) / recompute_po_totals(session, ids)
+        one UPDATE ... SET total = (SELECT SUM(...)) WHERE id IN (...) for any
+        number of parents; bumps their version like any other write.
+
+Nothing here commits.
+"""
+from typing import Iterable
+
+from sqlalchemy import func, update
+from sqlmodel import Session, select
+
+from .models import NewOrder, NewOrderItem, PurchaseItem, PurchaseOrder
+
+
+def _new_order_sum(order_id_col):
+    t = NewOrderItem.__table__
+    return (
+        select(func.coalesce(func.sum(t.c.subtotal), 0.0))
+        .where(t.c.new_order_id == order_id_col)
+        .scalar_subquery()
+    )
+
+
+def _po_sum(po_id_col):
+    t = PurchaseItem.__table__
+    return (
+        select(func.coalesce(func.sum(t.c.qty * t.c.unit_price), 0.0))
+        .where(t.c.purchase_order_id == po_id_col)
+        .scalar_subquery()
+    )
+
+
+def assign_new_order_total(order: NewOrder):
+    order.total_amount = _new_order_sum(order.id)
+
+
+def assign_po_total(po: PurchaseOrder):
+    po.total = _po_sum(po.id)
+
+
+def recompute_new_order_totals(session: Session, order_ids: Iterable[int]) -> int:
+    ids = list({int(i) for i in order_ids})
+    if not ids:
+        return 0
+    session.flush()  # Core statements don't autoflush; pending item edits must land first
+    t = NewOrder.__table__
+    res = session.execute(
+        update(t)
+        .where(t.c.id.in_(ids))
+        .values(total_amount=_new_order_sum(t.c.id), version=t.c.version + 1)
+    )
+    return res.rowcount
+
+
+def recompute_po_totals(session: Session, po_ids: Iterable[int]) -> int:
+    ids = list({int(i) for i in po_ids})
+    if not ids:
+        return 0
+    session.flush()
+    t = PurchaseOrder.__table__
+    res = session.execute(
+        update(t)
+        .where(t.c.id.in_(ids))
+        .values(total=_po_sum(t.c.id), version=t.c.version + 1)
+    )
+    return res.rowcount
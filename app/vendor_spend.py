@@ -0,0 +1,302 @@
+# app/vendor_spend.py
+"""
+Monthly vendor limits (VendorLimit) enforced against a rollup of month-to-date spend.
+
+vendor_month_spend holds one row per (vendor, "YYYY-MM") with the value and
+boxes (sum of item qty) of the vendor's NewOrders and POs created that month,
+cancelled ones excluded. It is maintained incrementally, in the same transaction
+as the order write, so a rolled back order never leaves a counter behind:
+
+    charge(session, vendor_id, amount, boxes)      # order / PO creation
+    with tracking(session, NEW_ORDER, [order.id]):  # edits, cancellations
+        ... mutate ...                             # (or snapshot() ... apply_changes())
+
+charge() and enforcing tracking() add with a single guarded UPDATE
+(... WHERE amount + :a <= :limit), so concurrent orders of one vendor cannot
+overshoot together; when the guard fails the caller gets 400. A row
+that does not exist yet is seeded once from the order tables (GROUP BY for that
+vendor and month) — that is also how months from before the rollup get picked up.
+
+Limits: a VendorLimit row for the month wins over the vendor's row without a
+month (the standing limit). 0 means no limit on that dimension.
+
+    python -m app.vendor_spend [YYYY-MM]    # rebuild a month from the order tables
+"""
+import re
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from fastapi import HTTPException
+from sqlalchemy import bindparam, func, insert, or_, update
+from sqlalchemy.exc import IntegrityError
+from sqlmodel import Session, select
+
+from .models import NewOrder, NewOrderItem, PurchaseItem, PurchaseOrder, User, VendorLimit, VendorMonthSpend
+
+NEW_ORDER = "new_order"
+PURCHASE_ORDER = "purchase_order"
+EXCLUDED_STATUSES = ("cancelled",)
+
+# kind -> (order model, value column, item model, item -> order fk)
+_SOURCES = {
+    NEW_ORDER: (NewOrder, NewOrder.total_amount, NewOrderItem, NewOrderItem.new_order_id),
+    PURCHASE_ORDER: (PurchaseOrder, PurchaseOrder.total, PurchaseItem, PurchaseItem.purchase_order_id),
+}
+
+_EPS = 0.005  # amounts are rupees; don't reject on float noise below a paisa
+
+Totals = Tuple[float, int]  # (amount, boxes)
+
+
+def month_of(ts: Optional[datetime] = None) -> str:
+    return (ts or datetime.utcnow()).strftime("%Y-%m")
+
+
+def parse_month(month: Optional[str]) -> str:
+    if month is None:
+        return month_of()
+    if not re.fullmatch(r"\d{4}-(0[1-9]|1[0-2])", month):
+        raise HTTPException(status_code=400, detail="month must be YYYY-MM")
+    return month
+
+
+def _month_range(month: str) -> Tuple[datetime, datetime]:
+    year, mon = int(month[:4]), int(month[5:7])
+    start = datetime(year, mon, 1)
+    end = datetime(year + mon // 12, mon % 12 + 1, 1)
+    return start, end
+
+
+# --------------------------------------------------------------------------
+# limits
+# --------------------------------------------------------------------------
+def limits_for(session: Session, month: str, vendor_ids: Optional[Iterable[int]] = None) -> Dict[int, dict]:
+    """vendor_id -> {limit_amount, limit_boxes, source: "month" | "default"} (one query)."""
+    stmt = select(VendorLimit).where(or_(VendorLimit.month == month, VendorLimit.month.is_(None)))
+    if vendor_ids is not None:
+        stmt = stmt.where(VendorLimit.vendor_id.in_(list(vendor_ids)))
+    out: Dict[int, dict] = {}
+    for lim in session.exec(stmt).all():
+        source = "month" if lim.month else "default"
+        if lim.vendor_id in out and out[lim.vendor_id]["source"] == "month":
+            continue
+        out[lim.vendor_id] = {"limit_amount": float(lim.limit_amount or 0.0),
+                              "limit_boxes": int(lim.limit_boxes or 0), "source": source}
+    return out
+
+
+# --------------------------------------------------------------------------
+# totals from the order tables (seeding / rebuild / utilization fallback)
+# --------------------------------------------------------------------------
+def compute_totals(session: Session, month: str, vendor_ids: Optional[Iterable[int]] = None) -> Dict[int, Totals]:
+    """Month totals per vendor straight from the order tables: two GROUP BY queries per source."""
+    start, end = _month_range(month)
+    ids = list(vendor_ids) if vendor_ids is not None else None
+    totals: Dict[int, List] = defaultdict(lambda: [0.0, 0])
+    for order, value_col, item, fk in _SOURCES.values():
+        where = [order.created_at >= start, order.created_at < end, order.status.not_in(EXCLUDED_STATUSES)]
+        if ids is not None:
+            where.append(order.vendor_id.in_(ids))
+        for vid, amount in session.exec(
+            select(order.vendor_id, func.coalesce(func.sum(value_col), 0.0)).where(*where).group_by(order.vendor_id)
+        ).all():
+            totals[vid][0] += float(amount or 0.0)
+        for vid, boxes in session.exec(
+            select(order.vendor_id, func.coalesce(func.sum(item.qty), 0))
+            .join(item, fk == order.id).where(*where).group_by(order.vendor_id)
+        ).all():
+            totals[vid][1] += int(boxes or 0)
+    return {vid: (a, b) for vid, (a, b) in totals.items()}
+
+
+def _ensure_row(session: Session, vendor_id: int, month: str) -> bool:
+    """Create the vendor's row for the month if missing, seeded from the order tables. True if created."""
+    exists = session.exec(
+        select(VendorMonthSpend.id).where(VendorMonthSpend.vendor_id == vendor_id, VendorMonthSpend.month == month)
+    ).first()
+    if exists is not None:
+        return False
+    amount, boxes = compute_totals(session, month, [vendor_id]).get(vendor_id, (0.0, 0))
+    try:
+        with session.begin_nested():
+            session.execute(insert(VendorMonthSpend.__table__).values(
+                vendor_id=vendor_id, month=month, amount=amount, boxes=boxes, updated_at=datetime.utcnow()))
+    except IntegrityError:
+        return False  # a concurrent request seeded it first
+    return True
+
+
+# --------------------------------------------------------------------------
+# incremental updates
+# --------------------------------------------------------------------------
+def _add(session: Session, vendor_id: int, month: str, amount: float, boxes: int, enforce: bool):
+    t = VendorMonthSpend.__table__
+    stmt = (
+        update(t)
+        .where(t.c.vendor_id == vendor_id, t.c.month == month)
+        .values(amount=t.c.amount + amount, boxes=t.c.boxes + boxes, updated_at=datetime.utcnow())
+    )
+    lim = limits_for(session, month, [vendor_id]).get(vendor_id) if enforce else None
+    if lim:
+        # only growth is checked; shrinking an order over a lowered limit is always allowed
+        if amount > 0 and lim["limit_amount"] > 0:
+            stmt = stmt.where(t.c.amount + amount <= lim["limit_amount"] + _EPS)
+        if boxes > 0 and lim["limit_boxes"] > 0:
+            stmt = stmt.where(t.c.boxes + boxes <= lim["limit_boxes"])
+    if session.execute(stmt).rowcount or not lim:
+        return
+    spent_amount, spent_boxes = session.exec(
+        select(VendorMonthSpend.amount, VendorMonthSpend.boxes)
+        .where(VendorMonthSpend.vendor_id == vendor_id, VendorMonthSpend.month == month)
+    ).one()
+    raise HTTPException(status_code=400, detail={
+        "message": f"Monthly purchase limit for {month} exceeded",
+        "month": month,
+        "limit_amount": lim["limit_amount"], "spent_amount": round(spent_amount, 2), "requested_amount": round(amount, 2),
+        "limit_boxes": lim["limit_boxes"], "spent_boxes": spent_boxes, "requested_boxes": boxes,
+    })
+
+
+def charge(session: Session, vendor_id: int, amount: float, boxes: int, at: Optional[datetime] = None):
+    """
+    Count a new order / PO that is about to be inserted (call before adding it).
+    400 if it would take the vendor past its monthly limit.
+    """
+    month = month_of(at)
+    _ensure_row(session, vendor_id, month)
+    _add(session, vendor_id, month, float(amount), int(boxes), enforce=True)
+
+
+def _usage(session: Session, kind: str, ids: List[int]) -> Dict[int, Tuple[int, str, float, int]]:
+    """order id -> (vendor_id, month, counted amount, counted boxes); 0/0 when cancelled."""
+    order, value_col, item, fk = _SOURCES[kind]
+    boxes = select(fk.label("oid"), func.sum(item.qty).label("boxes")).where(fk.in_(ids)).group_by(fk).subquery()
+    rows = session.exec(
+        select(order.id, order.vendor_id, order.created_at, order.status, value_col, func.coalesce(boxes.c.boxes, 0))
+        .outerjoin(boxes, boxes.c.oid == order.id)
+        .where(order.id.in_(ids))
+    ).all()
+    out = {}
+    for oid, vid, created_at, status, amount, n in rows:
+        counted = status not in EXCLUDED_STATUSES
+        out[oid] = (vid, month_of(created_at), float(amount or 0.0) if counted else 0.0, int(n or 0) if counted else 0)
+    return out
+
+
+def snapshot(session: Session, kind: str, ids: Iterable[int]) -> Tuple[str, Dict[int, tuple]]:
+    """Counted value / boxes of existing orders (kind NEW_ORDER) or POs (PURCHASE_ORDER) before an edit."""
+    ids = list({int(i) for i in ids})
+    return kind, (_usage(session, kind, ids) if ids else {})
+
+
+def apply_changes(session: Session, snap: Tuple[str, Dict[int, tuple]], enforce: bool = False):
+    """
+    After the edit (item changes, cancellation): add whatever the snapshotted
+    orders' counted value / boxes moved by. enforce=True rejects growth past the
+    limit (vendor edits). Call before the commit so it lands with the edit.
+    """
+    kind, before = snap
+    if not before:
+        return
+    after = _usage(session, kind, list(before))  # autoflushes the pending edits
+    deltas: Dict[Tuple[int, str], List] = defaultdict(lambda: [0.0, 0])
+    for oid, (vid, month, amount, boxes) in after.items():
+        _, _, old_amount, old_boxes = before[oid]
+        deltas[(vid, month)][0] += amount - old_amount
+        deltas[(vid, month)][1] += boxes - old_boxes
+    for (vid, month), (d_amount, d_boxes) in deltas.items():
+        if abs(d_amount) < _EPS and d_boxes == 0:
+            continue
+        if _ensure_row(session, vid, month):
+            continue  # just seeded from the rows as they are now, edit included
+        _add(session, vid, month, d_amount, d_boxes, enforce=enforce)
+
+
+@contextmanager
+def tracking(session: Session, kind: str, ids: Iterable[int], enforce: bool = False):
+    """snapshot + apply_changes around a block; use inside versioned_write so it commits with the edit."""
+    snap = snapshot(session, kind, ids)
+    yield
+    apply_changes(session, snap, enforce=enforce)
+
+
+# --------------------------------------------------------------------------
+# reporting / repair
+# --------------------------------------------------------------------------
+def _pct(used: float, limit: float) -> Optional[float]:
+    return round(used * 100.0 / limit, 1) if limit > 0 else None
+
+
+def utilization(session: Session, month: str) -> List[dict]:
+    """Every vendor with a limit or spend in the month, most utilized first (a fixed handful of queries)."""
+    limits = limits_for(session, month)
+    spend = {vid: (float(a), int(b)) for vid, a, b in session.exec(
+        select(VendorMonthSpend.vendor_id, VendorMonthSpend.amount, VendorMonthSpend.boxes)
+        .where(VendorMonthSpend.month == month)
+    ).all()}
+    # vendors with a limit but no row yet (no order since the rollup started): read the order tables
+    missing = [vid for vid in limits if vid not in spend]
+    if missing:
+        spend.update(compute_totals(session, month, missing))
+    vendor_ids = set(limits) | set(spend)
+    if not vendor_ids:
+        return []
+    names = dict(session.exec(select(User.id, User.name).where(User.id.in_(list(vendor_ids)))).all())
+
+    rows = []
+    for vid in vendor_ids:
+        lim = limits.get(vid, {"limit_amount": 0.0, "limit_boxes": 0, "source": None})
+        amount, boxes = spend.get(vid, (0.0, 0))
+        rows.append({
+            "vendor_id": vid,
+            "vendor_name": names.get(vid),
+            "month": month,
+            "limit_source": lim["source"],
+            "limit_amount": lim["limit_amount"],
+            "spent_amount": round(amount, 2),
+            "amount_utilization_pct": _pct(amount, lim["limit_amount"]),
+            "limit_boxes": lim["limit_boxes"],
+            "boxes": boxes,
+            "boxes_utilization_pct": _pct(boxes, lim["limit_boxes"]),
+        })
+    rows.sort(key=lambda r: (-max(r["amount_utilization_pct"] or 0, r["boxes_utilization_pct"] or 0), r["vendor_id"]))
+    return rows
+
+
+def rebuild(session: Session, month: str) -> int:
+    """Overwrite the month's rollup rows with totals recomputed from the order tables. Returns rows written."""
+    totals = compute_totals(session, month)
+    existing = set(session.exec(select(VendorMonthSpend.vendor_id).where(VendorMonthSpend.month == month)).all())
+    now = datetime.utcnow()
+    t = VendorMonthSpend.__table__
+    for vid in existing - set(totals):
+        totals[vid] = (0.0, 0)
+    if not totals:
+        return 0
+    if existing:
+        session.execute(
+            update(t)
+            .where(t.c.vendor_id == bindparam("b_vendor_id"), t.c.month == month)
+            .values(amount=bindparam("b_amount"), boxes=bindparam("b_boxes"), updated_at=now),
+            [{"b_vendor_id": vid, "b_amount": totals[vid][0], "b_boxes": totals[vid][1]} for vid in existing],
+        )
+    new = [{"vendor_id": vid, "month": month, "amount": a, "boxes": b, "updated_at": now}
+           for vid, (a, b) in totals.items() if vid not in existing]
+    if new:
+        session.execute(insert(t), new)
+    return len(totals)
+
+
+if __name__ == "__main__":
+    import sys
+
+    from .database import engine, init_db
+
+    init_db()
+    target = parse_month(sys.argv[1] if len(sys.argv) > 1 else None)
+    with Session(engine) as s:
+        n = rebuild(s, target)
+        s.commit()
+    print(f"rebuilt {n} vendor spend row(s) for {target}")
@@ -0,0 +1,73 @@
+# benchmarks/bench_load_planner.py
+"""
+Query count + wall time of load_planner.plan_loads for growing numbers of pending orders.
+
+Runs against a throwaway in-memory SQLite DB, so it needs no MySQL/Redis:
+
+    python -m benchmarks.bench_load_planner
+
+Query count must stay constant (vehicles + vehicle loads + order weights) and a
+few hundred orders should plan well under a second.
+"""
+import random
+import time
+
+from sqlalchemy import event
+from sqlmodel import Session, SQLModel, create_engine
+
+from app.load_planner import plan_loads
+from app.models import NewOrder, NewOrderItem, Product, Role, User, Vehicle
+
+ORDER_COUNTS = (100, 500, 2000)
+VEHICLES = 25
+ITEMS_PER_ORDER = 4
+
+
+def _seed(engine, n_orders: int):
+    rnd = random.Random(7)
+    with Session(engine) as s:
+        vendor = User(name="vendor", email="vendor@bench", role=Role.VENDOR, password_hash="x")
+        driver = User(name="driver", email="driver@bench", role=Role.DRIVER, password_hash="x")
+        s.add(vendor)
+        s.add(driver)
+        products = [Product(sku=f"SKU{i}", name=f"P{i}", weight=rnd.uniform(0.2, 25.0)) for i in range(50)]
+        s.add_all(products)
+        s.commit()
+        for i in range(VEHICLES):
+            ton = i % 2 == 0
+            s.add(Vehicle(driver_id=driver.id, vehicle_number=f"V{i}",
+                          capacity_weight=rnd.choice([1, 2, 5]) if ton else rnd.choice([500, 750, 1500]),
+                          capacity_unit="ton" if ton else "kg"))
+        for _ in range(n_orders):
+            o = NewOrder(vendor_id=vendor.id)
+            s.add(o)
+            s.flush()
+            s.add_all([NewOrderItem(new_order_id=o.id, product_id=p.id, qty=rnd.randint(1, 10))
+                       for p in rnd.sample(products, ITEMS_PER_ORDER)])
+        s.commit()
+
+
+def main():
+    print(f"{'orders':>8} {'queries':>8} {'ms':>10} {'placed':>8} {'left':>6}")
+    for n in ORDER_COUNTS:
+        engine = create_engine("sqlite://")
+        SQLModel.metadata.create_all(engine)
+        _seed(engine, n)
+
+        statements = []
+
+        @event.listens_for(engine, "before_cursor_execute")
+        def _count(conn, cursor, statement, params, context, executemany):
+            statements.append(statement)
+
+        with Session(engine) as s:
+            t0 = time.perf_counter()
+            plan = plan_loads(s)
+            elapsed = (time.perf_counter() - t0) * 1000
+        placed = sum(len(v["order_ids"]) for v in plan["vehicles"])
+        assert placed + len(plan["unassigned"]) == n
+        print(f"{n:>8} {len(statements):>8} {elapsed:>10.1f} {placed:>8} {len(plan['unassigned']):>6}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+# benchmarks/bench_new_order_listing.py
+"""
+Query count + wall time of GET /api/new-orders/ (list_orders) for growing page sizes.
+
+Runs against a throwaway in-memory SQLite DB, so it needs no MySQL/Redis:
+
+    python -m benchmarks.bench_new_order_listing
+
+The number of SQL statements per listing must stay constant (orders + items)
+regardless of page size.
+"""
+import time
+
+from sqlalchemy import event
+from sqlmodel import Session, SQLModel, create_engine
+
+from app.models import NewOrder, NewOrderItem, Product, Role, User
+from app.routers.new_orders import list_orders
+
+PAGE_SIZES = (10, 100, 500, 2000)
+ITEMS_PER_ORDER = 5
+
+
+def _seed(engine, n_orders: int):
+    with Session(engine) as s:
+        admin = User(name="admin", email="admin@bench", role=Role.ADMIN, password_hash="x")
+        vendor = User(name="vendor", email="vendor@bench", role=Role.VENDOR, password_hash="x")
+        s.add(admin)
+        s.add(vendor)
+        products = [Product(sku=f"SKU{i}", name=f"P{i}", price=10.0 + i) for i in range(ITEMS_PER_ORDER)]
+        s.add_all(products)
+        s.commit()
+        for _ in range(n_orders):
+            o = NewOrder(vendor_id=vendor.id, total_amount=0.0)
+            s.add(o)
+            s.flush()
+            s.add_all([NewOrderItem(new_order_id=o.id, product_id=p.id, qty=2, unit_price=p.price, subtotal=2 * p.price) for p in products])
+        s.commit()
+        return admin.id
+
+
+def main():
+    engine = create_engine("sqlite://")
+    SQLModel.metadata.create_all(engine)
+    admin_id = _seed(engine, max(PAGE_SIZES))
+
+    statements = []
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _count(conn, cursor, statement, params, context, executemany):
+        statements.append(statement)
+
+    print(f"{'page size':>10} {'queries':>8} {'ms':>10}")
+    for size in PAGE_SIZES:
+        with Session(engine) as s:
+            admin = s.get(User, admin_id)
+            statements.clear()
+            t0 = time.perf_counter()
+            rows = list_orders(limit=size, session=s, current=admin)
+            elapsed = (time.perf_counter() - t0) * 1000
+            assert len(rows) == size and all(len(r.items) == ITEMS_PER_ORDER for r in rows)
+            print(f"{size:>10} {len(statements):>8} {elapsed:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+# benchmarks/bench_route_sequencing.py
+"""
+Wall time and route quality of routing.sequence (nearest-neighbour + 2-opt) up to 200 stops.
+
+Pure NumPy, no DB or Redis needed:
+
+    python -m benchmarks.bench_route_sequencing
+
+Stops are random points in a ~60 km box around a depot. "nn km" is the
+nearest-neighbour seed, "2-opt km" the improved route; 200 stops should
+sequence well inside an API request budget.
+"""
+import random
+import time
+
+from app.routing import distance_matrix, nearest_neighbour, route_length, sequence
+
+STOP_COUNTS = (10, 25, 50, 100, 200)
+DEPOT = (21.2514, 81.6296)
+REPEATS = 3
+
+
+def _stops(n: int, rnd: random.Random):
+    return [(DEPOT[0] + rnd.uniform(-0.3, 0.3), DEPOT[1] + rnd.uniform(-0.3, 0.3)) for _ in range(n)]
+
+
+def main():
+    rnd = random.Random(42)
+    print(f"{'stops':>6} {'matrix ms':>10} {'total ms':>10} {'nn km':>10} {'2-opt km':>10} {'saved':>7}")
+    for n in STOP_COUNTS:
+        coords = [DEPOT] + _stops(n, rnd)
+
+        t0 = time.perf_counter()
+        for _ in range(REPEATS):
+            dist = distance_matrix(coords)
+        matrix_ms = (time.perf_counter() - t0) * 1000 / REPEATS
+
+        t0 = time.perf_counter()
+        for _ in range(REPEATS):
+            route, dist = sequence(coords)
+        total_ms = (time.perf_counter() - t0) * 1000 / REPEATS
+
+        assert sorted(route) == list(range(n + 1)) and route[0] == 0
+        nn_km = route_length(nearest_neighbour(dist), dist) / 1000
+        opt_km = route_length(route, dist) / 1000
+        print(f"{n:>6} {matrix_ms:>10.2f} {total_ms:>10.1f} {nn_km:>10.1f} {opt_km:>10.1f} {1 - opt_km / nn_km:>7.1%}")
+
+
+if __name__ == "__main__":
+    main()
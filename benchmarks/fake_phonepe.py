@@ -0,0 +1,168 @@
+# benchmarks/fake_phonepe.py
+"""
+Local stand-in for the PhonePe checkout sandbox (OAuth, pay, order status).
+
+    uvicorn benchmarks.fake_phonepe:app --port 8081
+
+and start the API with PHONEPE_BASE_URL=http://127.0.0.1:8081/apis/pg-sandbox
+(or the individual PHONEPE_OAUTH_URL / PHONEPE_PAY_URL / PHONEPE_STATUS_BASE).
+Paths and payloads mirror the sandbox, so nothing else changes.
+
+Behaviour is configured with env vars at start, or at runtime with
+POST /_fake/config {"latency_ms": 200, ...}; GET /_fake/stats shows counters.
+
+    FAKE_PHONEPE_LATENCY_MS     mean added latency per call (default 50)
+    FAKE_PHONEPE_JITTER_MS      +/- uniform jitter (default 25)
+    FAKE_PHONEPE_ERROR_RATE     share of calls answered 503 (default 0)
+    FAKE_PHONEPE_TIMEOUT_RATE   share of calls that hang for 30 s (default 0)
+    FAKE_PHONEPE_TOKEN_TTL      OAuth token lifetime in seconds (default 3600)
+    FAKE_PHONEPE_SETTLE_SECONDS an order stays PENDING this long (default 5)
+    FAKE_PHONEPE_SUCCESS_RATE   share of settled orders that COMPLETE, others FAIL (default 0.9)
+    FAKE_PHONEPE_WEBHOOK_URL    if set, POST a callback there when an order settles
+    FAKE_PHONEPE_WEBHOOK_USERNAME / FAKE_PHONEPE_WEBHOOK_PASSWORD  callback credentials
+"""
+import asyncio
+import hashlib
+import os
+import random
+import time
+import uuid
+from typing import Dict
+
+import httpx
+from fastapi import FastAPI, Form, Header, HTTPException, Request
+from fastapi.responses import JSONResponse
+
+PREFIX = "/apis/pg-sandbox"
+
+CONFIG = {
+    "latency_ms": float(os.getenv("FAKE_PHONEPE_LATENCY_MS", "50")),
+    "jitter_ms": float(os.getenv("FAKE_PHONEPE_JITTER_MS", "25")),
+    "error_rate": float(os.getenv("FAKE_PHONEPE_ERROR_RATE", "0")),
+    "timeout_rate": float(os.getenv("FAKE_PHONEPE_TIMEOUT_RATE", "0")),
+    "token_ttl": int(os.getenv("FAKE_PHONEPE_TOKEN_TTL", "3600")),
+    "settle_seconds": float(os.getenv("FAKE_PHONEPE_SETTLE_SECONDS", "5")),
+    "success_rate": float(os.getenv("FAKE_PHONEPE_SUCCESS_RATE", "0.9")),
+    "webhook_url": os.getenv("FAKE_PHONEPE_WEBHOOK_URL"),
+    "webhook_username": os.getenv("FAKE_PHONEPE_WEBHOOK_USERNAME", ""),
+    "webhook_password": os.getenv("FAKE_PHONEPE_WEBHOOK_PASSWORD", ""),
+}
+
+TOKENS: Dict[str, float] = {}          # token -> expires_at
+ORDERS: Dict[str, dict] = {}           # merchantOrderId -> order
+STATS: Dict[str, int] = {"oauth": 0, "pay": 0, "status": 0, "errors": 0, "timeouts": 0, "unauthorized": 0,
+                         "webhooks_sent": 0, "webhooks_failed": 0}
+
+app = FastAPI(title="Fake PhonePe gateway")
+
+
+async def _misbehave():
+    """Apply configured latency, then maybe an injected timeout or 503."""
+    delay = CONFIG["latency_ms"] + random.uniform(-CONFIG["jitter_ms"], CONFIG["jitter_ms"])
+    await asyncio.sleep(max(0.0, delay) / 1000)
+    roll = random.random()
+    if roll < CONFIG["timeout_rate"]:
+        STATS["timeouts"] += 1
+        await asyncio.sleep(30)
+    elif roll < CONFIG["timeout_rate"] + CONFIG["error_rate"]:
+        STATS["errors"] += 1
+        raise HTTPException(status_code=503, detail="injected failure")
+
+
+def _authorize(authorization: str):
+    token = (authorization or "").replace("O-Bearer", "", 1).strip()
+    if TOKENS.get(token, 0) < time.time():
+        STATS["unauthorized"] += 1
+        raise HTTPException(status_code=401, detail="invalid or expired token")
+
+
+def _settle(order: dict):
+    """Move a PENDING order to its final state once settle_seconds have passed."""
+    if order["state"] == "PENDING" and time.time() - order["created_at"] >= CONFIG["settle_seconds"]:
+        order["state"] = "COMPLETED" if random.random() < CONFIG["success_rate"] else "FAILED"
+        if CONFIG["webhook_url"]:
+            asyncio.get_running_loop().create_task(_send_webhook(order))
+
+
+async def _send_webhook(order: dict):
+    creds = f"{CONFIG['webhook_username']}:{CONFIG['webhook_password']}".encode()
+    body = {
+        "event": f"checkout.order.{order['state'].lower()}",
+        "payload": {k: order[k] for k in ("orderId", "merchantOrderId", "state", "amount")},
+    }
+    try:
+        async with httpx.AsyncClient(timeout=10) as client:
+            resp = await client.post(CONFIG["webhook_url"], json=body,
+                                     headers={"Authorization": hashlib.sha256(creds).hexdigest()})
+        STATS["webhooks_sent" if resp.status_code < 400 else "webhooks_failed"] += 1
+    except httpx.HTTPError:
+        STATS["webhooks_failed"] += 1
+
+
+async def _settle_later(order: dict):
+    await asyncio.sleep(CONFIG["settle_seconds"])
+    _settle(order)
+
+
+@app.post(f"{PREFIX}/v1/oauth/token")
+async def oauth_token(client_id: str = Form(...), client_secret: str = Form(...), grant_type: str = Form(...)):
+    STATS["oauth"] += 1
+    await _misbehave()
+    token = uuid.uuid4().hex
+    TOKENS[token] = time.time() + CONFIG["token_ttl"]
+    return {"access_token": token, "expires_in": CONFIG["token_ttl"], "token_type": "O-Bearer"}
+
+
+@app.post(f"{PREFIX}/checkout/v2/pay")
+async def pay(request: Request, authorization: str = Header(None)):
+    STATS["pay"] += 1
+    await _misbehave()
+    _authorize(authorization)
+    body = await request.json()
+    moid = body.get("merchantOrderId")
+    if not moid or not isinstance(body.get("amount"), int) or body["amount"] < 100:
+        return JSONResponse(status_code=400, content={"code": "BAD_REQUEST", "message": "invalid merchantOrderId / amount"})
+    order = ORDERS.get(moid)
+    if order is None:  # same merchantOrderId again returns the existing order, like the real gateway
+        order = {"orderId": f"OMO{uuid.uuid4().hex[:18].upper()}", "merchantOrderId": moid, "amount": body["amount"],
+                 "state": "PENDING", "created_at": time.time()}
+        ORDERS[moid] = order
+        if CONFIG["webhook_url"]:
+            asyncio.get_running_loop().create_task(_settle_later(order))
+    return {
+        "orderId": order["orderId"],
+        "state": order["state"],
+        "expireAt": int((order["created_at"] + body.get("expireAfter", 1200)) * 1000),
+        "redirectUrl": f"http://fake-phonepe.local/pay/{order['orderId']}",
+    }
+
+
+@app.get(f"{PREFIX}/checkout/v2/order/{{merchant_order_id}}/status")
+async def order_status(merchant_order_id: str, authorization: str = Header(None)):
+    STATS["status"] += 1
+    await _misbehave()
+    _authorize(authorization)
+    order = ORDERS.get(merchant_order_id)
+    if order is None:
+        return JSONResponse(status_code=404, content={"code": "NOT_FOUND", "message": "order not found"})
+    _settle(order)
+    return {"orderId": order["orderId"], "state": order["state"], "amount": order["amount"],
+            "expireAt": int((order["created_at"] + 1200) * 1000)}
+
+
+@app.post("/_fake/config")
+async def update_config(request: Request):
+    changes = await request.json()
+    unknown = set(changes) - set(CONFIG)
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"unknown keys: {sorted(unknown)}")
+    CONFIG.update(changes)
+    return CONFIG
+
+
+@app.get("/_fake/stats")
+async def stats():
+    states: Dict[str, int] = {}
+    for o in ORDERS.values():
+        states[o["state"]] = states.get(o["state"], 0) + 1
+    return {"calls": STATS, "orders": states, "config": CONFIG}
@@ -0,0 +1,158 @@
+# benchmarks/load_vendor_payments.py
+"""
+Load test of the vendor order -> PhonePe payment -> status sync path against the fake gateway.
+
+    # 1. fake gateway (settles orders after 5 s, 90% succeed)
+    uvicorn benchmarks.fake_phonepe:app --port 8081
+    # 2. the API, pointed at it (same DATABASE_URL / SECRET_KEY as this script)
+    PHONEPE_BASE_URL=http://127.0.0.1:8081/apis/pg-sandbox PAYMENT_ENABLED=true \\
+        gunicorn app.main:app -k uvicorn.workers.UvicornWorker -w 4 -b 127.0.0.1:8000
+    # 3. the scenario
+    python -m benchmarks.load_vendor_payments --orders 500 --concurrency 50
+
+Each virtual vendor creates a PO (POST /api/vendor/orders, which creates the
+PhonePe checkout), then polls POST /api/vendor/orders/{id}/sync-payment-status
+until the payment is COMPLETED or FAILED. Vendors and a product are created
+directly in the database and JWTs minted locally, so no admin login is needed.
+Reports per-step latency percentiles, errors, throughput and time to settle.
+"""
+import argparse
+import asyncio
+import time
+import uuid
+from collections import defaultdict
+from typing import Dict, List
+
+import httpx
+from sqlmodel import Session, select
+
+from app.auth import create_access_token
+from app.database import engine, init_db
+from app.models import Product, Role, User
+
+FINAL_STATES = ("COMPLETED", "FAILED")
+
+
+def _seed(n_vendors: int):
+    init_db()
+    with Session(engine) as s:
+        product = s.exec(select(Product).where(Product.sku == "LOADTEST-1")).first()
+        if not product:
+            product = Product(sku="LOADTEST-1", name="Load test product", price=125.0)
+            s.add(product)
+        vendor_ids = []
+        for i in range(n_vendors):
+            email = f"loadtest-vendor-{i}@example.test"
+            v = s.exec(select(User).where(User.email == email)).first()
+            if not v:
+                v = User(name=f"Load vendor {i}", email=email, role=Role.VENDOR, password_hash="x")
+                s.add(v)
+                s.flush()
+            vendor_ids.append(v.id)
+        s.commit()
+        return product.id, [create_access_token({"sub": str(vid)}) for vid in vendor_ids]
+
+
+def _pct(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+
+class Recorder:
+    def __init__(self):
+        self.latency: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Dict[str, Dict[str, int]] = defaultdict(lambda: defaultdict(int))
+        self.outcomes: Dict[str, int] = defaultdict(int)
+        self.settle_seconds: List[float] = []
+
+    async def call(self, step: str, coro):
+        t0 = time.perf_counter()
+        try:
+            resp = await coro
+        except httpx.HTTPError as e:
+            self.errors[step][type(e).__name__] += 1
+            return None
+        self.latency[step].append((time.perf_counter() - t0) * 1000)
+        if resp.status_code >= 400:
+            self.errors[step][str(resp.status_code)] += 1
+            return None
+        return resp
+
+
+async def _one_order(client: httpx.AsyncClient, token: str, product_id: int, rec: Recorder, args):
+    headers = {"Authorization": f"Bearer {token}"}
+    started = time.perf_counter()
+    resp = await rec.call("create", client.post(
+        "/api/vendor/orders",
+        json={"items": [{"product_id": product_id, "qty": 2}]},
+        headers={**headers, "Idempotency-Key": uuid.uuid4().hex},
+    ))
+    if resp is None:
+        rec.outcomes["create_failed"] += 1
+        return
+    po = resp.json()
+    if po.get("status") != "pending_payment":
+        rec.outcomes["no_payment"] += 1
+        return
+    deadline = started + args.sync_timeout
+    while time.perf_counter() < deadline:
+        await asyncio.sleep(args.sync_every)
+        resp = await rec.call("sync", client.post(f"/api/vendor/orders/{po['id']}/sync-payment-status", headers=headers))
+        if resp is None:
+            continue
+        body = resp.json()
+        if body.get("gateway_state") in FINAL_STATES:
+            rec.outcomes[body["gateway_state"].lower()] += 1
+            rec.outcomes[f"answered_from_{body.get('source', 'gateway')}"] += 1
+            rec.settle_seconds.append(time.perf_counter() - started)
+            return
+    rec.outcomes["not_settled"] += 1
+
+
+async def run(args):
+    product_id, tokens = _seed(args.vendors)
+    rec = Recorder()
+    sem = asyncio.Semaphore(args.concurrency)
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+
+    async with httpx.AsyncClient(base_url=args.api, timeout=30, limits=limits) as client:
+        async def bounded(i):
+            async with sem:
+                await _one_order(client, tokens[i % len(tokens)], product_id, rec, args)
+
+        t0 = time.perf_counter()
+        await asyncio.gather(*(bounded(i) for i in range(args.orders)))
+        wall = time.perf_counter() - t0
+
+        print(f"{args.orders} orders, {args.vendors} vendors, concurrency {args.concurrency}: {wall:.1f} s "
+              f"({args.orders / wall:.1f} orders/s)")
+        print(f"{'step':>8} {'calls':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8}  errors")
+        for step, values in rec.latency.items():
+            print(f"{step:>8} {len(values):>7} {_pct(values, .5):>8.1f} {_pct(values, .95):>8.1f} "
+                  f"{_pct(values, .99):>8.1f} {max(values):>8.1f}  {dict(rec.errors[step]) or '-'}")
+        print("outcomes:", dict(rec.outcomes))
+        if rec.settle_seconds:
+            print(f"time to settle: p50 {_pct(rec.settle_seconds, .5):.1f} s, p95 {_pct(rec.settle_seconds, .95):.1f} s")
+        try:
+            gw = (await client.get(f"{args.gateway}/_fake/stats")).json()
+            print("gateway:", gw["calls"], gw["orders"])
+        except (httpx.HTTPError, ValueError):
+            pass
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    p.add_argument("--api", default="http://127.0.0.1:8000")
+    p.add_argument("--gateway", default="http://127.0.0.1:8081", help="fake gateway, for its /_fake/stats")
+    p.add_argument("--vendors", type=int, default=20)
+    p.add_argument("--orders", type=int, default=200)
+    p.add_argument("--concurrency", type=int, default=50)
+    p.add_argument("--sync-every", type=float, default=1.0, help="seconds between status syncs per order")
+    p.add_argument("--sync-timeout", type=float, default=60.0)
+    asyncio.run(run(p.parse_args()))
+
+
+if __name__ == "__main__":
+    main()